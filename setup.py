@@ -32,13 +32,27 @@ entry_points = {
      ]
 }
 
+# OpenMP flags are added only if the compiler builds with them (see openmp_flags in taylor_tree.pyxbld). Without
+# OpenMP, the kernels run on a single thread.
+pyxbld = {}
+with open("turbo_seti/find_doppler/taylor_tree.pyxbld", "r") as fh:
+    exec(fh.read(), pyxbld)
+
+class openmp_build_ext(build_ext):
+    def build_extensions(self):
+        compile_args, link_args = pyxbld['openmp_flags'](self.compiler)
+        for extension in self.extensions:
+            extension.extra_compile_args += compile_args
+            extension.extra_link_args += link_args
+        build_ext.build_extensions(self)
+
 extensions = [Extension(
         name="turbo_seti.find_doppler.taylor_tree",
         sources=["turbo_seti/find_doppler/taylor_tree.pyx"],
         include_dirs=[numpy.get_include()],
         )
     ]
-cmdclass = {'build_ext': build_ext}
+cmdclass = {'build_ext': openmp_build_ext}
 
 
 # Need to copy over index files, generate filenames
@@ -46,6 +60,7 @@ idxs = [2,3,4,5,6,7,8,9,10,11]
 drift_idxs = ['drift_indexes/drift_indexes_array_%i.txt' % ii for ii in idxs]
 package_data={
     'turbo_seti': drift_idxs,
+    'turbo_seti.find_doppler': ['taylor_tree.pyx', 'taylor_tree.pyxbld'],
 }
 
 setup(
@@ -8,7 +8,7 @@ import os
 HERE = os.path.split(os.path.abspath(__file__))[0]
 
 
-def find_doppler(filename_fil):
+def find_doppler(filename_fil, **kwargs):
     """ Run turboseti doppler search on filename with default params """
     print("Searching %s" % filename_fil)
     suffix = os.path.splitext(filename_fil)[1]
@@ -28,7 +28,8 @@ def find_doppler(filename_fil):
     max_drift     = 1.0
 
     find_seti_event = FindDoppler(filename_fil, max_drift=max_drift, snr=snr, out_dir=HERE,
-                                  coarse_chans=coarse_chans, obs_info=obs_info, n_coarse_chan=n_coarse_chan)
+                                  coarse_chans=coarse_chans, obs_info=obs_info, n_coarse_chan=n_coarse_chan,
+                                  **kwargs)
     find_seti_event.search()
 
 
@@ -125,6 +126,13 @@ def test_find_doppler_voyager_flipped():
     validate_voyager_hits(filename_dat)
     plot_hits(filename_fil, filename_dat)
 
+def test_find_doppler_voyager_float32():
+    """ Run turboseti on Voyager data in single precision """
+    filename_fil = os.path.join(HERE, 'Voyager1.single_coarse.fine_res.h5')
+    filename_dat = filename_fil.replace('.h5', '.dat')
+    find_doppler(filename_fil, dtype='float32')
+    validate_voyager_hits(filename_dat)
+
 def test_find_doppler_voyager_filterbank():
     """ Run turboseti on Voyager data (filterbank version) """
     filename_fil = os.path.join(HERE, 'Voyager1.single_coarse.fine_res.fil')
@@ -141,6 +149,645 @@ def test_turboSETI_entry_point():
     args = [filename_fil, ]
     seti_event.main(args)
 
+def test_taylor_flt_threads():
+    """ The multithreaded taylor_flt kernel must match the single-threaded one bit for bit """
+    from turbo_seti.find_doppler import taylor_tree as tt
+    tsteps, tdwidth = 16, 4096
+    spectra = np.random.RandomState(42).normal(size=tsteps * tdwidth)
+
+    tree_1 = spectra.copy()
+    tt.taylor_flt(tree_1, tsteps * tdwidth, tsteps)
+    tree_n = spectra.copy()
+    tt.taylor_flt(tree_n, tsteps * tdwidth, tsteps, 4)
+
+    assert not np.array_equal(tree_1, spectra)
+    assert np.array_equal(tree_1, tree_n)
+
+def test_taylor_flt_reverse():
+    """ taylor_flt_reverse must equal flipping every row around a forward taylor_flt """
+    from turbo_seti.find_doppler import taylor_tree as tt
+    from turbo_seti.find_doppler.helper_functions import FlipX
+    tsteps, tdwidth = 16, 4096
+    spectra = np.random.RandomState(42).normal(size=tsteps * tdwidth)
+
+    tree_flip = spectra.copy()
+    FlipX(tree_flip, tdwidth, tsteps)
+    tt.taylor_flt(tree_flip, tsteps * tdwidth, tsteps)
+    FlipX(tree_flip, tdwidth, tsteps)
+
+    tree_rev = spectra.copy()
+    tt.taylor_flt_reverse(tree_rev, tsteps * tdwidth, tsteps, 2)
+    assert np.array_equal(tree_flip, tree_rev)
+
+def test_taylor_flt_tiled():
+    """ Summing the tree in frequency tiles gives the same tree as sweeping it whole at every stage """
+    from turbo_seti.find_doppler import taylor_tree as tt
+    tsteps, tdwidth = 16, 1000
+    for dtype in ('float64', 'float32'):
+        spectra = np.random.RandomState(42).normal(size=tsteps * tdwidth).astype(dtype)
+        for taylor_flt in (tt.taylor_flt, tt.taylor_flt_reverse):
+            tree = spectra.copy()
+            taylor_flt(tree, tsteps * tdwidth, tsteps)
+            for tile_width in (1, 7, 16, 100, tdwidth - tsteps - 1):
+                tree_tiled = spectra.copy()
+                taylor_flt(tree_tiled, tsteps * tdwidth, tsteps, 2, tile_width)
+                assert np.array_equal(tree, tree_tiled)
+
+def test_populate_tree():
+    """ populate_tree fills every row with its spectrum rolled as np.roll would, and the end of it in the shoulder """
+    from turbo_seti.find_doppler.find_doppler import populate_tree
+    tsteps, fftlen, shoulder_size = 8, 1000, 4
+    tdwidth = fftlen + shoulder_size * tsteps
+    shoulder = tsteps * shoulder_size // 2
+    for dtype in ('float64', 'float32'):
+        spectra = np.random.RandomState(42).normal(size=(tsteps, fftlen)).astype(dtype)
+        for roll in (-3, 0, 2):
+            tree = np.full(tsteps * tdwidth, -1., dtype=dtype)
+            populate_tree(spectra, tree, tsteps, tdwidth, tsteps, fftlen, shoulder_size, roll=roll, reverse=1,
+                          n_threads=2)
+            tree = tree.reshape((tsteps, tdwidth))
+            for i in range(tsteps):
+                assert np.array_equal(tree[i, shoulder:shoulder + fftlen], np.roll(spectra[i], -roll * i))
+                assert np.array_equal(tree[i, :shoulder], spectra[i, fftlen - shoulder:])
+                assert (tree[i, shoulder + fftlen:] == -1).all()
+
+def test_plan_drift_blocks():
+    """ Only the directions of the drift blocks with drift rates in range get a tree """
+    from turbo_seti.find_doppler.find_doppler import plan_drift_blocks
+    plan = plan_drift_blocks(3, 16, 0.01, 0, 0.5)
+    assert [drift_block for drift_block, _, _ in plan] == list(range(-3, 4))
+    assert sum((negative is not None) + (positive is not None) for _, negative, positive in plan) == 8
+
+    # Blocks whose drift rates are all below min_drift, in absolute value, are skipped in both directions
+    plan = plan_drift_blocks(3, 16, 0.01, 0.35, 0.5)
+    assert [drift_block for drift_block, _, _ in plan] == [-3, -2, 2, 3]
+    assert [drift_block for drift_block, _, positive in plan if positive is not None] == [2, 3]
+    assert [drift_block for drift_block, negative, _ in plan if negative is not None] == [-3, -2]
+    for drift_block, negative, positive in plan:
+        for direction in (negative, positive):
+            assert direction is None or direction[1].any()
+    for direction in (1, 2):
+        rates = np.concatenate([drifts[direction][0][drifts[direction][1]] for drifts in plan
+                                if drifts[direction] is not None])
+        assert np.abs(rates).min() >= 0.35 and np.abs(rates).max() <= 0.5
+
+    # With min_drift 0, the drift rate 0 is searched once, in the positive direction
+    plan = plan_drift_blocks(0, 16, 0.01, 0, 0.5)
+    (drift_block, negative, positive), = plan
+    assert negative[0][negative[1]].max() < 0 and positive[0][positive[1]].min() == 0
+
+def test_min_drift(tmpdir):
+    """ A search with min_drift finds the hits of the full search with large enough drift rates """
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    tables = []
+    for min_drift in (0, 0.2):
+        out_dir = str(tmpdir.mkdir('out_%s' % min_drift))
+        FindDoppler(filename_h5, max_drift=1.0, min_drift=min_drift, snr=10, out_dir=out_dir).search()
+        tables.append(find_event.make_table(os.path.join(out_dir, 'multi_coarse.dat')))
+    full, pruned = tables
+    assert set(np.round(full['DriftRate'], 6)) > set(np.round(pruned['DriftRate'], 6))
+    assert (np.abs(pruned['DriftRate']) >= 0.2).all()
+    # The signals drifting at 0.3 and -0.25 Hz/s are found with the same drift rates and SNRs
+    for drift_rate in full['DriftRate'][np.abs(full['DriftRate']) >= 0.2]:
+        assert drift_rate in pruned['DriftRate'].values
+    assert np.allclose(np.sort(full['SNR'][np.abs(full['DriftRate']) >= 0.2]), np.sort(pruned['SNR']))
+
+def test_hitsearch_block():
+    """ The vectorized hit search must match hitsearch called once per drift rate """
+    from turbo_seti.find_doppler.find_doppler import hitsearch, hitsearch_block, max_vals
+
+    def new_max_vals(n):
+        max_val = max_vals()
+        max_val.maxsnr = np.zeros(n)
+        max_val.maxdrift = np.zeros(n)
+        max_val.maxid = np.zeros(n, dtype='uint32')
+        return max_val
+
+    tsteps, tdwidth = 16, 1000
+    header = {'NAXIS1': tdwidth, 'FCNTR': 8000., 'DELTAF': 1e-6, 'baryv': 0.}
+    tree = np.round(np.random.RandomState(7).normal(size=tsteps * tdwidth) * 3)  # plenty of ties
+    tree_rows = np.random.RandomState(8).permutation(tsteps)
+    drift_rates = np.linspace(-1, 1, tsteps)
+
+    max_loop, max_block = new_max_vals(tdwidth), new_max_vals(tdwidth)
+    tree_loop, tree_block = tree.copy(), tree.copy()
+    n_hits_loop = []
+    for row, drift_rate in zip(tree_rows, drift_rates):
+        spectrum = tree_loop[row * tdwidth: (row + 1) * tdwidth]
+        spectrum -= 0.5
+        spectrum /= 1.5
+        n_hits, max_loop = hitsearch(spectrum, 5, tdwidth - 5, 2.0, drift_rate, header, tdwidth, tdwidth, max_loop, 0)
+        n_hits_loop.append(n_hits)
+    n_hits_block, max_block = hitsearch_block(tree_block, tree_rows, drift_rates, 0.5, 1.5, 5, tdwidth - 5, 2.0,
+                                              header, tdwidth, max_block)
+
+    assert list(n_hits_block) == n_hits_loop
+    for key in ('maxsnr', 'maxdrift', 'maxid'):
+        assert np.array_equal(getattr(max_loop, key), getattr(max_block, key))
+
+def test_sliding_window_max():
+    """ The linear-time window maximum must match a direct maximum over every window """
+    from turbo_seti.find_doppler.helper_functions import sliding_window_max
+
+    arrey = np.random.RandomState(3).randint(0, 20, size=101).astype('float64')
+    for before, after in ((1, 1), (3, 5), (7, 0), (0, 4), (60, 80), (0, 0)):
+        expected = [max(arrey[max(0, i - before):i + after], default=-np.inf) for i in range(len(arrey))]
+        assert np.array_equal(sliding_window_max(arrey, before, after), expected)
+
+def make_multi_coarse_h5(filename, n_coarse_chan=4, n_fine_chan=4096, n_ints=16, source_name='Synthetic'):
+    """ Writes a small synthetic filterbank .h5 file with a few drifting signals in every coarse channel """
+    import h5py
+    foff, tsamp = -2.7939677238464355e-06, 18.253611008
+    data = np.random.RandomState(1).chisquare(8, size=(n_ints, 1, n_coarse_chan * n_fine_chan)).astype('float32')
+    for coarse_chan in range(n_coarse_chan):
+        for pos, drift_rate in ((500, 0.3), (2000, -0.25), (3000, 0.)):
+            for t in range(n_ints):
+                data[t, 0, coarse_chan * n_fine_chan + pos + int(round(drift_rate * t * tsamp / (abs(foff) * 1e6)))] += 40
+    with h5py.File(filename, 'w') as h5:
+        h5.attrs['CLASS'] = 'FILTERBANK'
+        h5.attrs['VERSION'] = '1.0'
+        dset = h5.create_dataset('data', data=data)
+        header = dict(fch1=8421.386717353016, foff=foff, nchans=data.shape[2], nifs=1, nbits=32,
+                      tstart=57650.78209490741, tsamp=tsamp, source_name=source_name, src_raj=17.17, src_dej=12.3,
+                      telescope_id=6, machine_id=10, data_type=1, az_start=0.0, za_start=0.0)
+        for key, value in header.items():
+            dset.attrs[key] = value
+
+def test_find_doppler_workers(tmpdir):
+    """ Searching coarse channels in worker processes must give the same files as the serial search """
+    from turbo_seti.find_doppler.data_handler import DATAHandle
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+
+    outputs = []
+    for n_workers in (1, 2):
+        out_dir = str(tmpdir.mkdir('out_%d' % n_workers))
+        find_seti_event = FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=out_dir, n_workers=n_workers)
+        # Force the per coarse channel plan on this small file.
+        find_seti_event.data_handle = DATAHandle(filename_h5, size_limit=0, out_dir=out_dir, n_coarse_chan=4)
+        find_seti_event.search()
+        outputs.append([open(os.path.join(out_dir, 'multi_coarse' + ext)).read() for ext in ('.dat', '.log')])
+
+    assert outputs[0] == outputs[1]
+    top_hits = [line for line in outputs[0][0].splitlines() if not line.startswith('#')]
+    assert len(top_hits) >= 12  # the three signals of every coarse channel
+
+def test_stage_records(tmpdir):
+    """ Every stage of every coarse channel is recorded, in the .stages.json file and through the callback """
+    import json
+    from turbo_seti.find_doppler.data_handler import DATAHandle
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+    stages = ['load_data', 'comp_stats', 'populate_tree', 'taylor_flt', 'hitsearch', 'tophitsearch', 'write']
+
+    for n_workers in (1, 2):
+        out_dir = str(tmpdir.mkdir('out_%d' % n_workers))
+        records = []
+        find_seti_event = FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=out_dir, n_workers=n_workers,
+                                      stage_callback=records.append)
+        find_seti_event.data_handle = DATAHandle(filename_h5, size_limit=0, out_dir=out_dir, n_coarse_chan=4)
+        find_seti_event.search()
+
+        stage_json = json.load(open(os.path.join(out_dir, 'multi_coarse.stages.json')))
+        assert stage_json['stages'] == records
+        assert records[0]['stage'] == 'plan'
+        for coarse_chan in range(4):
+            chan_stages = dict((record['stage'], record) for record in records if record['coarse_chan'] == coarse_chan)
+            assert set(stages) <= set(chan_stages)
+            assert chan_stages['load_data']['bytes'] == 16 * 4096 * 8
+            assert chan_stages['hitsearch']['hits'] > 0
+            assert chan_stages['tophitsearch']['hits'] >= 3
+            assert chan_stages['write']['bytes'] > 0
+            assert chan_stages['taylor_flt']['peak_rss'] > 0
+        assert stage_json['totals']['tophitsearch']['hits'] == \
+            len([line for line in open(os.path.join(out_dir, 'multi_coarse.dat')) if not line.startswith('#')])
+
+def test_search_workspace(tmpdir):
+    """ The coarse channels of a search share one workspace, which is reset in place between them """
+    import json
+    from turbo_seti.find_doppler.data_handler import DATAHandle
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+
+    hits = []
+    for ii in range(2):
+        out_dir = str(tmpdir.mkdir('out_%d' % ii))
+        if ii == 0:
+            find_seti_event = FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=out_dir)
+        find_seti_event.out_dir = out_dir
+        find_seti_event.data_handle = DATAHandle(filename_h5, size_limit=0, out_dir=out_dir, n_coarse_chan=4)
+        find_seti_event.search()
+        assert len(find_seti_event.workspaces) == 1
+        hits.append([line for line in open(os.path.join(out_dir, 'multi_coarse.dat')) if not line.startswith('#')])
+        # The stage records are those of this search only
+        stage_json = json.load(open(os.path.join(out_dir, 'multi_coarse.stages.json')))
+        assert [record['stage'] for record in stage_json['stages']].count('plan') == 1
+        assert stage_json['totals']['tophitsearch']['hits'] == len(hits[-1])
+
+        # Leftovers of a previous search must not leak into the next one
+        workspace = list(find_seti_event.workspaces.values())[0]
+        workspace.tree_findoppler.fill(1e9)
+        workspace.max_val.maxsnr.fill(1e9)
+        workspace.max_val.total_n_hits = 1000
+    assert len(hits[0]) > 0
+    assert hits[0] == hits[1]
+
+def test_split_plan_header_only(tmpdir):
+    """ Planning a split reads the file header once; the coarse channels open the file only to load their data """
+    from turbo_seti.find_doppler.data_handler import DATAHandle, DATAH5
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+
+    data_handle = DATAHandle(filename_h5, size_limit=0, n_coarse_chan=4)
+    assert len(data_handle.data_list) == 4
+    for data_obj in data_handle.data_list:
+        assert not hasattr(data_obj, 'fil_file')
+        own_header = DATAH5(filename_h5, f_start=data_obj.f_start, f_stop=data_obj.f_stop,
+                            coarse_chan=data_obj.header['coarse_chan'], tn_coarse_chan=4).header
+        assert data_obj.header == own_header
+
+    spectra, drift_indexes = data_handle.data_list[1].load_data()
+    assert spectra.shape == (16, 4096)
+    data_handle.data_list[1].close()
+    data_handle.data_list[2].close()
+
+def test_filterbank_memmap(tmpdir, monkeypatch):
+    """ Coarse channels of a .fil file are read in place, with the same data as from the equivalent .h5 file """
+    from turbo_seti.find_doppler import data_handler
+    from turbo_seti.find_doppler.data_handler import DATAHandle
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    filename_fil = str(tmpdir.join('multi_coarse.fil'))
+    make_multi_coarse_h5(filename_h5)
+    bl.Waterfall(filename_h5).write_to_fil(filename_fil)
+    out_dir = str(tmpdir.mkdir('out'))
+
+    # The file type is found once per file, not once per coarse channel
+    checks = []
+    is_filterbank = data_handler.sigproc.is_filterbank
+    monkeypatch.setattr(data_handler.sigproc, 'is_filterbank', lambda filename: checks.append(filename) or
+                        is_filterbank(filename))
+    DATAHandle(filename_fil, size_limit=0, out_dir=out_dir, n_coarse_chan=1)
+    n_checks = len(checks)
+    handle_h5 = DATAHandle(filename_h5, size_limit=0, n_coarse_chan=4)
+    handle_fil = DATAHandle(filename_fil, size_limit=0, out_dir=out_dir, n_coarse_chan=4)
+    assert len(checks) == 2 * n_checks
+    assert handle_fil.filename == filename_fil
+    for data_h5, data_fil in zip(handle_h5.data_list, handle_fil.data_list):
+        assert data_fil.is_filterbank and not data_h5.is_filterbank
+        assert np.array_equal(data_h5.load_data()[0], data_fil.load_data()[0])
+        data_h5.close()
+        data_fil.close()
+    assert os.listdir(out_dir) == []
+
+def test_load_data_direct(tmpdir):
+    """ Spectra are read straight into a zero-padded buffer of the requested dtype, DC blanked as blimpy does """
+    from turbo_seti.find_doppler.data_handler import DATAHandle
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_ints=12)
+
+    for dtype in ('float64', 'float32'):
+        data_handle = DATAHandle(filename_h5, size_limit=0, n_coarse_chan=4, dtype=dtype)
+        for data_obj in data_handle.data_list:
+            spectra = data_obj.load_data()[0]
+            fil = bl.Waterfall(filename_h5, f_start=data_obj.f_start, f_stop=data_obj.f_stop)
+            fil.blank_dc(int(fil.calc_n_coarse_chan()))
+            assert spectra.dtype == np.dtype(dtype) and spectra.shape == (16, 4096)
+            assert np.array_equal(spectra[:12], np.squeeze(fil.data).astype(dtype))
+            assert not spectra[12:].any()
+            data_obj.close()
+
+def test_prefetch():
+    """ The prefetching loader yields the coarse channels in order, and passes on loading errors """
+    from turbo_seti.find_doppler.data_handler import DATAPrefetch
+
+    class FakeData:
+        def __init__(self, ii):
+            self.ii = ii
+        def load_data(self):
+            if self.ii == 3:
+                raise IOError('cannot read coarse channel 3')
+            return np.full(4, self.ii), None
+
+    for depth in (0, 1, 2):
+        loader = DATAPrefetch([FakeData(ii) for ii in range(3)], depth=depth)
+        assert [(data_obj.ii, loaded[0][0]) for data_obj, loaded in loader] == [(0, 0), (1, 1), (2, 2)]
+        assert len(loader.io_wait) == 3
+
+        loader = DATAPrefetch([FakeData(ii) for ii in range(5)], depth=depth)
+        seen = []
+        try:
+            for data_obj, loaded in loader:
+                seen.append(data_obj.ii)
+        except IOError:
+            pass
+        assert seen == [0, 1, 2]
+
+def test_prefetch_residency():
+    """ With a slow search, at most depth coarse channels are loaded ahead of the one searched """
+    import time
+    import threading
+    from turbo_seti.find_doppler.data_handler import DATAPrefetch
+
+    lock = threading.Lock()
+    resident = [0, 0]   # now, peak
+
+    class FakeData:
+        def load_data(self):
+            with lock:
+                resident[0] += 1
+                resident[1] = max(resident)
+            return np.zeros(4), None
+
+    for depth in (1, 2):
+        resident[:] = [0, 0]
+        for data_obj, loaded in DATAPrefetch([FakeData() for ii in range(6)], depth=depth):
+            time.sleep(0.05)
+            with lock:
+                resident[0] -= 1
+        assert resident[1] == depth + 1
+
+def test_prefetch_load_time():
+    """ The load time of every channel is its own, also when the loader is several channels ahead """
+    import time
+    from turbo_seti.find_doppler.data_handler import DATAPrefetch
+
+    class FakeData:
+        def __init__(self, ii):
+            self.ii = ii
+        def load_data(self):
+            time.sleep(0.2 if self.ii % 2 else 0.01)
+            return np.zeros(4), None
+
+    loader = DATAPrefetch([FakeData(ii) for ii in range(6)], depth=3)
+    for data_obj, loaded in loader:
+        time.sleep(0.3)
+        if data_obj.ii % 2:
+            assert 0.15 < loader.load_time[-1] < 0.3
+        else:
+            assert loader.load_time[-1] < 0.1
+    assert len(loader.load_time) == 6
+
+def test_drift_index_table(tmpdir):
+    """ Generated drift index tables must match the shipped ones, and be cached as .npy files """
+    from turbo_seti.find_doppler.helper_functions import drift_index_table
+    from turbo_seti.find_doppler import data_handler
+    from pkg_resources import resource_filename
+
+    for n in range(2, 11):
+        shipped = np.genfromtxt(resource_filename('turbo_seti', 'drift_indexes/drift_indexes_array_%d.txt' % n),
+                                dtype=int)
+        assert np.array_equal(drift_index_table(2**n), shipped)
+
+    cache_dir = str(tmpdir)
+    table = data_handler.load_drift_index_table(2**12, cache_dir=cache_dir)
+    assert table.shape == (2**11, 2**12)
+    assert np.array_equal(table[-1], np.arange(2**12))
+    del data_handler._drift_index_tables[2**12]
+    assert np.array_equal(np.load(os.path.join(cache_dir, 'drift_indexes_array_12.npy')), table)
+    assert np.array_equal(data_handler.load_drift_index_table(2**12, cache_dir=cache_dir), table)
+
+def test_buffered_writers(tmpdir):
+    """ Writers keep one buffered handle open, and flush it at close """
+    from turbo_seti.find_doppler.file_writers import LogWriter
+    filename_log = str(tmpdir.join('buffered.log'))
+
+    with LogWriter(filename_log) as logwriter:
+        handle = logwriter.filehandle
+        for ii in range(1000):
+            logwriter.info('line %d' % ii)
+        assert logwriter.filehandle is handle and logwriter.is_open()
+    assert not logwriter.is_open()
+    assert open(filename_log).read().splitlines() == ['line %d' % ii for ii in range(1000)]
+
+    logwriter.start_over()
+    logwriter.info('again')
+    logwriter.close()
+    assert open(filename_log).read() == 'again\n'
+
+def test_hits_h5(tmpdir):
+    """ The binary hit file must hold the same hits as the .dat file """
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    out_dir = str(tmpdir.mkdir('out'))
+    FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=out_dir, hits_h5=True).search()
+
+    table_dat = find_event.make_table(os.path.join(out_dir, 'multi_coarse.dat'))
+    table_h5 = find_event.make_table(os.path.join(out_dir, 'multi_coarse.hits.h5'))
+    assert len(table_dat) >= 3
+    assert list(table_dat.columns) == list(table_h5.columns)
+    for column in table_dat.columns:
+        assert table_dat[column].dtype == table_h5[column].dtype
+        if table_dat[column].dtype.kind == 'f':
+            assert np.allclose(table_dat[column], table_h5[column], rtol=0, atol=1e-6)
+        else:
+            assert (table_dat[column] == table_h5[column]).all()
+
+    # A data file listed by mistake is refused, not read as hits
+    try:
+        find_event.make_table(filename_h5)
+        assert False, 'make_table read an observation file'
+    except ValueError:
+        pass
+
+def test_read_dat_cache(tmpdir):
+    """ The .npz sidecar of a .dat file gives the same table, and is refreshed when the .dat file changes """
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=str(tmpdir)).search()
+    filename_dat = str(tmpdir.join('multi_coarse.dat'))
+
+    table = find_event.read_dat(filename_dat)
+    assert len(table) >= 3
+    assert table['TopHitNum'].tolist() == list(range(1, len(table) + 1))
+    assert find_event.read_dat(filename_dat, cache=True).equals(table)
+    assert os.path.isfile(filename_dat + '.npz')
+    assert find_event.read_dat(filename_dat, cache=True).equals(table)
+
+    lines = open(filename_dat).readlines()
+    with open(filename_dat, 'w') as file_dat:
+        file_dat.writelines(lines[:-1])
+    assert find_event.read_dat(filename_dat, cache=True).equals(table.iloc[:-1])
+
+def test_rfi_in_range():
+    """ Sorted-interval RFI counts must match a scan of the OFF table for every hit """
+    import pandas as pd
+    rng = np.random.RandomState(5)
+    on_table = pd.DataFrame({'Freq': np.round(rng.uniform(8000, 8001, 500), 3),
+                             'DriftRate': rng.choice([0., 0.5], 500), 'DELTAF': '-2.793968', 'DELTAT': '18.253611'})
+    off_table = pd.DataFrame({'Freq': np.round(rng.uniform(8000, 8001, 2000), 3)})
+    # OFF hits exactly on range borders must not count
+    off_table = pd.concat([off_table, pd.DataFrame({'Freq': on_table['Freq'][:50] + 2.0 * 300 / 1e6})])
+
+    expected = on_table.apply(lambda hit: len(off_table[((off_table['Freq'] > find_event.calc_freq_range(hit)[0]) &
+                                                         (off_table['Freq'] < find_event.calc_freq_range(hit)[1]))]),
+                              axis=1)
+    low_bounds, high_bounds = find_event.calc_freq_ranges(on_table)
+    n_in_range = find_event.count_in_ranges(np.sort(off_table['Freq'].values), low_bounds, high_bounds)
+    assert n_in_range.tolist() == expected.tolist()
+
+def test_follow_events():
+    """ Batched event following must match follow_event for every hit """
+    import pandas as pd
+    rng = np.random.RandomState(6)
+    def hits(n):
+        return pd.DataFrame({'Freq': np.round(rng.uniform(8000, 8000.01, n), 6),
+                             'DriftRate': rng.choice([-0.3, 0., 0.5], n), 'DELTAF': '-2.793968',
+                             'DELTAT': '18.253611', 'delta_t': 600.})
+    first_on, on_table = hits(200), hits(300)
+
+    matches = find_event.follow_events(first_on, on_table)
+    for ii in range(len(first_on)):
+        expected = find_event.follow_event(first_on.iloc[ii], on_table, get_count=False)
+        assert on_table.iloc[matches[ii]].equals(expected)
+        assert find_event.follow_event(first_on.iloc[ii], on_table) == int(len(matches[ii]) > 0)
+
+def test_find_event_pipeline_jobs(tmpdir, monkeypatch):
+    """ Cadences searched in a process pool give the same table and .csv file as a serial run """
+    import shutil
+    from turbo_seti.find_event import find_event_pipeline
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=str(tmpdir)).search()
+
+    # find_event_pipeline takes the source name from the underscore-separated file name
+    monkeypatch.chdir(tmpdir)
+    dat_file_list = ['blc00_guppi_58000_1234_SRC_%04d.dat' % ii for ii in range(4)]
+    for filename_dat in dat_file_list:
+        shutil.copy('multi_coarse.dat', filename_dat)
+    with open('cadences.lst', 'w') as file_lst:
+        file_lst.write('\n'.join(dat_file_list) + '\n')
+
+    tables = []
+    for n_jobs in (1, 2):
+        tables.append(find_event_pipeline.find_event_pipeline('cadences.lst', filter_threshold=1, check_zero_drift=True,
+                                                              number_in_cadence=2, n_jobs=n_jobs))
+        os.rename('0002.dat_f1_snr10_zero.csv', 'jobs%d.csv' % n_jobs)
+    assert len(tables[0]) > 0
+    assert tables[1].equals(tables[0])
+    assert open('jobs2.csv').read() == open('jobs1.csv').read()
+
+def test_rfi_index(tmpdir):
+    """ The RFI index counts the other sources with hits in range, and only indexes new or changed files """
+    from turbo_seti.find_event import rfi_index
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    FindDoppler(filename_h5, max_drift=1.0, snr=10, out_dir=str(tmpdir)).search()
+    filename_dat = str(tmpdir.join('multi_coarse.dat'))
+    hits = find_event.make_table(filename_dat)
+    source = hits['Source'].iloc[0]
+
+    # The same hits, seen in two other sources
+    dat_file_list = [filename_dat]
+    for other in ('OTHER1', 'OTHER2'):
+        dat_file_list.append(str(tmpdir.join(other + '.dat')))
+        lines = open(filename_dat).readlines()
+        lines[3] = '# Source:%s\n' % other
+        with open(dat_file_list[-1], 'w') as file_dat:
+            file_dat.writelines(lines)
+
+    index_file = str(tmpdir.join('rfi.db'))
+    assert rfi_index.update_rfi_index(index_file, dat_file_list[:2]) == 2
+    assert rfi_index.update_rfi_index(index_file, dat_file_list) == 1
+    assert rfi_index.count_rfi_sources(index_file, hits, source).tolist() == [2] * len(hits)
+    assert rfi_index.count_rfi_sources(index_file, hits, 'OTHER1').tolist() == [2] * len(hits)
+
+    # A changed file replaces its previous hits
+    with open(dat_file_list[2], 'w') as file_dat:
+        file_dat.writelines(open(filename_dat).readlines()[:9])
+    assert rfi_index.update_rfi_index(index_file, dat_file_list) == 1
+    assert rfi_index.count_rfi_sources(index_file, hits, 'OTHER1').tolist() == [1] * len(hits)
+
+def test_read_window_panels(tmpdir, monkeypatch):
+    """ Windows cut from shared slice reads match separate reads of every window """
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+    file_info = plot_event.read_waterfall_header(filename_h5)
+    fch1, foff = 8421.386717353016, -2.7939677238464355e-06
+    windows = [tuple(np.sort((fch1 + foff * chan - 250e-6, fch1 + foff * chan + 250e-6)))
+               for chan in (20, 150, 700, 2000, 2250, 9000, 16380)]
+
+    reads = []
+    waterfall = bl.Waterfall
+    monkeypatch.setattr(plot_event.bl, 'Waterfall', lambda *args, **kwargs: reads.append(kwargs) or
+                        waterfall(*args, **kwargs))
+    for max_slice_channels in (2**20, 1000, 200):
+        reads.clear()
+        monkeypatch.setattr(plot_event, 'MAX_SLICE_CHANNELS', max_slice_channels)
+        panels = plot_event.read_window_panels(filename_h5, file_info, windows)
+        # Only windows no more than a window width apart share a slice
+        assert len(reads) == (5 if max_slice_channels >= 1000 else 7)
+        for panel, (f_start, f_stop) in zip(panels, windows):
+            assert panel['plot_data'].flags.owndata
+            expected = plot_event.read_waterfall_panel(filename_h5, f_start, f_stop)
+            assert np.array_equal(panel['plot_f'], expected['plot_f'])
+            assert np.array_equal(panel['plot_data'], expected['plot_data'])
+            assert np.array_equal(panel['timestamps'], expected['timestamps'])
+            assert panel['n_ints_in_file'] == expected['n_ints_in_file']
+
+def test_plot_candidate_events(tmpdir, monkeypatch):
+    """ Batched candidate plotting saves one plot per candidate """
+    import pandas as pd
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5, n_coarse_chan=1)
+    monkeypatch.chdir(tmpdir)
+    with open('cadence.lst', 'w') as file_lst:
+        file_lst.write('\n'.join([filename_h5] * 2) + '\n')
+    fch1, foff = 8421.386717353016, -2.7939677238464355e-06
+    candidates = pd.DataFrame({'Source': ['SYNTHETIC'] * 2, 'Freq': [fch1 + foff * 500, fch1 + foff * 2000],
+                               'DriftRate': [0.3, -0.25], 'FreqStart': [0., 0.]})
+
+    plot_event.plot_candidate_events(candidates, 'cadence.lst', 'test', 3, number_in_cadence=2, n_jobs=2)
+    assert len(tmpdir.listdir('*.png')) == 2
+
+def test_plot_candidate_events_cadences(tmpdir, monkeypatch):
+    """ Candidates are plotted with the cadence of their ON source only, not those where it is an OFF target """
+    import pandas as pd
+    n_ints = {'A': 16, 'B': 8}
+    filenames = {}
+    for source in n_ints:
+        filenames[source] = str(tmpdir.join('%s.h5' % source))
+        make_multi_coarse_h5(filenames[source], n_coarse_chan=1, n_ints=n_ints[source], source_name=source)
+    monkeypatch.chdir(tmpdir)
+    with open('cadences.lst', 'w') as file_lst:
+        file_lst.write('\n'.join([filenames['A'], filenames['B'], filenames['B'], filenames['A']]) + '\n')
+    fch1, foff = 8421.386717353016, -2.7939677238464355e-06
+    candidates = pd.DataFrame({'Source': ['A', 'B'], 'Freq': [fch1 + foff * 500, fch1 + foff * 2000],
+                               'DriftRate': [0.3, -0.25], 'FreqStart': [0., 0.]})
+
+    plotted = []
+    monkeypatch.setattr(plot_event, '_plot_candidate', lambda job: plotted.append((job[1][0][0],
+                                                                                 job[0][0]['n_ints_in_file'])))
+    plot_event.plot_candidate_events(candidates, 'cadences.lst', 'test', 3, number_in_cadence=2)
+    assert plotted == [('A', 16), ('B', 8)]
+
+def test_preview_pyramid(tmpdir):
+    """ Preview levels average adjacent channels, and wide windows are read from the coarsest level that is enough """
+    from turbo_seti.find_event import preview
+    filename_h5 = str(tmpdir.join('multi_coarse.h5'))
+    make_multi_coarse_h5(filename_h5)
+    data = bl.Waterfall(filename_h5).data
+    assert preview.make_preview_pyramid(filename_h5, factors=(2, 4, 16)) == str(tmpdir.join('multi_coarse.preview.h5'))
+
+    fch1, foff = 8421.386717353016, -2.7939677238464355e-06
+    f_start, f_stop = fch1 + foff * 16000, fch1 + foff * 100
+    freqs, level, header = preview.read_preview_level(filename_h5, f_start, f_stop, 900)
+    assert header['n_ints_in_file'] == 16
+    assert np.allclose(freqs[1] - freqs[0], foff * 16)
+    first_chan = int(round((freqs[0] - fch1) / foff - 7.5))
+    assert np.allclose(level[:, 0, 0], data[:, 0, first_chan:first_chan + 16].mean(axis=1))
+    finer_freqs = preview.read_preview_level(filename_h5, f_start, f_stop, 5000)[0]
+    assert np.allclose(finer_freqs[1] - finer_freqs[0], foff * 2)
+
+    panel = plot_event.read_waterfall_panel(filename_h5, f_start, f_stop, min_points=900)
+    assert panel['plot_data'].shape == (16, 995)
+    assert panel['plot_f'][0] >= f_start and panel['plot_f'][-1] <= f_stop
+    assert plot_event.read_waterfall_panel(filename_h5, f_start, f_stop)['plot_data'].shape == (16, 15900)
+
+    # An out of date preview is not used
+    os.utime(filename_h5, ns=(0, 0))
+    assert preview.read_preview_level(filename_h5, f_start, f_stop, 900) is None
+
 def test_plotting():
     """ Some basic plotting tests
 
@@ -3,12 +3,15 @@
 import os
 import numpy as np
 import math
-from pkg_resources import resource_filename
-from pkg_resources import resource_filename
+import time
+import threading
+import queue
 from blimpy import Waterfall
 from blimpy.io import sigproc
 import h5py
 
+from .helper_functions import drift_index_table
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -17,17 +20,58 @@ logger = logging.getLogger(__name__)
 #import pdb;# pdb.set_trace()
 
 SIZE_LIM = 256.0   # File size limit in MB. If larger then make a split mapping.
+DRIFT_INDEX_CACHE = os.environ.get('TURBOSETI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'turbo_seti'))
+
+_drift_index_tables = {}
+
+def load_drift_index_table(tsteps, cache_dir=DRIFT_INDEX_CACHE):
+    """
+    Returns the drift index table for tsteps time steps. Tables are generated once, kept in memory, and saved as
+    drift_indexes_array_%d.npy in cache_dir, from where later processes load them.
+    :param tsteps:      int,        number of time steps, a power of two
+    :param cache_dir:   string,     directory of the .npy tables, None to not use one
+    :return:            ndarray,    table of shape (tsteps/2, tsteps). See helper_functions.drift_index_table.
+    """
+    if tsteps in _drift_index_tables:
+        return _drift_index_tables[tsteps]
+
+    table = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'drift_indexes_array_%d.npy' % int(np.log2(tsteps)))
+        try:
+            table = np.load(cache_file)
+            if table.shape != (tsteps // 2, tsteps):
+                table = None
+        except (IOError, ValueError):
+            table = None
+
+    if table is None:
+        table = drift_index_table(tsteps)
+        if cache_dir:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                tmp_file = '%s.%d.tmp.npy' % (cache_file[:-4], os.getpid())
+                np.save(tmp_file, table)
+                os.replace(tmp_file, cache_file)
+            except (IOError, OSError):
+                logger.debug("Unable to save the drift index table to %s" % cache_dir)
+
+    _drift_index_tables[tsteps] = table
+    return table
 
 class DATAHandle:
     """
-    Class to setup input file for further processing of data. Handles conversion to h5 (from fil), extraction of
+    Class to setup input file for further processing of data (.h5, or .fil read in place). Handles extraction of
     coarse channel info, waterfall info, and file size checking.
     """
-    def __init__(self, filename=None, size_limit=SIZE_LIM, out_dir='./', n_coarse_chan=None, coarse_chans=None):
+    def __init__(self, filename=None, size_limit=SIZE_LIM, out_dir='./', n_coarse_chan=None, coarse_chans=None,
+                 dtype='float64'):
         """
         :param filename:        string,      name of file (.h5 or .fil)
         :param size_limit:      float,       maximum size in MB that the file is allowed to be
         :param out_dir:         string,      directory where output files should be saved
+        :param dtype:           string,      float type the spectra are loaded as ('float64' or 'float32')
         """
 
         if filename and os.path.isfile(filename):
@@ -35,20 +79,22 @@ class DATAHandle:
             self.out_dir = out_dir
             self.n_coarse_chan = n_coarse_chan
             self.coarse_chans = coarse_chans
+            self.dtype = dtype
 
-            if not h5py.is_hdf5(filename):
+            self.is_filterbank = not h5py.is_hdf5(filename)
+            if self.is_filterbank:
                 if not sigproc.is_filterbank(filename):
                     raise IOError('No correct format, need .h5. Try again...')
                 else:
-                    logger.info("File .fil detected. Attempting to create .h5 file in current directory...")
-                    try:
-                        self.__make_h5_file()
-                    except:
-                        raise IOError('Unable to create .h5 file. Please, try again with correct format.')
+                    # Filterbank files are memory-mapped by DATAH5.load_data, there is no .h5 copy to make.
+                    logger.info("File .fil detected. Reading it directly...")
 
             self.filestat = os.stat(filename)
             self.filesize = self.filestat.st_size/(1024.0**2)
 
+            # Read the header and shape of the file once, without its data, and share them with every DATAH5.
+            self.__read_header()
+
             # Make sure file is not larger than limit. If it is, we must split the file
             if self.filesize > size_limit:
                 logger.info("The file is of size %f MB, exceeding our size limit %f MB. Split needed..."%(self.filesize, size_limit))
@@ -56,9 +102,11 @@ class DATAHandle:
             else:
                 #EE This is here mainly for testing. Since need to keep in mind the band pass shape.
                 logger.debug("File size %f MB within range %f MB, okay..."%(self.filesize, size_limit))
-                data_obj = DATAH5(filename)
+                data_obj = DATAH5(filename, header=self.header, n_ints=self.n_ints_in_file, dtype=self.dtype,
+                                  is_filterbank=self.is_filterbank)
                 self.data_list = [data_obj]
 
+            del self.fil_file
             self.status = True
 
         else:
@@ -71,21 +119,23 @@ class DATAHandle:
         :return:    dict,    header of the blimpy file
         """
 
-        fil_file = Waterfall(self.filename,load_data=False)
-        return fil_file.header
+        return self.header
 
-    def __make_h5_file(self,):
+    def __read_header(self):
         """
-        Converts file to h5 format. Saves output in current dir. Sets the filename attribute of the calling DATAHandle
-        to the (new) filename.
+        Reads the header and shape of the file, without loading any data, and caches them on the DATAHandle. The
+        header-only Waterfall is kept as fil_file until the planning is done.
         :return: void
         """
+        try:
+            self.fil_file = Waterfall(self.filename, load_data=False)
+        except:
+            logger.error("Error encountered when trying to open file: %s"%self.filename)
+            raise IOError("Error encountered when trying to open file: %s"%self.filename)
 
-        fil_file = Waterfall(self.filename)
-        bn = os.path.basename(self.filename)
-        new_filename = os.path.join(self.out_dir, bn.replace('.fil', '.h5'))
-        fil_file.write_to_hdf5(new_filename)
-        self.filename = new_filename
+        self.header = self.fil_file.header
+        self.n_ints_in_file = self.fil_file.n_ints_in_file
+        self.n_channels_in_file = self.fil_file.n_channels_in_file
 
     def __split_h5(self, size_limit=SIZE_LIM):
         """
@@ -97,24 +147,17 @@ class DATAHandle:
 
         data_list = []
 
-        #Instancing file.
-        try:
-            fil_file = Waterfall(self.filename)
-        except:
-            logger.error("Error encountered when trying to open file: %s"%self.filename)
-            raise IOError("Error encountered when trying to open file: %s"%self.filename)
-
         #Finding lowest freq in file.
-        f_delt = fil_file.header['foff']
-        f0 = fil_file.header['fch1']
+        f_delt = self.header['foff']
+        f0 = self.header['fch1']
 
         #Looping over the number of coarse channels.
         if self.n_coarse_chan is not None:
             n_coarse_chan = self.n_coarse_chan
-        elif fil_file.header.get('n_coarse_chan', None) is not None:
-            n_coarse_chan = fil_file.header['n_coarse_chan']
+        elif self.header.get('n_coarse_chan', None) is not None:
+            n_coarse_chan = self.header['n_coarse_chan']
         else:
-            n_coarse_chan = int(fil_file.calc_n_coarse_chan())
+            n_coarse_chan = int(self.fil_file.calc_n_coarse_chan())
 
         # Only load coarse chans of interest -- or do all if not specified
         if self.coarse_chans in (None, ''):
@@ -123,13 +166,15 @@ class DATAHandle:
         for chan in self.coarse_chans:
 
             #Calculate freq range for given course channel.
-            f_start = f0 + chan*(f_delt)*fil_file.n_channels_in_file/n_coarse_chan
-            f_stop = f0 + (chan+1)*(f_delt)*fil_file.n_channels_in_file/n_coarse_chan
+            f_start = f0 + chan*(f_delt)*self.n_channels_in_file/n_coarse_chan
+            f_stop = f0 + (chan+1)*(f_delt)*self.n_channels_in_file/n_coarse_chan
 
             if f_start > f_stop:
                 f_start, f_stop = f_stop, f_start
 
-            data_obj = DATAH5(self.filename, f_start=f_start, f_stop=f_stop, coarse_chan=chan, tn_coarse_chan=n_coarse_chan)
+            data_obj = DATAH5(self.filename, f_start=f_start, f_stop=f_stop, coarse_chan=chan, tn_coarse_chan=n_coarse_chan,
+                              header=self.header, n_ints=self.n_ints_in_file, dtype=self.dtype,
+                              is_filterbank=self.is_filterbank)
 
 #----------------------------------------------------------------
 
@@ -138,13 +183,129 @@ class DATAHandle:
 
         return data_list
 
+class DATAPrefetch:
+    """
+    Loads the coarse channels of a data list on a background thread, so that the next coarse channel is read while
+    the current one is searched. The thread takes a slot of a semaphore of `depth` slots before loading a channel,
+    and each slot is given back when its channel is handed to the search: at most `depth` channels are loaded (or
+    being loaded) ahead of the one searched, so depth + 1 coarse channels are in memory at most. With depth 0 every
+    channel is loaded when it is asked for, without a thread.
+    Iterating yields (data_obj, (spectra, drift_indexes)) in data list order; io_wait holds the time spent waiting
+    for each of them, and load_time the time spent loading each of them. Both are appended when the channel is
+    yielded, so their last items are those of the channel just yielded, however far ahead the thread loads.
+    """
+    def __init__(self, data_list, depth=1):
+        """
+        :param data_list:   list[DATAH5],   coarse channels to load, in search order
+        :param depth:       int,            number of coarse channels loaded ahead of the search
+        """
+        self.data_list = data_list
+        self.depth = depth
+        self.io_wait = []
+        self.load_time = []
+        self.__stop = threading.Event()
+        self.__slots = None
+        self.__queue = None
+        self.__thread = None
+
+    def __iter__(self):
+        if self.depth < 1:
+            for data_obj in self.data_list:
+                t0 = time.time()
+                loaded = data_obj.load_data()
+                self.io_wait.append(time.time() - t0)
+                self.load_time.append(self.io_wait[-1])
+                yield data_obj, loaded
+            return
+
+        self.__slots = threading.Semaphore(self.depth)
+        self.__queue = queue.Queue(maxsize=self.depth)
+        self.__thread = threading.Thread(target=self.__load_all, name='DATAPrefetch')
+        self.__thread.daemon = True
+        self.__thread.start()
+        try:
+            for data_obj in self.data_list:
+                t0 = time.time()
+                loaded, error, load_time = self.__queue.get()
+                self.__slots.release()
+                self.io_wait.append(time.time() - t0)
+                self.load_time.append(load_time)
+                if error is not None:
+                    raise error
+                yield data_obj, loaded
+        finally:
+            self.close()
+
+    def __load_all(self):
+        """
+        Loader thread: loads the data list in order and queues the results, or the first error met, with the time
+        each load took.
+        """
+        for data_obj in self.data_list:
+            # Waits for the search to take a channel before loading one more.
+            while not self.__slots.acquire(timeout=0.1):
+                if self.__stop.is_set():
+                    return
+            t0 = time.time()
+            try:
+                item = (data_obj.load_data(), None, time.time() - t0)
+            except Exception as e:
+                item = (None, e, time.time() - t0)
+            while not self.__stop.is_set():
+                try:
+                    self.__queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.__stop.is_set() or item[1] is not None:
+                return
+
+    def close(self):
+        """
+        Stops the loader thread, e.g. when the search ends early. May be called multiple times.
+        """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+def blank_dc(data, n_coarse_chan, value_dtype=None):
+    """
+    Blanks the DC bin in the middle of every coarse channel, in place, by replacing it with the median of a few
+    channels next to it. Same as blimpy's Waterfall.blank_dc, for data that is not held by a Waterfall.
+    :param data:            ndarray     data, with frequency as its last axis
+    :param n_coarse_chan:   int         number of coarse channels in data
+    :param value_dtype:     dtype       data type of the file, when data was converted to another one on reading.
+                                        The medians are rounded to it, as if the file's data had been blanked.
+    :return: void
+    """
+    if n_coarse_chan < 1:
+        logger.warning('Coarse channel number < 1, unable to blank DC bin.')
+        return None
+
+    n_coarse_chan = int(n_coarse_chan)
+    n_chan_per_coarse = int(data.shape[-1] / n_coarse_chan)
+    mid_chan = int(n_chan_per_coarse / 2)
+
+    for ii in range(n_coarse_chan):
+        ss = ii*n_chan_per_coarse
+        w_slice = data[..., ss+mid_chan+5:ss+mid_chan+10]
+        # Nearing the end of the fine channel frequency array.
+        if w_slice.shape[-1] < 5:
+            break
+        median = np.median(w_slice)
+        if value_dtype is not None:
+            median = np.asarray(median).astype(value_dtype)
+        data[..., ss+mid_chan] = median
+
 class DATAH5:
     """
     This class is where the waterfall data is loaded, as well as the header info.
     It creates other attributes related to the dedoppler search (load_drift_indexes).
     """
 
-    def __init__(self, filename, size_limit = SIZE_LIM,f_start=None, f_stop=None,t_start=None, t_stop=None,coarse_chan=1,tn_coarse_chan=None):
+    def __init__(self, filename, size_limit = SIZE_LIM,f_start=None, f_stop=None,t_start=None, t_stop=None,coarse_chan=1,tn_coarse_chan=None,
+                 header=None, n_ints=None, dtype='float64', is_filterbank=None):
         """
         :param filename:        string      name of file
         :param size_limit:      float       maximum size in MB that the file is allowed to be
@@ -154,9 +315,17 @@ class DATAH5:
         :param t_stop:          int         stop integration ID
         :param coarse_chan:     int
         :param tn_coarse_chan:  int
+        :param header:          dict        blimpy header of the whole file, as read by DATAHandle. If given (with
+                                            n_ints), the file is only opened when the data are loaded.
+        :param n_ints:          int         number of integrations in the file
+        :param dtype:           string      float type the spectra are loaded as ('float64' or 'float32')
+        :param is_filterbank:   boolean     whether the file is a filterbank file, as found by DATAHandle. If None,
+                                            the file is checked.
         """
 
         self.filename = filename
+        self.is_filterbank = sigproc.is_filterbank(filename) if is_filterbank is None else is_filterbank
+        self.dtype = np.dtype(dtype)
         self.closed = False
         self.f_start = f_start
         self.f_stop = f_stop
@@ -164,21 +333,22 @@ class DATAH5:
         self.t_stop = t_stop
         self.tn_coarse_chan = tn_coarse_chan
 
-        #Instancing file.
-        try:
-            self.fil_file = Waterfall(filename,f_start=self.f_start, f_stop=self.f_stop,t_start=self.t_start, t_stop=self.t_stop,load_data=False)
-        except:
-            logger.error("Error encountered when trying to open file %s"%filename)
-            raise IOError("Error encountered when trying to open file %s"%filename)
+        #Instancing file, unless its header was already read.
+        if header is None or n_ints is None:
+            self.__open_file()
+            header = self.fil_file.header
+            n_ints = self.fil_file.n_ints_in_file
+        self.n_ints_in_file = n_ints
 
         #Getting header
+        file_header = header
         try:
             if self.tn_coarse_chan:
-                header = self.__make_data_header(self.fil_file.header,coarse=True)
+                header = self.__make_data_header(file_header,coarse=True)
             else:
-                header = self.__make_data_header(self.fil_file.header)
+                header = self.__make_data_header(file_header)
         except:
-            logger.debug('The fil_file.header is ' % self.fil_file.header)
+            logger.debug('The fil_file.header is %s' % file_header)
             raise IOError("Error accessing header from file: %s." % self.filename)
 
         self.header = header
@@ -201,51 +371,137 @@ class DATAH5:
         self.shoulder_size = 0
         self.tdwidth = self.fftlen + self.shoulder_size*self.tsteps
 
+    def __open_file(self):
+        """
+        Opens the Waterfall of the file (header only) for the selection of this object.
+        :return: void
+        """
+        try:
+            self.fil_file = Waterfall(self.filename,f_start=self.f_start, f_stop=self.f_stop,t_start=self.t_start, t_stop=self.t_stop,load_data=False)
+        except:
+            logger.error("Error encountered when trying to open file %s"%self.filename)
+            raise IOError("Error encountered when trying to open file %s"%self.filename)
+
+    def __getstate__(self):
+        """
+        Pickled copies (e.g. sent to a search worker process) leave out the open file, which load_data reopens.
+        """
+        state = self.__dict__.copy()
+        state.pop('fil_file', None)
+        return state
+
     def load_data(self,):
         """
-        Read the spectra and drift indices from file.
+        Read the spectra and drift indices from file. The spectra are returned with the dtype given at creation.
         :return:    ndarray, ndarray        spectra, drift indices
         """
-        self.fil_file.read_data(f_start=self.f_start, f_stop=self.f_stop)
+        if getattr(self, 'fil_file', None) is None:
+            self.__open_file()
 
         #Blanking DC bin.
         n_coarse_chan = int(self.fil_file.calc_n_coarse_chan())
         if n_coarse_chan != self.fil_file.calc_n_coarse_chan():
             logger.warning('The file/selection is not an integer number of coarse channels. This could have unexpected consequences. Let op!')
-        self.fil_file.blank_dc(n_coarse_chan)
 
-        spec = np.squeeze(self.fil_file.data)
-        spectra = np.array(spec, dtype=np.float64)
+        # The spectra are read straight into their final buffer, converted to self.dtype on the way. The rows past
+        # the end of the observation (when it is not a power of two long) stay zero.
+        n_ints, file_dtype = self.__selection_shape()
+        spectra = np.empty((self.tsteps, self.fftlen), dtype=self.dtype)
+        spectra[n_ints:] = 0
+        if self.is_filterbank:
+            self.__read_filterbank(spectra[:n_ints], file_dtype)
+        else:
+            self.__read_h5(spectra[:n_ints])
+        blank_dc(spectra[:n_ints], n_coarse_chan, value_dtype=file_dtype)
 
         # DCP APR 2020 -- COMMENTED OUT. THIS IS BREAKING STUFF IN CURRENT VERSION.
         #Arrange data in ascending order in freq if not already in that format.
         #if self.header['DELTAF'] < 0.0:
         #    spectra = spectra[:,::-1]
 
-        #This check will add rows of zeros if the obs is too short (and thus not a power of two rows).
-        if spectra.shape[0] != self.tsteps:
-            spectra = np.append(spectra, np.zeros((self.tsteps-spectra.shape[0], self.fftlen)), axis=0)
         self.tsteps_valid = self.tsteps
         self.obs_length = self.tsteps * self.header['DELTAT']
 
-        if spectra.shape != (self.tsteps_valid, self.fftlen):
+        drift_indexes = self.load_drift_indexes()
+
+        return spectra, drift_indexes
+
+    def __selection_chans(self):
+        """
+        :return:    int, int    first and last (excluded) channels of the selection of this object in the file
+        """
+        container = self.fil_file.container
+        header = self.fil_file.header
+        #Same channel borders as blimpy's reader (fch1 is the first channel for either sign of foff).
+        chan_start_idx = int(np.round((container.f_start - header['fch1']) / header['foff']))
+        chan_stop_idx = int(np.round((container.f_stop - header['fch1']) / header['foff']))
+        if chan_stop_idx < chan_start_idx:
+            chan_stop_idx, chan_start_idx = chan_start_idx, chan_stop_idx
+        return chan_start_idx, chan_stop_idx
+
+    def __selection_shape(self):
+        """
+        Checks that the selection of this object fits in the spectra.
+        :return:    int, dtype  number of integrations of the selection, and data type of the file
+        """
+        container = self.fil_file.container
+        header = self.fil_file.header
+        chan_start_idx, chan_stop_idx = self.__selection_chans()
+        n_ints = container.t_stop - container.t_start
+        if (header['nifs'] != 1 or chan_stop_idx - chan_start_idx != self.fftlen or n_ints > self.tsteps or
+                n_ints < 1):
             logger.error('Something is wrong with array size.')
             raise IOError('Something is wrong with array size.')
 
-        drift_indexes = self.load_drift_indexes()
+        if not self.is_filterbank:
+            return n_ints, container.h5['data'].dtype
+        n_bytes = int(header['nbits'] / 8)
+        if n_bytes == 4:
+            return n_ints, np.dtype('float32')
+        elif n_bytes == 2:
+            return n_ints, np.dtype('uint16')
+        elif n_bytes == 1:
+            return n_ints, np.dtype('uint8')
+        raise IOError('Unsupported number of bits in file %s: %s' % (self.filename, header['nbits']))
+
+    def __read_h5(self, spectra):
+        """
+        Reads the selection of this object from an HDF5 file into spectra, converting it to the type of spectra.
+        :param spectra:     ndarray     C-contiguous array of shape (n_ints, n_chans), filled in place
+        :return: void
+        """
+        container = self.fil_file.container
+        chan_start_idx, chan_stop_idx = self.__selection_chans()
+        container.h5['data'].read_direct(spectra.reshape((spectra.shape[0], 1, spectra.shape[1])),
+                                         np.s_[container.t_start:container.t_stop, :, chan_start_idx:chan_stop_idx])
 
-        return spectra, drift_indexes
+    def __read_filterbank(self, spectra, file_dtype):
+        """
+        Reads the selection of this object from a filterbank file into spectra, through a memory map of its data
+        block. Only the columns of the selection are read, and converted to the type of spectra.
+        :param spectra:     ndarray     array of shape (n_ints, n_chans), filled in place
+        :param file_dtype:  dtype       data type of the file
+        :return: void
+        """
+        container = self.fil_file.container
+        header = self.fil_file.header
+        file_shape = (self.fil_file.n_ints_in_file, header['nifs'], self.fil_file.n_channels_in_file)
+        file_data = np.memmap(self.filename, dtype=file_dtype, mode='r', offset=sigproc.len_header(self.filename),
+                              shape=file_shape)
+
+        chan_start_idx, chan_stop_idx = self.__selection_chans()
+        np.copyto(spectra, file_data[container.t_start:container.t_stop, 0, chan_start_idx:chan_stop_idx])
+        del file_data
 
     def load_drift_indexes(self):
         """
-        The drift indices are read from a stored file so that there is no need to recalculate. This speed things up.
+        The drift indices come from a table generated once per tsteps, then cached (see load_drift_index_table).
         :return:    ndarray     drift indices
         """
-        n = int(np.log2(self.tsteps))
-        di_array = np.genfromtxt(resource_filename('turbo_seti', 'drift_indexes/drift_indexes_array_%d.txt'%n), delimiter=' ', dtype=int)
+        di_array = load_drift_index_table(self.tsteps)
 
         ts2 = int(self.tsteps/2)
-        drift_indexes = di_array[(self.tsteps_valid - 1 - ts2), 0:self.tsteps_valid]
+        drift_indexes = np.array(di_array[(self.tsteps_valid - 1 - ts2), 0:self.tsteps_valid], dtype=int)
         return drift_indexes
 
     def __make_data_header(self,header,coarse=False):
@@ -269,14 +525,14 @@ class DATAH5:
         #used by helper_functions.py
         if coarse:
             base_header['NAXIS1'] = int(header['nchans']/self.tn_coarse_chan)
-            base_header['FCNTR'] = np.abs(self.f_stop - self.f_start)/2. + np.min(self.f_start, self.f_stop)
+            base_header['FCNTR'] = np.abs(self.f_stop - self.f_start)/2. + min(self.f_start, self.f_stop)
         else:
             base_header['NAXIS1'] = int(header['nchans'])
             base_header['FCNTR'] = float(header['fch1']) + header['foff'] * base_header['NAXIS1'] / 2
 
         #other header values.
         base_header['NAXIS'] = 2
-        base_header['NAXIS2'] = int(self.fil_file.n_ints_in_file)
+        base_header['NAXIS2'] = int(self.n_ints_in_file)
         return base_header
 
     def close(self):
@@ -285,8 +541,9 @@ class DATAH5:
         `close()` may be called multiple times without error.
         """
 
-        # Call file object destructor which should close the file
-        del self.fil_file
+        # Call file object destructor which should close the file. The file may never have been opened.
+        if getattr(self, 'fil_file', None) is not None:
+            del self.fil_file
 
         self.closed = True
 
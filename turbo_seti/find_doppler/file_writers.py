@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import numpy as np
+import h5py
 import astropy.io.fits as pyfits
 from .helper_functions import chan_freq
 
@@ -10,26 +11,41 @@ import logging
 def tophits_writer(spectra_slice, hit_indices, header, format='txt'):
     return None
 
+WRITE_BUFFER_SIZE = 256 * 1024   # Bytes buffered by a writer before they are flushed to its file.
+
+# Columns of the binary hit files (see HitWriter), in the order of the .dat columns.
+HIT_COLUMNS = [('TopHitNum', 'int64'), ('DriftRate', 'float64'), ('SNR', 'float64'), ('Freq', 'float64'),
+               ('CorrFreq', 'float64'), ('ChanIndx', 'int64'), ('FreqStart', 'float64'), ('FreqEnd', 'float64'),
+               ('SEFD', 'float64'), ('SEFD_freq', 'float64'), ('CoarseChanNum', 'int64'),
+               ('FullNumHitsInRange', 'int64')]
+
 class GeneralWriter:
     """
-    Wrapper class for file operations.
+    Wrapper class for file operations. The file is kept open, with a write buffer, until close() is called, so that
+    many small writes cost few system calls. It can be used as a context manager, which closes it.
     """
     def __init__(self, filename='', mode='a'):
         """
         Initializes GeneralWriter object. Opens given file with given mode, sets new object's filehandle to the file
-        object, sets the new object's filename to the file's name, then closes the file.
+        object and sets the new object's filename to the file's name.
         :param filename:    string,     name of file on which we would like to perform operations
         :param mode:        string,     mode which we want to use to open file, same modes as the built-in python
                                         built-in open function: r - read, a - append, w -write, x - create
         """
-        with open(filename, mode) as myfile:
-            self.filehandle = myfile
-            self.filename = filename
+        self.filename = filename
+        self.filehandle = open(filename, mode, buffering=WRITE_BUFFER_SIZE)
         return None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def close(self):
         """
-        Closes file object if it is open.
+        Flushes and closes file object if it is open.
         :return: void
         """
         if self.filehandle.closed:
@@ -37,23 +53,28 @@ class GeneralWriter:
         else:
             self.filehandle.close()
 
+    def flush(self):
+        """
+        Writes the buffered data to the file, if it is open.
+        :return: void
+        """
+        if not self.filehandle.closed:
+            self.filehandle.flush()
+
     def open(self, mode='a'):
         """
-        Opens the file with the inputted mode, then closes it. Does not actually leave the file opened, only used for
-        changing mode.
+        Opens the file with the inputted mode, closing it first if it is open with another mode.
         :param mode:    string,     mode which we want to assign to this file, same modes as the built-in python
                                     built-in open function: r - read, a - append, w -write, x - create
         :return: void
         """
         if self.filehandle.closed:
-            with open(self.filename, mode) as myfile:
-                self.filehandle = myfile
+            self.filehandle = open(self.filename, mode, buffering=WRITE_BUFFER_SIZE)
         elif self.filehandle.mode == mode:
             return
         else:
             self.close()
-            with open(self.filename, mode) as myfile:
-                self.filehandle = myfile
+            self.filehandle = open(self.filename, mode, buffering=WRITE_BUFFER_SIZE)
 
     def is_open(self):
         """
@@ -74,20 +95,16 @@ class GeneralWriter:
 
     def write(self, info_str, mode='a'):
         """
-        Sets file mode to a writeable mode and opens it if it is not already open in a writeable mode, writes info_str
-        to it, and then closes it. If the file was not previously open when this is called, the file is closed after
-        writing in order to maintain the state the filewriter was in before.
+        Writes info_str to the file's buffer. If the file is not open in a writeable mode, it is (re)opened with mode
+        first, and stays open.
         :param info_str:    string,     data to be written to file
         :param mode:        string,     mode for file. If it is not a writeable mode, it will be set to a writeable mode
         """
         if (not 'w' in mode) and (not 'a' in mode):
             mode = 'a'
         if not self.writable():
-            with open(self.filename, mode) as myfile:
-                myfile.write(info_str)
-                self.filehandle = myfile
-        else:
-            self.filehandle.write(info_str)
+            self.open(mode)
+        self.filehandle.write(info_str)
 
     def start_over(self):
         """
@@ -95,27 +112,52 @@ class GeneralWriter:
         don't have to actually write an empty string to it.
         """
         self.open('w')
-        self.write('')
         self.open('a')
 
 class FileWriter(GeneralWriter):
     """
     Used to write information to turboSETI output files.
     """
-    def __init__(self, filename, header):
+    def __init__(self, filename, header, hits_h5=False):
         """
         Initializes FileWriter object and writes its header.
         :param filename:    string,     name of file on which we would like to perform operations
         :param header:      dict,       information to be written to header of file filename
+        :param hits_h5:     boolean,    also write the top hits, with typed columns, to a .hits.h5 file next to
+                                        filename (see HitWriter)
         """
         GeneralWriter.__init__(self, filename)
+        file_id = filename.split('/')[-1].replace('.dat','')+'.h5'
         self.write('# -------------------------- o --------------------------\n')
-        self.write('# File ID: %s \n'%(filename.split('/')[-1].replace('.dat','')+'.h5'))
+        self.write('# File ID: %s \n'%file_id)
         self.write('# -------------------------- o --------------------------\n')
         self.report_header(header)
 
         self.tophit_count = 0
 
+        if hits_h5:
+            self.hit_writer = HitWriter(filename.replace('.dat', '') + '.hits.h5', header, file_id)
+        else:
+            self.hit_writer = None
+
+    def close(self):
+        """
+        Flushes and closes the file, and the .hits.h5 file if any.
+        :return: void
+        """
+        GeneralWriter.close(self)
+        if self.hit_writer is not None:
+            self.hit_writer.close()
+
+    def flush(self):
+        """
+        Writes the buffered data to the file, and to the .hits.h5 file if any.
+        :return: void
+        """
+        GeneralWriter.flush(self)
+        if self.hit_writer is not None:
+            self.hit_writer.flush()
+
     def report_coarse_channel(self, header,total_n_candi):
         """
         This function does nothing due to the first line, which returns before the rest of the code can run.
@@ -177,6 +219,41 @@ class FileWriter(GeneralWriter):
         :return: FileWriter object that called this function.
         """
 
+        self.report_tophits(max_val, [ind], [ind_tuple], tdwidth, fftlen, header, total_n_candi, obs_info=obs_info)
+
+        return self
+
+    def report_tophits(self, max_val, inds, ind_tuples, tdwidth, fftlen, header, total_n_candi, obs_info=None):
+        """
+        Same as report_tophit, for a batch of top hits written with a single write call.
+        :param max_val:         findopp.max_vals,
+        :param inds:            list(int),              indices at which top hits are located in max_val's maxdrift
+                                                        and maxsnr
+        :param ind_tuples:      list(tuple(int, int))   (lbound, ubound) of each top hit
+        :param tdwidth:         int,
+        :param fftlen:          int,                    length of the fast fourier transform matrix
+        :param header:          dict,                   contains info on coarse channel to be written to file
+        :param total_n_candi:   int,
+        :param obs_info:        dict,                   used to hold info found on file, including info about pulsars,
+                                                        RFI, and SEFD
+        :return: FileWriter object that called this function.
+        """
+
+        hits = [self.tophit_values(max_val, ind, ind_tuple, tdwidth, fftlen, header, total_n_candi, obs_info)
+                for ind, ind_tuple in zip(inds, ind_tuples)]
+        if hits:
+            self.write(''.join([self.tophit_str(hit) for hit in hits]))
+            if self.hit_writer is not None:
+                self.hit_writer.append(hits)
+
+        return self
+
+    def tophit_values(self, max_val, ind, ind_tuple, tdwidth, fftlen, header, total_n_candi, obs_info):
+        """
+        Numbers a top hit and computes the values of its .dat columns.
+        :return:    tuple,      values in the order of HIT_COLUMNS
+        """
+
         offset = int((tdwidth - fftlen)/2)
         tdwidth =  len(max_val.maxsnr)
 
@@ -193,22 +270,87 @@ class FileWriter(GeneralWriter):
         else:
             this_one = 0
 
-        info_str = '%03d\t'%(self.tophit_count)  #Top Hit number
-        info_str += '%10.6f\t'%max_val.maxdrift[ind]  #Drift Rate
-        info_str += '%10.6f\t'%max_val.maxsnr[ind]  #SNR
+        return (self.tophit_count, max_val.maxdrift[ind], max_val.maxsnr[ind], uncorr_freq, corr_freq, ind - offset,
+                freq_start, freq_end, obs_info['SEFDs_val'][this_one], obs_info['SEFDs_freq'][this_one],
+                header['coarse_chan'], total_n_candi)
+
+    def tophit_str(self, hit):
+        """
+        Formats the line of a top hit in the .dat file.
+        :param hit:     tuple,      values returned by tophit_values
+        :return:        string,     the line, ending with a newline
+        """
+        (tophit_count, drift_rate, snr, uncorr_freq, corr_freq, index, freq_start, freq_end, sefd, sefd_freq,
+         coarse_chan, total_n_candi) = hit
+
+        info_str = '%03d\t'%(tophit_count)  #Top Hit number
+        info_str += '%10.6f\t'%drift_rate  #Drift Rate
+        info_str += '%10.6f\t'%snr  #SNR
         info_str += '%14.6f\t'%uncorr_freq #Uncorrected Frequency:
         info_str += '%14.6f\t'%corr_freq #Corrected Frequency:
-        info_str += '%d\t'%(ind - offset) #Index:
+        info_str += '%d\t'%index #Index:
         info_str += '%14.6f\t'%freq_start #freq_start:
         info_str += '%14.6f\t'%freq_end #freq_end:
-        info_str += '%s\t'%obs_info['SEFDs_val'][this_one] #SEFD:
-        info_str += '%14.6f\t'%obs_info['SEFDs_freq'][this_one] #SEFD_mid_freq:
-        info_str += '%i\t'%header['coarse_chan']
+        info_str += '%s\t'%sefd #SEFD:
+        info_str += '%14.6f\t'%sefd_freq #SEFD_mid_freq:
+        info_str += '%i\t'%coarse_chan
         info_str += '%i\t'%total_n_candi #
         info_str +='\n'
-        self.write(info_str)
 
-        return self
+        return info_str
+
+class HitWriter:
+    """
+    Binary counterpart of the .dat file: the top hits are appended to resizable, typed HDF5 columns (HIT_COLUMNS),
+    and the .dat header fields are stored as attributes. Values are kept at full precision, without the rounding of
+    the text format. find_event.make_table reads these files directly.
+    """
+    def __init__(self, filename, header, file_id):
+        """
+        Creates the file, overwriting any previous one, with empty columns.
+        :param filename:    string,     name of the .hits.h5 file
+        :param header:      dict,       header of the observation, as given to FileWriter
+        :param file_id:     string,     File ID written in the .dat header
+        """
+        self.filename = filename
+        self.h5 = h5py.File(filename, 'w')
+        self.h5.attrs['FileID'] = file_id
+        self.h5.attrs['Source'] = str(header['SOURCE'])
+        self.h5.attrs['MJD'] = float(header['MJD'])
+        self.h5.attrs['RA'] = str(header['RA'])
+        self.h5.attrs['DEC'] = str(header['DEC'])
+        self.h5.attrs['DELTAT'] = float(header['DELTAT'])
+        self.h5.attrs['DELTAF'] = float(header['DELTAF'])*1e6  # Hz, as in the .dat header
+        for name, dtype in HIT_COLUMNS:
+            self.h5.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(4096,))
+
+    def append(self, hits):
+        """
+        Appends top hits to the columns.
+        :param hits:    list(tuple),    values of each hit, in the order of HIT_COLUMNS
+        :return: void
+        """
+        n_old = self.h5[HIT_COLUMNS[0][0]].shape[0]
+        for (name, dtype), values in zip(HIT_COLUMNS, zip(*hits)):
+            dset = self.h5[name]
+            dset.resize((n_old + len(hits),))
+            dset[n_old:] = np.array(values, dtype=dtype)
+
+    def flush(self):
+        """
+        Flushes the file, if it is open.
+        :return: void
+        """
+        if self.h5:
+            self.h5.flush()
+
+    def close(self):
+        """
+        Closes the file. May be called multiple times.
+        :return: void
+        """
+        if self.h5:
+            self.h5.close()
 
 class LogWriter(GeneralWriter):
     """
@@ -229,5 +371,68 @@ class LogWriter(GeneralWriter):
         self.write(info_str + '\n')
         return None
 
+class LogRecorder:
+    """
+    In-memory stand-in for LogWriter, used by the search workers. The parent process writes the recorded text to the
+    real log file, in coarse channel order.
+    """
+    def __init__(self):
+        self.info_strs = []
+
+    def info(self, info_str):
+        """
+        Records info_str, as LogWriter.info would write it.
+        :param info_str:    string,     to be written to file
+        :return: void
+        """
+        self.info_strs.append(info_str + '\n')
+        return None
+
+    def text(self):
+        """
+        :return:    string,     everything recorded so far
+        """
+        return ''.join(self.info_strs)
 
+class TopHitRecorder:
+    """
+    In-memory stand-in for FileWriter, used by the search workers. Only the values of the top hits are kept, so that
+    the parent process can replay them into the real FileWriter, which numbers the top hits across coarse channels.
+    """
+    def __init__(self):
+        self.batches = []
+        self.tophit_count = 0
+
+    def report_tophits(self, max_val, inds, ind_tuples, tdwidth, fftlen, header, total_n_candi, obs_info=None):
+        """
+        Records a batch of top hits. Same parameters as FileWriter.report_tophits.
+        :return: TopHitRecorder object that called this function.
+        """
+        inds = np.asarray(inds)
+        self.tophit_count += len(inds)
+        self.batches.append({'inds': inds, 'ind_tuples': list(ind_tuples), 'tdwidth': tdwidth,
+                             'n_chans': len(max_val.maxsnr), 'maxsnr': max_val.maxsnr[inds],
+                             'maxdrift': max_val.maxdrift[inds], 'fftlen': fftlen, 'header': header,
+                             'total_n_candi': total_n_candi, 'obs_info': obs_info})
+        return self
+
+    def replay(self, filewriter):
+        """
+        Writes the recorded top hits to filewriter, in the order they were recorded.
+        :param filewriter:  FileWriter,     file to which the top hits are written
+        :return: FileWriter object that was passed in.
+        """
+        for batch in self.batches:
+            max_val = _TopHitValues(batch['n_chans'], batch['inds'], batch['maxsnr'], batch['maxdrift'])
+            filewriter = filewriter.report_tophits(max_val, batch['inds'], batch['ind_tuples'], batch['tdwidth'],
+                                                   batch['fftlen'], batch['header'], batch['total_n_candi'],
+                                                   obs_info=batch['obs_info'])
+        return filewriter
 
+class _TopHitValues:
+    """Rebuilds the parts of findopp.max_vals that FileWriter.report_tophits reads."""
+    def __init__(self, n_chans, inds, maxsnr, maxdrift):
+        self.maxsnr = np.zeros(n_chans)
+        self.maxdrift = np.zeros(n_chans)
+        self.maxsnr[inds] = maxsnr
+        self.maxdrift[inds] = maxdrift
@@ -6,10 +6,12 @@ import sys
 import os
 import logging
 logger = logging.getLogger(__name__)
-import gc   #Garbage collector.
+import multiprocessing
 
-from .data_handler import DATAHandle
-from .file_writers import FileWriter, LogWriter
+import time
+from .data_handler import DATAHandle, DATAPrefetch
+from .file_writers import FileWriter, LogWriter, LogRecorder, TopHitRecorder
+from .stage_recorder import StageRecorder
 from .helper_functions import *
 
 #For importing cython code
@@ -40,14 +42,72 @@ class hist_vals:
         self.histdrift = None
         self.histid = None
 
+class SearchWorkspace:
+    """
+    Buffers of the search of one coarse channel: the dedoppler trees, the bit-reversed row index and the max_vals
+    arrays. Coarse channels of the same shape share a workspace, which reset() prepares in place for each of them,
+    instead of allocating (and garbage collecting) these buffers again for every channel.
+    """
+    def __init__(self, tsteps, tdwidth, dtype):
+        """
+        :param tsteps:      int,        number of time steps of the tree, a power of 2
+        :param tdwidth:     int,        width of the tree, in channels
+        :param dtype:       dtype,      data type of the trees
+        """
+        self.tsteps = tsteps
+        self.tdwidth = tdwidth
+        self.tree_findoppler = np.empty(tsteps * tdwidth, dtype=dtype)
+        # Negative drift rates are searched with taylor_flt_reverse, which sums the populated tree in the
+        # opposite channel direction in place. A second tree is only needed for drift_block 0, where both
+        # directions start from the same populated buffer.
+        self.__tree_findoppler_neg = None
+
+        # build index mask for in-place tree doppler correction
+        self.ibrev = np.zeros(tsteps, dtype=np.int32)
+        for i in range(0, tsteps):
+            self.ibrev[i] = bitrev(i, int(np.log2(tsteps)))
+
+##EE: should double check if tdwidth is really better than fftlen here.
+        self.max_val = max_vals()
+        self.max_val.maxsnr = np.zeros(tdwidth, dtype=np.float64)
+        self.max_val.maxdrift = np.zeros(tdwidth, dtype=np.float64)
+        self.max_val.maxsmooth = np.zeros(tdwidth, dtype='uint8')
+        self.max_val.maxid = np.zeros(tdwidth, dtype='uint32')
+        self.max_val.total_n_hits = 0
+
+    @property
+    def tree_findoppler_neg(self):
+        """
+        :return:    ndarray,    second tree, of the same shape as tree_findoppler, allocated on first use
+        """
+        if self.__tree_findoppler_neg is None:
+            self.__tree_findoppler_neg = np.empty_like(self.tree_findoppler)
+        return self.__tree_findoppler_neg
+
+    def reset(self, fill_value=0):
+        """
+        Prepares the workspace for the search of a new coarse channel.
+        :param fill_value:  float,      initial value of the tree (the median of the spectra when flagging)
+        :return:            SearchWorkspace,    this workspace
+        """
+        self.tree_findoppler.fill(fill_value)
+        self.max_val.maxsnr.fill(0)
+        self.max_val.maxdrift.fill(0)
+        self.max_val.maxsmooth.fill(0)
+        self.max_val.maxid.fill(0)
+        self.max_val.total_n_hits = 0
+        return self
+
 class FindDoppler:
     """ """
-    def __init__(self, datafile, max_drift, min_drift=0, snr=25.0, out_dir='./', coarse_chans=None, obs_info=None, flagging=None, n_coarse_chan=None):
+    def __init__(self, datafile, max_drift, min_drift=0, snr=25.0, out_dir='./', coarse_chans=None, obs_info=None, flagging=None, n_coarse_chan=None,
+                 n_threads=1, dtype='float64', n_workers=1, prefetch=1, hits_h5=False, stage_stats=True,
+                 stage_callback=None, tile_width=0):
         """
         Initializes FinDoppler object
         :param datafile:        string,     inputted filename (.h5 or .fil)
         :param max_drift:       float,      Max drift rate in Hz/second
-        :param min_drift:       int,        Min drift rate in Hz/second
+        :param min_drift:       int,        Min absolute drift rate in Hz/second, in both drift directions
         :param snr:             float,      Signal to Noise Ratio - A ratio bigger than 1 to 1 has more signal than
                                             noise
         :param out_dir:         string,     directory where output files should be placed. By default this is the
@@ -56,13 +116,39 @@ class FindDoppler:
         :param obs_info:        dict,       used to hold info found on file, including info about pulsars, RFI, and SEFD
         :param flagging:        boolean     flags the edges of the PFF for BL data (with 3Hz res per channel)
         :param n_coarse_chan:   int         number of coarse channels in file
+        :param n_threads:       int         number of OpenMP threads used by the taylor_flt kernel
+        :param dtype:           string      float type of the spectra and dedoppler trees, 'float64' (default) or
+                                            'float32'. float32 halves memory traffic; SNRs then agree with the
+                                            float64 path to about 1e-6 relative (see README).
+        :param n_workers:       int         number of processes searching coarse channels in parallel. The output
+                                            files are the same as with a single process.
+        :param prefetch:        int         number of coarse channels read ahead, on a background thread, while the
+                                            current one is searched. 0 reads each channel when it is searched.
+        :param hits_h5:         boolean     also write the top hits, with typed columns, to a .hits.h5 file next to
+                                            the .dat file. find_event.make_table reads either.
+        :param stage_stats:     boolean     write the time, bytes, hits and peak RSS of every search stage of every
+                                            coarse channel to a .stages.json file next to the .dat file.
+        :param stage_callback:  callable    called with the record of every search stage, as a dict (see
+                                            StageRecorder), as soon as its coarse channel is searched.
+        :param tile_width:      int         width, in channels, of the frequency tiles taylor_flt sums through all
+                                            its stages at once (see taylor_tree.taylor_flt). 0 (default) sums the
+                                            whole tree stage by stage. The trees are the same either way.
         """
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("dtype must be 'float32' or 'float64', not %s" % dtype)
+        if tile_width < 0:
+            raise ValueError("tile_width must not be negative, not %s" % tile_width)
+
         self.min_drift = min_drift
         self.max_drift = max_drift
         self.snr = snr
         self.out_dir = out_dir
 
-        self.data_handle = DATAHandle(datafile, out_dir=out_dir, n_coarse_chan=n_coarse_chan, coarse_chans=coarse_chans)
+        self.stages = StageRecorder(callback=stage_callback)
+        with self.stages.stage(None, 'plan'):
+            self.data_handle = DATAHandle(datafile, out_dir=out_dir, n_coarse_chan=n_coarse_chan,
+                                          coarse_chans=coarse_chans, dtype=dtype)
+        self.stages.finish()
         if (self.data_handle is None) or (self.data_handle.status is False):
             raise IOError("File error, aborting...")
 
@@ -87,6 +173,38 @@ class FindDoppler:
 
         self.status = True
         self.flagging = flagging
+        self.n_threads = n_threads
+        self.dtype = np.dtype(dtype)
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.hits_h5 = hits_h5
+        self.stage_stats = stage_stats
+        self.tile_width = tile_width
+        self.workspaces = {}
+
+    def __getstate__(self):
+        """
+        Pickled copies, sent to the search workers, leave out the open files and the stage records. Each worker
+        allocates its own workspaces.
+        """
+        state = self.__dict__.copy()
+        for key in ('data_handle', 'logwriter', 'filewriter', 'stages'):
+            state.pop(key, None)
+        state['workspaces'] = {}
+        return state
+
+    def workspace(self, tsteps, tdwidth, dtype):
+        """
+        Returns the workspace of the coarse channels of this shape, allocated by the first of them.
+        :param tsteps:      int,        number of time steps of the tree
+        :param tdwidth:     int,        width of the tree, in channels
+        :param dtype:       dtype,      data type of the spectra
+        :return:            SearchWorkspace,    not yet reset for the coarse channel
+        """
+        key = (tsteps, tdwidth, np.dtype(dtype))
+        if key not in self.workspaces:
+            self.workspaces[key] = SearchWorkspace(tsteps, tdwidth, dtype)
+        return self.workspaces[key]
 
     def get_info(self):
         """
@@ -102,28 +220,109 @@ class FindDoppler:
         logger.debug("Start searching...")
         logger.debug(self.get_info())
 
-        self.logwriter = LogWriter('%s/%s.log'%(self.out_dir.rstrip('/'),
-                                    self.data_handle.data_list[0].filename.split('/')[-1].replace('.h5','').replace('.fits','').replace('.fil','')))
-        self.filewriter = FileWriter('%s/%s.dat'%(self.out_dir.rstrip('/'),
-                                     self.data_handle.data_list[0].filename.split('/')[-1].replace('.h5','').replace('.fits','').replace('.fil','')),
-                                     self.data_handle.data_list[0].header)
+        # The records of a search start from the planning of the file, not from those of a previous search.
+        plan_records = [record for record in self.stages.records if record['stage'] == 'plan']
+        self.stages = StageRecorder(callback=self.stages.callback)
+        self.stages.records.extend(plan_records)
 
-        logger.info("Start ET search for %s"%self.data_handle.data_list[0].filename)
-        self.logwriter.info("Start ET search for %s"%(self.data_handle.data_list[0].filename))
+        basename = self.data_handle.data_list[0].filename.split('/')[-1].replace('.h5','').replace('.fits','').replace('.fil','')
+        with LogWriter('%s/%s.log'%(self.out_dir.rstrip('/'), basename)) as self.logwriter, \
+             FileWriter('%s/%s.dat'%(self.out_dir.rstrip('/'), basename), self.data_handle.data_list[0].header,
+                        hits_h5=self.hits_h5) as self.filewriter:
 
-        for ii,target_data_obj in enumerate(self.data_handle.data_list):
-            self.search_data(target_data_obj)
-            self.data_handle.data_list[ii].close()
-            gc.collect()
+            logger.info("Start ET search for %s"%self.data_handle.data_list[0].filename)
+            self.logwriter.info("Start ET search for %s"%(self.data_handle.data_list[0].filename))
+            self.output_size = 0
+            self.flush_writers()
 
-    def search_data(self, data_obj):
+            n_workers = min(self.n_workers, len(self.data_handle.data_list))
+            if n_workers > 1:
+                self.search_parallel(n_workers)
+            else:
+                self.search_serial()
+
+        if self.stage_stats:
+            self.stages.write_json('%s/%s.stages.json'%(self.out_dir.rstrip('/'), basename),
+                                   file=self.data_handle.data_list[0].filename, n_workers=n_workers,
+                                   n_threads=self.n_threads, prefetch=self.prefetch, dtype=self.dtype.name,
+                                   max_drift=self.max_drift, snr=self.snr, tile_width=self.tile_width)
+
+    def search_serial(self):
+        """
+        Searches the coarse channels one after the other, reading the next ones ahead (see DATAPrefetch).
+        """
+        loader = DATAPrefetch(self.data_handle.data_list, depth=self.prefetch)
+        compute_time = 0.
+        for target_data_obj, loaded in loader:
+            coarse_chan = target_data_obj.header['coarse_chan']
+            self.stages.add(coarse_chan, 'load_data', loader.load_time[-1], nbytes=loaded[0].nbytes)
+            self.stages.add(coarse_chan, 'io_wait', loader.io_wait[-1])
+            t0 = time.time()
+            self.search_data(target_data_obj, loaded=loaded)
+            compute_time += time.time() - t0
+            logger.info("Coarse channel %s: I/O wait %.2f s, search %.2f s"%(coarse_chan, loader.io_wait[-1],
+                                                                        time.time() - t0))
+            with self.stages.stage(coarse_chan, 'write') as record:
+                record['bytes'] += self.flush_writers()
+            self.stages.finish()
+            target_data_obj.close()
+        logger.info("Total I/O wait %.2f s, total search %.2f s (prefetch depth %d)"%(sum(loader.io_wait),
+                                                                                   compute_time, self.prefetch))
+
+    def search_parallel(self, n_workers):
+        """
+        Searches the coarse channels in a pool of n_workers processes. Each worker reads its own coarse channel.
+        The log lines and top hits of each channel are written by this process, in coarse channel order, so the
+        output files are the same as those of the serial search.
+        :param n_workers:   int,        number of worker processes
+        """
+        logger.info("Searching %d coarse channels with %d workers."%(len(self.data_handle.data_list), n_workers))
+        # Forked workers inherit the open writers: their buffers must be empty.
+        self.logwriter.flush()
+        self.filewriter.flush()
+        pool = multiprocessing.Pool(n_workers, initializer=_init_search_worker, initargs=(self,))
+        try:
+            results = pool.imap(_search_coarse_chan, self.data_handle.data_list)
+            for ii, (log_text, tophits, records) in enumerate(results):
+                self.stages.extend(records)
+                with self.stages.stage(self.data_handle.data_list[ii].header['coarse_chan'], 'write') as record:
+                    self.logwriter.write(log_text)
+                    self.filewriter = tophits.replay(self.filewriter)
+                    record['bytes'] += self.flush_writers()
+                self.stages.finish()
+                self.data_handle.data_list[ii].close()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def flush_writers(self):
+        """
+        Writes the buffered output of the log and .dat writers to their files.
+        :return:    int,    number of bytes the files grew by since the previous call
+        """
+        self.logwriter.flush()
+        self.filewriter.flush()
+        output_size = sum(os.path.getsize(writer.filename) for writer in (self.logwriter, self.filewriter))
+        written, self.output_size = output_size - self.output_size, output_size
+        return written
+
+    def search_data(self, data_obj, loaded=None):
         """
         Search the waterfall data of file.
         :param data_obj:    DATAH5,     file's waterfall data
+        :param loaded:      tuple,      (spectra, drift indices) already returned by data_obj.load_data(), if any
         """
-        logger.info("Start searching for coarse channel: %s"%data_obj.header['coarse_chan'])
-        self.logwriter.info("Start searching for %s ; coarse channel: %i "%(data_obj.filename,data_obj.header['coarse_chan']))
-        spectra, drift_indices = data_obj.load_data()
+        coarse_chan = data_obj.header['coarse_chan']
+        logger.info("Start searching for coarse channel: %s"%coarse_chan)
+        self.logwriter.info("Start searching for %s ; coarse channel: %i "%(data_obj.filename,coarse_chan))
+        if loaded is None:
+            with self.stages.stage(coarse_chan, 'load_data') as record:
+                loaded = data_obj.load_data()
+                record['bytes'] += loaded[0].nbytes
+        spectra, drift_indices = loaded
         tsteps = data_obj.tsteps
         tsteps_valid = data_obj.tsteps_valid
         tdwidth = data_obj.tdwidth
@@ -132,54 +331,32 @@ class FindDoppler:
         shoulder_size = data_obj.shoulder_size
 
         if self.flagging:
-            ##EE This flags the edges of the PFF for BL data (with 3Hz res per channel).
-            ##EE The PFF flat profile falls after around 100k channels.
-            ##EE But it falls slowly enough that could use 50-80k channels.
-            median_flag = np.median(spectra)
-#             spectra[:,:80000] = median_flag/float(tsteps)
-#             spectra[:,-80000:] = median_flag/float(tsteps)
-
-            ##EE Flagging spikes in time series.
-            time_series=spectra.sum(axis=1)
-            time_series_median = np.median(time_series)
-            mask=(time_series-time_series_median)/time_series.std() > 10   #Flagging spikes > 10 in SNR
-
-            if mask.any():
-                self.logwriter.info("Found spikes in the time series. Removing ...")
-                spectra[mask,:] = time_series_median/float(fftlen)  # So that the value is not the median in the time_series.
+            with self.stages.stage(coarse_chan, 'flagging', nbytes=spectra.nbytes):
+                ##EE This flags the edges of the PFF for BL data (with 3Hz res per channel).
+                ##EE The PFF flat profile falls after around 100k channels.
+                ##EE But it falls slowly enough that could use 50-80k channels.
+                median_flag = np.median(spectra)
+#                 spectra[:,:80000] = median_flag/float(tsteps)
+#                 spectra[:,-80000:] = median_flag/float(tsteps)
+
+                ##EE Flagging spikes in time series.
+                time_series=spectra.sum(axis=1)
+                time_series_median = np.median(time_series)
+                mask=(time_series-time_series_median)/time_series.std() > 10   #Flagging spikes > 10 in SNR
+
+                if mask.any():
+                    self.logwriter.info("Found spikes in the time series. Removing ...")
+                    spectra[mask,:] = time_series_median/float(fftlen)  # So that the value is not the median in the time_series.
 
         else:
-            median_flag = np.array([0])
-
-        # allocate array for findopplering
-        # init findopplering array to zero
-        tree_findoppler = np.zeros(tsteps * tdwidth,dtype=np.float64) + median_flag
+            median_flag = 0
 
-        # allocate array for holding original
-        # Allocates array in a fast way (without initialize)
-        tree_findoppler_original = np.empty_like(tree_findoppler)
-
-        # allocate array for negative doppler rates
-        tree_findoppler_flip = np.empty_like(tree_findoppler)
-
-        # build index mask for in-place tree doppler correction
-        ibrev = np.zeros(tsteps, dtype=np.int32)
-
-        for i in range(0, tsteps):
-            ibrev[i] = bitrev(i, int(np.log2(tsteps)))
-
-##EE: should double check if tdwidth is really better than fftlen here.
-        max_val = max_vals()
-        if max_val.maxsnr == None:
-            max_val.maxsnr = np.zeros(tdwidth, dtype=np.float64)
-        if max_val.maxdrift == None:
-            max_val.maxdrift = np.zeros(tdwidth, dtype=np.float64)
-        if max_val.maxsmooth == None:
-            max_val.maxsmooth = np.zeros(tdwidth, dtype='uint8')
-        if max_val.maxid == None:
-            max_val.maxid = np.zeros(tdwidth, dtype='uint32')
-        if max_val.total_n_hits == None:
-            max_val.total_n_hits = 0
+        # The trees, row index and max values are shared by the coarse channels of this shape: the tree is
+        # initialised with median_flag and the max values are zeroed in place.
+        workspace = self.workspace(tsteps, tdwidth, spectra.dtype).reset(median_flag)
+        tree_findoppler = workspace.tree_findoppler
+        ibrev = workspace.ibrev
+        max_val = workspace.max_val
 
         #EE: Making "shoulders" to avoid "edge effects". Could do further testing.
         specstart = int(tsteps*shoulder_size/2)
@@ -187,122 +364,156 @@ class FindDoppler:
 
         #--------------------------------
         #Stats calc
-        self.the_mean_val, self.the_stddev = comp_stats(spectra.sum(axis=0))
+        with self.stages.stage(coarse_chan, 'comp_stats', nbytes=spectra.nbytes):
+            self.the_mean_val, self.the_stddev = comp_stats(spectra.sum(axis=0))
 
         #--------------------------------
         #Looping over drift_rate_nblock
         #--------------------------------
         drift_rate_nblock = int(np.floor(self.max_drift / (data_obj.drift_rate_resolution*tsteps_valid)))
+        drift_plan = plan_drift_blocks(drift_rate_nblock, tsteps_valid, data_obj.drift_rate_resolution,
+                                       self.min_drift, self.max_drift)
+        n_trees = sum((negative is not None) + (positive is not None) for _, negative, positive in drift_plan)
+        logger.info("Drift blocks: computing %d of %d trees, %d skipped outside the drift rate range."%(
+            n_trees, 2*drift_rate_nblock + 2, 2*drift_rate_nblock + 2 - n_trees))
 
 ##EE-debuging        kk = 0
 
-        for drift_block in range(-1*drift_rate_nblock,drift_rate_nblock+1):
+        for drift_block, negative, positive in drift_plan:
             logger.debug( "Drift_block %i"%drift_block)
 
+            #Populates the find_doppler tree with the spectra, once for both drift directions of this block.
+            with self.stages.stage(coarse_chan, 'populate_tree', nbytes=tree_findoppler.nbytes):
+                populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder_size,roll=drift_block,reverse=1,
+                              n_threads=self.n_threads)
+
             #----------------------------------------------------------------------
             # Negative drift rates search.
             #----------------------------------------------------------------------
-            if drift_block <= 0:
-
-                #Populates the find_doppler tree with the spectra
-                populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder_size,roll=drift_block,reverse=1)
-
-                # populate original array
-                np.copyto(tree_findoppler_original, tree_findoppler)
+            if negative is not None:
+
+                if positive is not None:
+                    # The positive search below still needs the populated tree.
+                    tree_findoppler_neg = workspace.tree_findoppler_neg
+                    with self.stages.stage(coarse_chan, 'populate_tree', nbytes=tree_findoppler.nbytes):
+                        np.copyto(tree_findoppler_neg, tree_findoppler)
+                    tree_findoppler_flip = tree_findoppler_neg
+                else:
+                    tree_findoppler_flip = tree_findoppler
 
-                # populate neg doppler array
-                np.copyto(tree_findoppler_flip, tree_findoppler_original)
-                
-                # Flip matrix across X dimension to search negative doppler drift rates
-                FlipX(tree_findoppler_flip, tdwidth, tsteps)
+                # Sum in the reverse channel direction to search negative doppler drift rates
                 logger.info("Doppler correcting reverse...")
-                tt.taylor_flt(tree_findoppler_flip, tsteps * tdwidth, tsteps)
+                with self.stages.stage(coarse_chan, 'taylor_flt', nbytes=tree_findoppler_flip.nbytes):
+                    tt.taylor_flt_reverse(tree_findoppler_flip, tsteps * tdwidth, tsteps, self.n_threads,
+                                          self.tile_width)
                 logger.debug( "done...")
                 
-                complete_drift_range = data_obj.drift_rate_resolution*np.array(range(-1*tsteps_valid*(np.abs(drift_block)+1)+1,-1*tsteps_valid*(np.abs(drift_block))+1))
-                for k,drift_rate in enumerate(complete_drift_range[(complete_drift_range<self.min_drift) & (complete_drift_range>=-1*self.max_drift)]):
-                    # indx  = ibrev[drift_indices[::-1][k]] * tdwidth
-
-                    # DCP 2020.04 -- WAR to drift rate in flipped files
-                    if data_obj.header['DELTAF'] < 0:
-                        drift_rate *= -1
-
-                    indx  = ibrev[drift_indices[::-1][(complete_drift_range<self.min_drift) & (complete_drift_range>=-1*self.max_drift)][k]] * tdwidth
-
-                    # SEARCH NEGATIVE DRIFT RATES
-                    spectrum = tree_findoppler_flip[indx: indx + tdwidth]
-
-                    # normalize
-                    spectrum -= self.the_mean_val
-                    spectrum /= self.the_stddev
-
-                    #Reverse spectrum back
-                    spectrum = spectrum[::-1]
-
-                    n_hits, max_val = hitsearch(spectrum, specstart, specend, self.snr, drift_rate, data_obj.header, fftlen, tdwidth, max_val, 0)
-                    info_str = "Found %d hits at drift rate %15.15f\n"%(n_hits, drift_rate)
-                    max_val.total_n_hits += n_hits
-                    logger.debug(info_str)
-                    self.logwriter.info(info_str)
+                complete_drift_range, in_range = negative
+                drift_rates = complete_drift_range[in_range]
+
+                # DCP 2020.04 -- WAR to drift rate in flipped files
+                if data_obj.header['DELTAF'] < 0:
+                    drift_rates = drift_rates * -1
+
+                # SEARCH NEGATIVE DRIFT RATES
+                tree_rows = ibrev[drift_indices[::-1][in_range]]
+                with self.stages.stage(coarse_chan, 'hitsearch', nbytes=tree_findoppler_flip.nbytes) as record:
+                    n_hits, max_val = hitsearch_block(tree_findoppler_flip, tree_rows, drift_rates, self.the_mean_val,
+                                                      self.the_stddev, specstart, specend, self.snr, data_obj.header,
+                                                      tdwidth, max_val)
+                    self.report_n_hits(n_hits, drift_rates, max_val)
+                    record['hits'] += int(np.sum(n_hits))
 
             #----------------------------------------------------------------------
             # Positive drift rates search.
             #----------------------------------------------------------------------
-            if drift_block >= 0:
-
-                #Populates the find_doppler tree with the spectra
-                populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder_size,
-                              roll=drift_block,reverse=1)
-
-                # populate original array
-                np.copyto(tree_findoppler_original, tree_findoppler)
+            if positive is not None:
 
                 logger.info("Doppler correcting forward...")
-                tt.taylor_flt(tree_findoppler, tsteps * tdwidth, tsteps)
+                with self.stages.stage(coarse_chan, 'taylor_flt', nbytes=tree_findoppler.nbytes):
+                    tt.taylor_flt(tree_findoppler, tsteps * tdwidth, tsteps, self.n_threads, self.tile_width)
                 logger.debug( "done...")
-                if (tree_findoppler == tree_findoppler_original).all():
-                     logger.error("taylor_flt has no effect?")
-                else:
-                     logger.debug("tree_findoppler changed")
 
-                ##EE: Calculates the range of drift rates for a full drift block.
-                complete_drift_range = data_obj.drift_rate_resolution*np.array(range(tsteps_valid*(drift_block),tsteps_valid*(drift_block +1)))
+                complete_drift_range, in_range = positive
+                drift_rates = complete_drift_range[in_range]
 
-                for k,drift_rate in enumerate(complete_drift_range[(complete_drift_range>=self.min_drift) & (complete_drift_range<=self.max_drift)]):
+                #DCP 2020.04 -- WAR to drift rate in flipped files
+                if data_obj.header['DELTAF'] < 0:
+                    drift_rates = drift_rates * -1
 
-                    indx  = ibrev[drift_indices[k]] * tdwidth
-
-                    #DCP 2020.04 -- WAR to drift rate in flipped files
-                    if data_obj.header['DELTAF'] < 0:
-                        drift_rate *= -1
-
-                    # SEARCH POSITIVE DRIFT RATES
-                    spectrum = tree_findoppler[indx: indx+tdwidth]
-
-                    # normalize
-                    spectrum -= self.the_mean_val
-                    spectrum /= self.the_stddev
-
-                    n_hits, max_val = hitsearch(spectrum, specstart, specend, self.snr, drift_rate, data_obj.header, fftlen, tdwidth, max_val, 0)
-                    info_str = "Found %d hits at drift rate %15.15f\n"%(n_hits, drift_rate)
-                    max_val.total_n_hits += n_hits
-                    logger.debug(info_str)
-                    self.logwriter.info(info_str)
+                # SEARCH POSITIVE DRIFT RATES
+                tree_rows = ibrev[drift_indices[in_range]]
+                with self.stages.stage(coarse_chan, 'hitsearch', nbytes=tree_findoppler.nbytes) as record:
+                    n_hits, max_val = hitsearch_block(tree_findoppler, tree_rows, drift_rates, self.the_mean_val,
+                                                      self.the_stddev, specstart, specend, self.snr, data_obj.header,
+                                                      tdwidth, max_val)
+                    self.report_n_hits(n_hits, drift_rates, max_val)
+                    record['hits'] += int(np.sum(n_hits))
 
         # Writing the top hits to file.
-        self.filewriter = tophitsearch(tree_findoppler_original, max_val, tsteps, nframes, data_obj.header, tdwidth,
-                                       fftlen, self.max_drift,data_obj.obs_length, out_dir = self.out_dir,
-                                       logwriter=self.logwriter, filewriter=self.filewriter, obs_info=self.obs_info)
+        with self.stages.stage(coarse_chan, 'tophitsearch', nbytes=max_val.maxsnr.nbytes) as record:
+            n_tophits = self.filewriter.tophit_count
+            self.filewriter = tophitsearch(tree_findoppler, max_val, tsteps, nframes, data_obj.header, tdwidth,
+                                           fftlen, self.max_drift,data_obj.obs_length, out_dir = self.out_dir,
+                                           logwriter=self.logwriter, filewriter=self.filewriter, obs_info=self.obs_info)
+            record['hits'] += self.filewriter.tophit_count - n_tophits
 
         logger.info("Total number of candidates for coarse channel "+ str(data_obj.header['coarse_chan']) +" is: %i"%max_val.total_n_hits)
 
+    def report_n_hits(self, n_hits, drift_rates, max_val):
+        """
+        Logs the number of hits found at each drift rate of a drift block and adds them to the total.
+        :param n_hits:          ndarray(int),   number of hits at each drift rate
+        :param drift_rates:     ndarray,        drift rates searched, in search order
+        :param max_val:         max_vals,       its total_n_hits is updated
+        """
+        for n, drift_rate in zip(n_hits, drift_rates):
+            info_str = "Found %d hits at drift rate %15.15f\n"%(n, drift_rate)
+            max_val.total_n_hits += n
+            logger.debug(info_str)
+            self.logwriter.info(info_str)
+
 #  ======================================================================  #
 
-def populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder_size,roll=0,reverse=0):
+def plan_drift_blocks(drift_rate_nblock, tsteps_valid, drift_rate_resolution, min_drift, max_drift):
+    """
+    Plans the trees of a search: each drift block holds tsteps_valid drift rates in either direction, and a tree is
+    only computed for the directions of the blocks that have drift rates in the searched range: drift rates whose
+    absolute value is between min_drift and max_drift. A drift rate of 0 is searched in the positive direction.
+    :param drift_rate_nblock:       int,        number of drift blocks on each side of block 0
+    :param tsteps_valid:            int,        number of drift rates of a block in one direction
+    :param drift_rate_resolution:   float,      drift rate step, in Hz/s
+    :param min_drift:               float,      min absolute drift rate, in Hz/s
+    :param max_drift:               float,      max drift rate, in Hz/s
+    :return:                        list,       (drift_block, negative, positive) for every block with a tree to
+                                                compute, in search order. negative and positive are the
+                                                (complete_drift_range, in_range) of the block in that direction,
+                                                or None when no drift rate of that direction is in range.
+    """
+    plan = []
+    for drift_block in range(-1*drift_rate_nblock,drift_rate_nblock+1):
+        negative = positive = None
+        if drift_block <= 0:
+            complete_drift_range = drift_rate_resolution*np.array(range(-1*tsteps_valid*(np.abs(drift_block)+1)+1,-1*tsteps_valid*(np.abs(drift_block))+1))
+            in_range = (complete_drift_range<0) & (complete_drift_range<=-1*min_drift) & (complete_drift_range>=-1*max_drift)
+            if in_range.any():
+                negative = (complete_drift_range, in_range)
+        if drift_block >= 0:
+            ##EE: Calculates the range of drift rates for a full drift block.
+            complete_drift_range = drift_rate_resolution*np.array(range(tsteps_valid*(drift_block),tsteps_valid*(drift_block +1)))
+            in_range = (complete_drift_range>=min_drift) & (complete_drift_range<=max_drift)
+            if in_range.any():
+                positive = (complete_drift_range, in_range)
+        if negative is not None or positive is not None:
+            plan.append((drift_block, negative, positive))
+    return plan
+
+def populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder_size,roll=0,reverse=0,n_threads=1):
     """
     This script populates the findoppler tree with the spectra.
     It creates two "shoulders" (each region of tsteps*(shoulder_size/2) in size) to avoid "edge" issues.
-    It uses np.roll() for drift-rate blocks higher than 1.
+    Row i gets spectra[i] rolled by roll*i channels, as np.roll() would, for drift-rate blocks higher than 1. The shifts
+    of the rows are computed once, and the rows and their shoulders are copied in one pass by taylor_tree.populate_rows.
     :param spectra:             ndarray,        spectra calculated from file
     :param tree_findoppler:     ndarray,        tree to be populated with spectra
     :param nframes:             int,
@@ -312,6 +523,7 @@ def populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder
     :param shoulder_size:       int,            size of shoulder region
     :param roll:                int,            used to calculate amount each entry to the spectra should be rolled (shifted)
     :param reverse:             int(boolean),   used to determine which way spectra should be rolled (shifted)
+    :param n_threads:           int,            number of threads copying the rows
     :return:                    ndarray,        spectra-populated version of the input tree_findoppler
     """
 
@@ -320,18 +532,10 @@ def populate_tree(spectra,tree_findoppler,nframes,tdwidth,tsteps,fftlen,shoulder
     else:
         direction = 1
 
-    for i in range(0, nframes):
-        sind = tdwidth*i + tsteps*int(shoulder_size/2)
-        cplen = fftlen
-
-        ##EE copy spectra into tree_findoppler, leaving two regions in each side blanck (each region of tsteps*(shoulder_size/2) in size).
-        # Copy spectra into tree_findoppler, with rolling.
-        np.copyto(tree_findoppler[sind: sind + cplen], np.roll(spectra[i],roll*i*direction))
-
-#         ##EE loads the end part of the current spectrum into the left hand side black region in tree_findoppler (comment below says "next spectra" but for that need i+1...bug?)
-         #load end of current spectra into left hand side of next spectra
-        sind = i * tdwidth
-        np.copyto(tree_findoppler[sind: sind + tsteps*int(shoulder_size/2)], spectra[i, fftlen-(tsteps*int(shoulder_size/2)):fftlen])
+    shifts = (roll * direction * np.arange(nframes, dtype=np.intp)) % fftlen
+    ##EE copy spectra into tree_findoppler, leaving two regions in each side blanck (each region of tsteps*(shoulder_size/2) in size).
+    ##EE the end part of the current spectrum goes into the left hand side region of its own row.
+    tt.populate_rows(spectra, tree_findoppler, shifts, tdwidth, tsteps*int(shoulder_size/2), n_threads)
 
     return tree_findoppler
 
@@ -354,14 +558,16 @@ def hitsearch(spectrum, specstart, specend, hitthresh, drift_rate, header, fftle
     """
 
     logger.debug('Start searching for hits at drift rate: %f'%drift_rate)
+    debug = logger.isEnabledFor(logging.DEBUG)
     j = 0
     for i in (spectrum[specstart:specend] > hitthresh).nonzero()[0] + specstart:
         k =  (tdwidth - 1 - i) if reverse else i
-        info_str = 'Hit found at SNR %f! %s\t'%(spectrum[i], '(reverse)' if reverse else '')
-        info_str += 'Spectrum index: %d, Drift rate: %f\t'%(i, drift_rate)
-        info_str += 'Uncorrected frequency: %f\t'%chan_freq(header,  k, tdwidth, 0)
-        info_str += 'Corrected frequency: %f'%chan_freq(header, k, tdwidth, 1)
-        logger.debug(info_str)
+        if debug:
+            info_str = 'Hit found at SNR %f! %s\t'%(spectrum[i], '(reverse)' if reverse else '')
+            info_str += 'Spectrum index: %d, Drift rate: %f\t'%(i, drift_rate)
+            info_str += 'Uncorrected frequency: %f\t'%chan_freq(header,  k, tdwidth, 0)
+            info_str += 'Corrected frequency: %f'%chan_freq(header, k, tdwidth, 1)
+            logger.debug(info_str)
         j += 1
         used_id = j
         if spectrum[i] > max_val.maxsnr[k]:
@@ -371,10 +577,105 @@ def hitsearch(spectrum, specstart, specend, hitthresh, drift_rate, header, fftle
 
     return j, max_val
 
+_worker_finder = None
+
+def _init_search_worker(finder):
+    """
+    Pool initializer: keeps the worker's copy of the FindDoppler object.
+    :param finder:      FindDoppler,    pickled without its data handle and writers
+    """
+    global _worker_finder
+    _worker_finder = finder
+
+def _search_coarse_chan(data_obj):
+    """
+    Searches one coarse channel in a worker process, recording the log lines and top hits instead of writing them.
+    :param data_obj:    DATAH5,     coarse channel to search
+    :return:            string, TopHitRecorder, list    log text, top hits and stage records of the coarse channel
+    """
+    finder = _worker_finder
+    finder.logwriter = LogRecorder()
+    finder.filewriter = TopHitRecorder()
+    finder.stages = StageRecorder()
+    finder.search_data(data_obj)
+    data_obj.close()
+    return finder.logwriter.text(), finder.filewriter, finder.stages.finish()
+
+def hitsearch_block(tree_findoppler, tree_rows, drift_rates, the_mean_val, the_stddev, specstart, specend, hitthresh,
+                    header, tdwidth, max_val):
+    """
+    Searches for hits at all the drift rates of a dedoppler tree at once. It gives the same max_val and hit counts
+    as calling hitsearch once per drift rate, in the order of drift_rates: a channel keeps the first drift rate at
+    which it reached its highest SNR.
+    :param tree_findoppler: ndarray,            dedoppler tree of shape (tsteps * tdwidth), normalized in place
+    :param tree_rows:       ndarray(int),       tree row holding each drift rate
+    :param drift_rates:     ndarray,            drift rates to search, in search order
+    :param the_mean_val:    float,              mean used to normalize the spectra
+    :param the_stddev:      float,              standard deviation used to normalize the spectra
+    :param specstart:       int,                first index to search for hit in spectrum
+    :param specend:         int,                last index to search for hit in spectrum
+    :param hitthresh:       float,              signal to noise ratio used as threshold for determining hits
+    :param header:          dict,               header in fits header format. Only used for debug output
+    :param tdwidth:         int,
+    :param max_val:         max_vals,           object to be filled with max values from this search and then returned
+    :return:                ndarray(int), max_vals,     number of hits at each drift rate, and max_val.
+    """
+    tree = tree_findoppler.reshape((-1, tdwidth))
+    tree_rows = np.asarray(tree_rows)
+
+    # normalize every searched row at once
+    if np.array_equal(np.sort(tree_rows), np.arange(tree.shape[0])):
+        tree -= the_mean_val
+        tree /= the_stddev
+        block = tree[:, specstart:specend]
+        block_rows = tree_rows
+    else:
+        for row in np.unique(tree_rows):
+            tree[row] -= the_mean_val
+            tree[row] /= the_stddev
+        block = tree[tree_rows, specstart:specend]
+        block_rows = np.arange(len(tree_rows))
+
+    hits = block > hitthresh
+    n_hits = np.count_nonzero(hits, axis=1)[block_rows]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for drift_rate, row in zip(drift_rates, block_rows):
+            logger.debug('Start searching for hits at drift rate: %f'%drift_rate)
+            for i in hits[row].nonzero()[0] + specstart:
+                info_str = 'Hit found at SNR %f! %s\t'%(block[row, i - specstart], '')
+                info_str += 'Spectrum index: %d, Drift rate: %f\t'%(i, drift_rate)
+                info_str += 'Uncorrected frequency: %f\t'%chan_freq(header, i, tdwidth, 0)
+                info_str += 'Corrected frequency: %f'%chan_freq(header, i, tdwidth, 1)
+                logger.debug(info_str)
+
+    if len(block_rows) == 0:
+        return n_hits, max_val
+
+    # Best SNR of each channel over all drift rates, then the first drift rate (in search order) reaching it.
+    best_snr = np.fmax.reduce(block, axis=0)
+    chans = ((best_snr > hitthresh) & (best_snr > max_val.maxsnr[specstart:specend])).nonzero()[0]
+    if len(chans):
+        chan_snr = best_snr[chans]
+        first = np.argmax(block[np.ix_(block_rows, chans)] == chan_snr, axis=0)
+        best_rows = block_rows[first]
+
+        # maxid is the rank of the channel among the hits of its drift rate, as counted by hitsearch.
+        hit_ids = np.empty(len(chans), dtype=max_val.maxid.dtype)
+        for row in np.unique(best_rows):
+            in_row = best_rows == row
+            hit_ids[in_row] = np.searchsorted(hits[row].nonzero()[0], chans[in_row], side='right')
+
+        max_val.maxsnr[chans + specstart] = chan_snr
+        max_val.maxdrift[chans + specstart] = drift_rates[first]
+        max_val.maxid[chans + specstart] = hit_ids
+
+    return n_hits, max_val
+
 def tophitsearch(tree_findoppler_original, max_val, tsteps, nframes, header, tdwidth, fftlen,max_drift,obs_length, out_dir='', logwriter=None, filewriter=None,obs_info=None):
     """
     This finds the hits with largest SNR within 2*tsteps frequency channels.
-    :param tree_findoppler_original:        ndarray,        spectra-populated findoppler tree
+    :param tree_findoppler_original:        ndarray,        findoppler tree, only used for its shape in debug output
     :param max_val:                         max_vals,       contains max values from hitsearch
     :param tsteps:                          int,
     :param nframes:                         int,            UNUSED
@@ -397,30 +698,42 @@ def tophitsearch(tree_findoppler_original, max_val, tsteps, nframes, header, tdw
     tree_orig = tree_findoppler_original.reshape((tsteps, tdwidth))
     logger.debug("tree_orig shape: %s"%str(tree_orig.shape))
 
-    for i in (maxsnr > 0).nonzero()[0]:
-        lbound = int(max(0, i - obs_length*max_drift/2))
-        ubound = int(min(tdwidth, i + obs_length*max_drift/2))
-
-        skip = 0
-
-        if (maxsnr[lbound:ubound] > maxsnr[i]).nonzero()[0].any():
-            skip = 1
-
-        if skip:
+    half_width = obs_length*max_drift/2
+    hit_ids = (maxsnr > 0).nonzero()[0]
+    lbounds = np.maximum(0, hit_ids - half_width).astype(int)
+    ubounds = np.minimum(tdwidth, hit_ids + half_width).astype(int)
+
+    # A hit is skipped when some channel in its window has a larger SNR. As in the original per-hit test
+    # ((maxsnr[lbound:ubound] > maxsnr[i]).nonzero()[0].any()), the channel at lbound itself never counts, so
+    # the windows are (lbound, ubound) = [i - ceil(w) + 1, i + floor(w)), and channel 0 is masked out.
+    before = int(np.ceil(half_width)) - 1
+    after = int(np.floor(half_width))
+    snr_masked = maxsnr.copy()
+    snr_masked[0] = -np.inf
+    window_max = sliding_window_max(snr_masked, before, after)
+    skip = window_max[hit_ids] > maxsnr[hit_ids]
+
+    # Windows whose float bounds round differently from the closed form are checked directly.
+    irregular = (lbounds != np.maximum(0, hit_ids - before - 1)) | (ubounds != np.minimum(tdwidth, hit_ids + after))
+    for j in irregular.nonzero()[0]:
+        skip[j] = (maxsnr[lbounds[j]+1:ubounds[j]] > maxsnr[hit_ids[j]]).any()
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for i in hit_ids[skip]:
             logger.debug("SNR not big enough... %f pass... index: %d"%(maxsnr[i], i))
+
+    top_hits = hit_ids[~skip]
+    info_strs = ["Top hit found! SNR: %f ... index: %d"%(maxsnr[i], i) for i in top_hits]
+    for info_str in info_strs:
+        logger.info(info_str)
+    if logwriter and info_strs:
+        logwriter.info('\n'.join(info_strs))
+
+    if len(top_hits):
+        if filewriter:
+            filewriter = filewriter.report_tophits(max_val, top_hits, zip(lbounds[~skip], ubounds[~skip]), tdwidth,
+                                                   fftlen, header, max_val.total_n_hits, obs_info=obs_info)
         else:
-            info_str = "Top hit found! SNR: %f ... index: %d"%(maxsnr[i], i)
-            logger.info(info_str)
-            if logwriter:
-                logwriter.info(info_str)
-                #logwriter.report_tophit(max_val, i, header)
-#EE            logger.debug("slice of spectrum...size: %s"%str(tree_orig[0:nframes, lbound:ubound].shape))
-            if filewriter:
-                filewriter = filewriter.report_tophit(max_val, i, (lbound, ubound), tdwidth, fftlen, header,max_val.total_n_hits,obs_info=obs_info)
-#EE: not passing array cut, since not saving in .dat file                filewriter = filewriter.report_tophit(max_val, i, (lbound, ubound), tree_orig[0:nframes, lbound:ubound], header)
-
-##EE : Uncomment if want to save each blob              np.save(out_dir + '/spec_drift_%.4f_id_%d.npy'%(max_val.maxdrift[i],i), tree_orig[0:nframes, lbound:ubound])
-            else:
-                logger.error('Not have filewriter? tell me why.')
+            logger.error('Not have filewriter? tell me why.')
 
     return filewriter
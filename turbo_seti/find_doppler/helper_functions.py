@@ -41,6 +41,44 @@ def bitrev(inval, nbits):
     return ibitr
 
 
+def taylor_shifts(tsteps, t):
+    """
+    Channel shift, at time step t, of every drift path of a Taylor tree of tsteps time steps. The tree merges two
+    half trees of drift d into drifts 2d and 2d+1, delaying the second half by d and d+1 channels respectively.
+    :param tsteps:  int,        number of time steps of the tree, a power of two
+    :param t:       int,        time step
+    :return:        ndarray,    shift of each drift path, indexed by drift (not bit-reversed)
+    """
+    drift = np.arange(tsteps)
+    shift = np.zeros(tsteps, dtype=np.int64)
+    width = tsteps
+    while width > 1:
+        half = width // 2
+        if t >= half:
+            shift += drift // 2 + drift % 2
+            t -= half
+        drift = drift // 2
+        width = half
+    return shift
+
+def drift_index_table(tsteps):
+    """
+    Generates the drift index table for a Taylor tree of tsteps time steps, the same as the
+    drift_indexes/drift_indexes_array_%d.txt files. Row r is for tsteps/2 + r + 1 valid time steps, and lists for each
+    total drift k (in channels over those steps) the first drift path that ends k channels away, padded with zeros.
+    :param tsteps:  int,        number of time steps, a power of two
+    :return:        ndarray,    table of shape (tsteps/2, tsteps)
+    """
+    if tsteps < 2 or tsteps & (tsteps - 1):
+        raise ValueError('tsteps must be a power of two, not %s' % tsteps)
+
+    table = np.zeros((tsteps // 2, tsteps), dtype=np.min_scalar_type(tsteps - 1))
+    for row, tsteps_valid in enumerate(range(tsteps // 2 + 1, tsteps + 1)):
+        shifts, first = np.unique(taylor_shifts(tsteps, tsteps_valid - 1), return_index=True)
+        table[row, :tsteps_valid] = first
+    return table
+
+
 def FlipX(outbuf, xdim, ydim):
     """
     This function takes in an array of values and iteratively flips ydim chunks of values of length xdim. For example,
@@ -62,9 +100,36 @@ def FlipX(outbuf, xdim, ydim):
     return
 
 
+def sliding_window_max(arrey, before, after):
+    """
+    Computes the maximum of arrey[max(0, i-before) : min(len(arrey), i+after)] for every index i, in linear time
+    (van Herk / Gil-Werman: blocks of the window length, with running maxima from both ends of each block).
+    :param arrey:       ndarray,        floating point vector array
+    :param before:      int,            number of elements before i in the window
+    :param after:       int,            number of elements after i in the window (i itself included)
+    :return:            ndarray,        window maxima, -inf where the window is empty
+    """
+    arrey = np.asarray(arrey, dtype=np.float64)
+    n = len(arrey)
+    wlen = before + after
+    if wlen <= 0 or n == 0:
+        return np.full(n, -np.inf)
+
+    nblocks = int(np.ceil((n + wlen) / float(wlen)))
+    padded = np.full(nblocks * wlen, -np.inf)
+    padded[before:before + n] = arrey
+    blocks = padded.reshape((nblocks, wlen))
+    prefix_max = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix_max = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    # The window of i starts at padded[i] and ends at padded[i+wlen-1].
+    return np.maximum(suffix_max[:n], prefix_max[wlen - 1:wlen - 1 + n])
+
+
 def comp_stats(arrey):
     """
     Compute mean and stddev of floating point vector array in a fast way, without using the outliers.
+    The statistics keep the dtype (float32 or float64) of the input.
     :param arrey:       ndarray,        floating point vector array
     :return:            float, float,   median and standard deviation of input array
     """
@@ -30,6 +30,10 @@ def main(args=None):
                    help='Comma separated list of coarse channels to analyze.')
     p.add_argument('-n', '--n_coarse_chan', dest='n_coarse_chan', type=int, default=None,
                    help='Number of coarse channels in file.')
+    p.add_argument('-j', '--jobs', dest='n_workers', type=int, default=1,
+                   help='Number of processes searching coarse channels in parallel. Default: 1')
+    p.add_argument('--hits_h5', dest='hits_h5', action='store_true', default=False,
+                   help='Also write the hits to a binary .hits.h5 file next to the .dat file.')
 
     if args is None:
         args = p.parse_args()
@@ -63,7 +67,8 @@ def main(args=None):
         logging.basicConfig(format=format,stream=stream,level = level_log)
 
         find_seti_event = FindDoppler(args.filename, max_drift=args.max_drift, snr=args.snr, out_dir=args.out_dir,
-                                      coarse_chans=coarse_chans, obs_info=None, n_coarse_chan=args.n_coarse_chan)
+                                      coarse_chans=coarse_chans, obs_info=None, n_coarse_chan=args.n_coarse_chan,
+                                      n_workers=args.n_workers, hits_h5=args.hits_h5)
         find_seti_event.search()
 
         t1 = time.time()
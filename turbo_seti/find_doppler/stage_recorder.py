@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import json
+import socket
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+STAGE_FIELDS = ('coarse_chan', 'stage', 'wall_time', 'bytes', 'hits', 'peak_rss')
+
+def peak_rss():
+    """
+    :return:    int,    peak resident set size of this process so far, in bytes, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class StageRecorder:
+    """
+    Records, for each stage of the search of each coarse channel, the wall time, the number of bytes processed, the
+    number of hits and the peak RSS of the process. The calls of one stage within a coarse channel (one per drift
+    block, for instance) add up into a single record. Records are complete once finish() is called, which hands
+    them to the optional callback.
+    """
+    def __init__(self, callback=None):
+        """
+        :param callback:    callable,   called with every complete record (a dict with STAGE_FIELDS keys)
+        """
+        self.callback = callback
+        self.records = []
+        self.__open = {}
+
+    def __record(self, coarse_chan, name):
+        key = (coarse_chan, name)
+        if key not in self.__open:
+            self.__open[key] = {'coarse_chan': coarse_chan, 'stage': name, 'wall_time': 0., 'bytes': 0, 'hits': 0,
+                                'peak_rss': None}
+        return self.__open[key]
+
+    @contextmanager
+    def stage(self, coarse_chan, name, nbytes=0, hits=0):
+        """
+        Times the enclosed block as a call of stage name. The record is yielded, so that the block can add hits or
+        bytes known only at its end.
+        :param coarse_chan: int,        coarse channel searched, None for stages of the whole file
+        :param name:        string,     name of the stage
+        :param nbytes:      int,        bytes processed by this call
+        :param hits:        int,        hits found by this call
+        """
+        record = self.__record(coarse_chan, name)
+        t0 = time.time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] += time.time() - t0
+            record['bytes'] += int(nbytes)
+            record['hits'] += int(hits)
+            record['peak_rss'] = peak_rss()
+
+    def add(self, coarse_chan, name, wall_time, nbytes=0, hits=0):
+        """
+        Adds a call of stage name timed elsewhere (on the prefetch thread, for instance). Same parameters as stage.
+        :param wall_time:   float,      seconds spent in the call
+        """
+        record = self.__record(coarse_chan, name)
+        record['wall_time'] += wall_time
+        record['bytes'] += int(nbytes)
+        record['hits'] += int(hits)
+        record['peak_rss'] = peak_rss()
+
+    def finish(self):
+        """
+        Completes the open records, in the order they were opened.
+        :return:    list(dict),     the records completed
+        """
+        records = list(self.__open.values())
+        self.__open.clear()
+        self.extend(records)
+        return records
+
+    def extend(self, records):
+        """
+        Adds complete records, such as those returned by a search worker, and hands them to the callback.
+        :param records:     list(dict),     complete records
+        """
+        for record in records:
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def totals(self):
+        """
+        :return:    dict,   wall time, bytes and hits of each stage, summed over the coarse channels
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'wall_time': 0., 'bytes': 0, 'hits': 0})
+            for key in total:
+                total[key] += record[key]
+        return totals
+
+    def write_json(self, filename, **info):
+        """
+        Writes the records and their totals to a JSON file.
+        :param filename:    string,     name of the JSON file
+        :param info:        dict,       extra values describing the search (file, options...)
+        """
+        info.setdefault('hostname', socket.gethostname())
+        info.setdefault('peak_rss', peak_rss())
+        with open(filename, 'w') as json_file:
+            json.dump({'info': info, 'totals': self.totals(), 'stages': self.records}, json_file, indent=1)
+        logger.debug("Stage records written to %s"%filename)
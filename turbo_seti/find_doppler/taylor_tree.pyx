@@ -6,83 +6,281 @@ points in second spectra, etc...  Data are summed across time.
          Modified 2011 A. Siemion float/64 bit addressing (C-code)
          Modified 2014 H. Chen python version
          Modified 1-Feb-2016 E. Enriquez + P.Schellart cython version
+         Modified 2020 nogil kernel on typed memoryviews, OpenMP over tree sections
+         Modified 2020 frequency tiles, each summed through all the stages
 """
 
 import numpy as np
 cimport numpy as np
 
 cimport cython
+from cython.parallel cimport prange, threadid
+from libc.string cimport memcpy
 
 DTYPE = np.float64
-# "ctypedef" assigns a corresponding compile-time type to DTYPE_t. For
-# every type in the numpy module there's a corresponding compile-time
-# type with a _t-suffix.
-ctypedef np.float64_t DTYPE_t
+# "ctypedef fused" lets the kernel be compiled for both supported tree types:
+# float64 (default) and float32 (single-precision pipeline mode). For every
+# type in the numpy module there's a corresponding compile-time type with a
+# _t-suffix.
+ctypedef fused DTYPE_t:
+    np.float32_t
+    np.float64_t
 
 @cython.boundscheck(False)
-def taylor_flt(np.ndarray[DTYPE_t, ndim=1] outbuf, long mlen, long nchn):
+@cython.wraparound(False)
+@cython.cdivision(True)
+def taylor_flt(DTYPE_t[::1] outbuf, long mlen, long nchn, int n_threads=1, long tile_width=0):
     """
     Parameters:
-        outbuf       : input array (float), replaced by dedispersed data
-                       at the output
+        outbuf       : input array (float32 or float64), replaced by
+                       dedispersed data at the output
         mlen         : dimension of outbuf[] (long int)
         nchn         : number of frequency channels (long int)
+        n_threads    : number of OpenMP threads used to process the
+                       independent (isec, ipair) row pairs of each stage
+        tile_width   : width of the frequency tiles, in channels. 0 (the
+                       default) sweeps the whole rows at every stage.
+
+    Within a stage every (isec, ipair) combination reads and writes its own
+    pair of rows only, so the pairs are distributed over threads while each
+    row is still swept sequentially. The output is therefore identical to
+    the single-threaded kernel, whatever n_threads is.
+
+    With tile_width > 0, the tree is summed one frequency tile at a time:
+    the tile, and the nchn channels after it that its sums read, are copied
+    to a per-thread buffer of nchn * (tile_width + nchn) values, which goes
+    through all the stages before the next tile is read. A tile that fits
+    in the L2 cache is then read from memory once instead of once per
+    stage. The tiles are distributed over the threads, and the output is
+    identical to the untiled kernel.
+    """
+
+    _taylor_flt(outbuf, mlen, nchn, n_threads, False, tile_width)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def taylor_flt_reverse(DTYPE_t[::1] outbuf, long mlen, long nchn, int n_threads=1, long tile_width=0):
+    """
+    Same as taylor_flt, but every row of outbuf is summed from its last
+    channel towards its first one, i.e. it searches the opposite drift
+    direction. The result is stored in the original channel order, so it
+    equals flipping each row (FlipX), running taylor_flt and flipping back,
+    without the two copies.
+
+    Parameters:
+        outbuf       : input array (float32 or float64), replaced by
+                       dedispersed data at the output
+        mlen         : dimension of outbuf[] (long int)
+        nchn         : number of frequency channels (long int)
+        n_threads    : number of OpenMP threads
+        tile_width   : width of the frequency tiles (see taylor_flt)
     """
 
-    assert outbuf.dtype == DTYPE
+    _taylor_flt(outbuf, mlen, nchn, n_threads, True, tile_width)
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _taylor_flt(DTYPE_t[::1] outbuf, long mlen, long nchn, int n_threads, bint reverse, long tile_width):
+    """Runs all the Taylor tree stages, in the forward or reverse channel direction."""
+
+    if outbuf.shape[0] < mlen:
+        raise ValueError('taylor_flt: outbuf is shorter than mlen.')
+    if tile_width < 0:
+        raise ValueError('taylor_flt: tile_width must not be negative.')
+    if n_threads < 1:
+        n_threads = 1
 
-    cdef long nsamp = (mlen/nchn) - (2*nchn)
-    cdef long npts = nsamp + nchn
+    cdef Py_ssize_t nsamp = (mlen // nchn) - (2 * nchn)
+    cdef Py_ssize_t npts = nsamp + nchn
+    cdef Py_ssize_t ndat1 = nsamp + 2 * nchn
     cdef int nstages = int(np.log2(nchn))
 
     cdef int istages
-    cdef int isec
-    cdef int ipair
-    cdef int i1
-    cdef int ndelay
-    cdef int ndelay2
     cdef int nmem = 1
-    cdef int nmem2
-    cdef int nsec1
+    cdef int npairs = nchn // 2
+    cdef int iwork
 
-    cdef int ndat1 = nsamp + 2 * nchn
-    cdef int koff
-    cdef int nfin
-    cdef int ioff1
-    cdef int i2
+    # Reverse mode walks every row backwards from its last channel.
+    cdef Py_ssize_t step = -1 if reverse else 1
+    cdef DTYPE_t* start = &outbuf[ndat1 - 1] if reverse else &outbuf[0]
 
-    cdef DTYPE_t itemp
+    if 0 < tile_width < npts:
+        _taylor_flt_tiled(outbuf, start, step, ndat1, nchn, npts, nstages, tile_width, n_threads)
+        return
+
+    with nogil:
+        for istages in range(0, nstages):
+            nmem *= 2
+            # Each stage has nchn/nmem sections of nmem/2 independent row pairs.
+            for iwork in prange(npairs, num_threads=n_threads, schedule='static'):
+                _sum_pair(start, ndat1, npts, step, nmem, istages, iwork)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef _taylor_flt_tiled(DTYPE_t[::1] outbuf, DTYPE_t* start, Py_ssize_t step, Py_ssize_t ndat1, Py_ssize_t nchn,
+                       Py_ssize_t npts, int nstages, Py_ssize_t tile_width, int n_threads):
+    """Runs all the Taylor tree stages on one frequency tile after the other."""
+
+    dtype = np.float32 if DTYPE_t is np.float32_t else np.float64
+    cdef Py_ssize_t n_tiles = (npts + tile_width - 1) // tile_width
+    cdef Py_ssize_t width = tile_width + nchn
+    # The sums of a tile read the first nchn channels of the next one (its halo), which that tile overwrites:
+    # the halos are copied out of the tree before any tile is summed.
+    cdef DTYPE_t[:, :, ::1] halos = np.empty((n_tiles, nchn, nchn), dtype=dtype)
+    cdef DTYPE_t[:, :, ::1] scratch = np.empty((n_threads, nchn, width), dtype=dtype)
+    cdef Py_ssize_t itile
+
+    with nogil:
+        for itile in prange(n_tiles, num_threads=n_threads, schedule='static'):
+            _gather(start, ndat1, step, nchn, min((itile + 1) * tile_width, npts), nchn, &halos[itile, 0, 0], nchn)
+        for itile in prange(n_tiles, num_threads=n_threads, schedule='static'):
+            _sum_tile(start, ndat1, step, nchn, npts, nstages, itile * tile_width,
+                      min(tile_width, npts - itile * tile_width), &halos[itile, 0, 0], &scratch[threadid(), 0, 0],
+                      width)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _sum_tile(DTYPE_t* start, Py_ssize_t ndat1, Py_ssize_t step, Py_ssize_t nchn, Py_ssize_t npts, int nstages,
+                    Py_ssize_t offset, Py_ssize_t ntile, DTYPE_t* halo, DTYPE_t* scratch, Py_ssize_t width) nogil:
+    """
+    Sums channels [offset, offset + ntile) of the tree through all the stages, in scratch (nchn rows of width
+    channels), and writes them back.
+    """
+    cdef Py_ssize_t irow
+    cdef Py_ssize_t i
+    cdef Py_ssize_t nsum
+    cdef DTYPE_t* row
+    cdef int istages
+    cdef int iwork
+    cdef int nmem = 1
+
+    _gather(start, ndat1, step, nchn, offset, ntile, scratch, width)
+    for irow in range(nchn):
+        memcpy(scratch + irow * width + ntile, halo + irow * nchn, nchn * sizeof(DTYPE_t))
 
     for istages in range(0, nstages):
-        nmem  *= 2
-        nsec1  = nchn/nmem
-        nmem2  = nmem - 2
-        for isec in range(0, nsec1):
-            ndelay = -1
-            koff = isec * nmem
-            for ipair in range(0, nmem2+1, 2):
-                ioff1 = (bitrev(ipair, istages+1) + koff) * ndat1
-                i2 = (bitrev(ipair+1, istages+1) + koff) * ndat1
-                ndelay += 1
-                ndelay2 = (ndelay + 1)
-                nfin = (npts + ioff1)
-
-                for i1 in range(ioff1, nfin):
-                    itemp = outbuf[i1] + outbuf[i2+ndelay]
-                    outbuf[i2] = outbuf[i1] + outbuf[i2+ndelay2]
-                    outbuf[i1] = itemp
-                    i2 += 1
-    return
+        nmem *= 2
+        # A stage reads up to nmem/2 channels ahead, so the later stages need nchn - nmem channels past the tile.
+        # As in the untiled kernel, channels from npts on are never summed.
+        nsum = ntile + nchn - nmem
+        if nsum > npts - offset:
+            nsum = npts - offset
+        for iwork in range(nchn // 2):
+            _sum_pair(scratch, width, nsum, 1, nmem, istages, iwork)
 
-"""This function bit-reverses the given value "inval" with the number of
-bits, "nbits".    ----  R. Ramachandran, 10-Nov-97, nfra.
-python version ----  H. Chen   Modified 2014
-cython version ---- E. Enriquez + P.Schellart 1-Feb-2016
-"""
-cpdef int bitrev(int inval, int nbits) except *:
+    for irow in range(nchn):
+        row = start + irow * ndat1
+        if step == 1:
+            memcpy(row + offset, scratch + irow * width, ntile * sizeof(DTYPE_t))
+        else:
+            for i in range(ntile):
+                row[-(offset + i)] = scratch[irow * width + i]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _gather(DTYPE_t* start, Py_ssize_t ndat1, Py_ssize_t step, Py_ssize_t nrows, Py_ssize_t offset,
+                         Py_ssize_t n, DTYPE_t* dest, Py_ssize_t dest_width) nogil:
+    """Copies channels [offset, offset + n) of every row, in the sweep direction, into the rows of dest."""
+    cdef Py_ssize_t irow
+    cdef Py_ssize_t i
+    cdef DTYPE_t* row
+
+    for irow in range(nrows):
+        row = start + irow * ndat1
+        if step == 1:
+            memcpy(dest + irow * dest_width, row + offset, n * sizeof(DTYPE_t))
+        else:
+            for i in range(n):
+                dest[irow * dest_width + i] = row[-(offset + i)]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void _sum_pair(DTYPE_t* outbuf, Py_ssize_t ndat1, Py_ssize_t npts, Py_ssize_t step, int nmem,
+                           int istages, int iwork) nogil:
+    """Sums one (isec, ipair) row pair of a single Taylor tree stage, in place."""
+    cdef int half = nmem // 2
+    cdef int isec = iwork // half
+    cdef int ipair = 2 * (iwork % half)
+    cdef int koff = isec * nmem
+    cdef Py_ssize_t ndelay = ipair // 2
+    cdef Py_ssize_t ndelay2 = ndelay + 1
+    cdef DTYPE_t* row1 = outbuf + (_bitrev(ipair, istages+1) + koff) * ndat1
+    cdef DTYPE_t* row2 = outbuf + (_bitrev(ipair+1, istages+1) + koff) * ndat1
+    cdef Py_ssize_t i1
+    cdef DTYPE_t itemp
+
+    if step == 1:
+        for i1 in range(npts):
+            itemp = row1[i1] + row2[i1+ndelay]
+            row2[i1] = row1[i1] + row2[i1+ndelay2]
+            row1[i1] = itemp
+    else:
+        for i1 in range(npts):
+            itemp = row1[-i1] + row2[-(i1+ndelay)]
+            row2[-i1] = row1[-i1] + row2[-(i1+ndelay2)]
+            row1[-i1] = itemp
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def populate_rows(DTYPE_t[:, ::1] spectra, DTYPE_t[::1] outbuf, Py_ssize_t[::1] shifts, long tdwidth,
+                  long shoulder, int n_threads=1):
+    """
+    Copies the spectra into the rows of a Taylor tree, each rolled by its
+    own shift, with the end of every spectrum also copied into the shoulder
+    at the start of its row. Each row is written with three contiguous
+    copies, so no rolled temporary is made.
+
+    Parameters:
+        spectra      : (nframes, fftlen) array, same type as outbuf
+        outbuf       : tree of rows of tdwidth channels, filled in place
+        shifts       : shift of every row, in [0, fftlen) (np.intp array
+                       of length nframes): row i gets np.roll(spectra[i],
+                       shifts[i])
+        tdwidth      : width of the tree rows (long int)
+        shoulder     : number of channels in the left shoulder of each row
+        n_threads    : number of OpenMP threads, over the rows
+    """
+
+    cdef Py_ssize_t nframes = shifts.shape[0]
+    cdef Py_ssize_t fftlen = spectra.shape[1]
+    cdef Py_ssize_t i
+
+    if spectra.shape[0] < nframes:
+        raise ValueError('populate_rows: fewer spectra than shifts.')
+    if fftlen + shoulder > tdwidth or outbuf.shape[0] < nframes * tdwidth or shoulder > fftlen:
+        raise ValueError('populate_rows: outbuf is too small for the spectra.')
+    for i in range(nframes):
+        if shifts[i] < 0 or shifts[i] >= fftlen:
+            raise ValueError('populate_rows: shifts must be in [0, fftlen).')
+    if n_threads < 1:
+        n_threads = 1
+
+    with nogil:
+        for i in prange(nframes, num_threads=n_threads, schedule='static'):
+            _populate_row(&spectra[i, 0], &outbuf[i * tdwidth], fftlen, shifts[i], shoulder)
+
+cdef inline void _populate_row(const DTYPE_t* spectrum, DTYPE_t* row, Py_ssize_t fftlen, Py_ssize_t shift,
+                               Py_ssize_t shoulder) nogil:
+    """Fills one tree row: the shoulder, then the spectrum rolled by shift."""
+    memcpy(row, spectrum + fftlen - shoulder, shoulder * sizeof(DTYPE_t))
+    row += shoulder
+    memcpy(row + shift, spectrum, (fftlen - shift) * sizeof(DTYPE_t))
+    memcpy(row, spectrum + fftlen - shift, shift * sizeof(DTYPE_t))
+
+@cython.cdivision(True)
+cdef inline int _bitrev(int inval, int nbits) nogil:
+    """GIL-free twin of bitrev(), used inside the parallel kernel."""
     cdef int ibitr
     cdef int k
     cdef int ifact
+    cdef int i
 
     if nbits <= 1:
         ibitr = inval
@@ -93,8 +291,15 @@ cpdef int bitrev(int inval, int nbits) except *:
         k = inval
         ibitr = (1 & k) * ifact
         for i in range(2, nbits+1):
-            k /= 2
-            ifact /= 2
+            k = k // 2
+            ifact = ifact // 2
             ibitr += (1 & k) * ifact
     return ibitr
 
+"""This function bit-reverses the given value "inval" with the number of
+bits, "nbits".    ----  R. Ramachandran, 10-Nov-97, nfra.
+python version ----  H. Chen   Modified 2014
+cython version ---- E. Enriquez + P.Schellart 1-Feb-2016
+"""
+cpdef int bitrev(int inval, int nbits) except *:
+    return _bitrev(inval, nbits)
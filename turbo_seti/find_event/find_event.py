@@ -36,7 +36,10 @@ Usage (beta):
                            SNR_cut=10, 
                            check_zero_drift=False, 
                            filter_threshold=3, 
-                           on_off_first='ON')
+                           on_off_first='ON',
+                           cache=False,
+                           rfi_index=None,
+                           rfi_sources=1)
     
     file_sublist        A Python list of .dat files with ON observations of a
                         single target alternating with OFF observations. This 
@@ -71,6 +74,20 @@ Usage (beta):
     on_off_first        Tells the code whether the .dat sequence starts with
                         the ON or the OFF observation. Valid entries are 'ON'
                         and 'OFF' only. Default is 'ON'.
+
+    cache               A True/False flag that tells the program whether to
+                        keep the parsed .dat files in .npz sidecar files
+                        (<name>.dat.npz), so that later runs over the same,
+                        unchanged files skip the parsing. Default is False.
+
+    rfi_index           Name of an RFI index file built by rfi_index.py from
+                        the .dat files of other observations. When given, 
+                        filter levels 2 and 3 also reject the ON hits that 
+                        are in range of hits from at least rfi_sources other
+                        sources in the index. Default is None (no index).
+
+    rfi_sources         The number of other sources, in the RFI index, that
+                        makes a hit RFI. Default is 1.
                     
 author: 
     Version 2.0 - Sofia Sheikh (ssheikhmsa@gmail.com)
@@ -88,8 +105,10 @@ function.
 
 """
 
+import os
 import pandas as pd
 import numpy as np
+import h5py
 import time
 
 pd.options.mode.chained_assignment = None  
@@ -112,71 +131,139 @@ def end_search(t0):
     print('------   o   -------')
     return
 
-def read_dat(filename):
+# Columns of the .dat body read by read_dat: (position in the line, name, type)
+DAT_COLUMNS = [(0, 'TopHitNum', 'int64'), (1, 'DriftRate', 'float64'), (2, 'SNR', 'float64'),
+               (3, 'Freq', 'float64'), (5, 'ChanIndx', 'int64'), (6, 'FreqStart', 'float64'),
+               (7, 'FreqEnd', 'float64'), (10, 'CoarseChanNum', 'int64'),
+               (11, 'FullNumHitsInRange', 'int64')]
+DAT_HEADER_KEYS = ['FileID', 'Source', 'MJD', 'RA', 'DEC', 'DELTAT', 'DELTAF']
+
+def read_dat(filename, cache=False):
     """ Read a turboseti .dat file
 
     Args:
         filename (str): Name of .dat file to open
+        cache (bool): Keep the parsed columns in a <filename>.npz sidecar file,
+            which is used instead of the .dat file as long as the size and
+            modification time of the .dat file are unchanged.
 
     Returns: pandas dataframe of hits
     """
 
-    file_dat = open(filename.strip())
-    hits = file_dat.readlines()
-
-    # Get info from the .dat file header
-    FileID = hits[1].strip().split(':')[-1].strip()
-    Source = hits[3].strip().split(':')[-1].strip()
-
-    MJD = hits[4].strip().split('\t')[0].split(':')[-1].strip()
-    RA = hits[4].strip().split('\t')[1].split(':')[-1].strip()
-    DEC = hits[4].strip().split('\t')[2].split(':')[-1].strip()
-
-    DELTAT = hits[5].strip().split('\t')[0].split(':')[-1].strip()  # s
-    DELTAF = hits[5].strip().split('\t')[1].split(':')[-1].strip()  # Hz
-
-    # Get info from individual hits (the body of the .dat file)
-    all_hits = [hit.strip().split('\t') for hit in hits[9:]]
-
-    # Now reorganize that info to be grouped by column (parameter)
-    # not row (individual hit)
-    if all_hits:
-        TopHitNum = list(zip(*all_hits))[0]
-        DriftRate = [float(df) for df in list(zip(*all_hits))[1]]
-        SNR = [float(ss) for ss in list(zip(*all_hits))[2]]
-        Freq = [float(ff) for ff in list(zip(*all_hits))[3]]
-        ChanIndx = list(zip(*all_hits))[5]
-        FreqStart = list(zip(*all_hits))[6]
-        FreqEnd = list(zip(*all_hits))[7]
-        CoarseChanNum = list(zip(*all_hits))[10]
-        FullNumHitsInRange = list(zip(*all_hits))[11]
-
-        data = {'TopHitNum': TopHitNum,
-                'DriftRate': DriftRate,
-                'SNR': SNR,
-                'Freq': Freq,
-                'ChanIndx': ChanIndx,
-                'FreqStart': FreqStart,
-                'FreqEnd': FreqEnd,
-                'CoarseChanNum': CoarseChanNum,
-                'FullNumHitsInRange': FullNumHitsInRange
-                }
+    filename = filename.strip()
+    file_stat = os.stat(filename)
+    cache_key = np.array([file_stat.st_mtime_ns, file_stat.st_size])
+    cache_file = filename + '.npz'
+
+    if cache and os.path.isfile(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as cached:
+                if np.array_equal(cached['cache_key'], cache_key):
+                    header = dict(zip(DAT_HEADER_KEYS, cached['header']))
+                    columns = {name: cached[name] for _, name, _ in DAT_COLUMNS}
+                    return dat_table(columns, header)
+        except (IOError, ValueError, KeyError):
+            pass
+
+    with open(filename) as file_dat:
+        # Get info from the .dat file header
+        header_lines = [file_dat.readline() for ii in range(9)]
+        header = {}
+        header['FileID'] = header_lines[1].strip().split(':')[-1].strip()
+        header['Source'] = header_lines[3].strip().split(':')[-1].strip()
+
+        header['MJD'] = header_lines[4].strip().split('\t')[0].split(':')[-1].strip()
+        header['RA'] = header_lines[4].strip().split('\t')[1].split(':')[-1].strip()
+        header['DEC'] = header_lines[4].strip().split('\t')[2].split(':')[-1].strip()
+
+        header['DELTAT'] = header_lines[5].strip().split('\t')[0].split(':')[-1].strip()  # s
+        header['DELTAF'] = header_lines[5].strip().split('\t')[1].split(':')[-1].strip()  # Hz
+
+        # Get info from individual hits (the body of the .dat file), with the
+        # C tokenizer of pandas. round_trip parses floats as python does.
+        try:
+            body = pd.read_csv(file_dat, sep='\t', header=None, comment='#', skipinitialspace=True,
+                               usecols=[col for col, _, _ in DAT_COLUMNS],
+                               dtype={col: dtype for col, _, dtype in DAT_COLUMNS},
+                               float_precision='round_trip')
+            columns = {name: body[col].values for col, name, _ in DAT_COLUMNS}
+        except pd.errors.EmptyDataError:
+            columns = {name: np.array([], dtype=dtype) for _, name, dtype in DAT_COLUMNS}
+
+    if cache:
+        try:
+            np.savez(cache_file, cache_key=cache_key, header=np.array([header[key] for key in DAT_HEADER_KEYS]),
+                     **columns)
+        except (IOError, OSError):
+            pass
+
+    return dat_table(columns, header)
+
+def dat_table(columns, header):
+    """ Builds the hit table returned by read_dat
+
+    Args:
+        columns (dict): Arrays of the .dat body columns, by name
+        header (dict): Header strings of the .dat file, by name
 
-        # Creating pandas dataframe from data we just read in
-        df_data = pd.DataFrame(data)
-        df_data = df_data.apply(pd.to_numeric)
+    Returns: pandas dataframe of hits
+    """
 
+    if len(columns['TopHitNum']):
+        df_data = pd.DataFrame(columns, columns=[name for _, name, _ in DAT_COLUMNS])
     else:
         df_data = pd.DataFrame()
 
     # Matching column information from before to the .dat data we read in
-    df_data['FileID'] = FileID
-    df_data['Source'] = Source.upper()
-    df_data['MJD'] = MJD
-    df_data['RA'] = RA
-    df_data['DEC'] = DEC
-    df_data['DELTAT'] = DELTAT
-    df_data['DELTAF'] = DELTAF
+    df_data['FileID'] = header['FileID']
+    df_data['Source'] = header['Source'].upper()
+    df_data['MJD'] = header['MJD']
+    df_data['RA'] = header['RA']
+    df_data['DEC'] = header['DEC']
+    df_data['DELTAT'] = header['DELTAT']
+    df_data['DELTAF'] = header['DELTAF']
+
+    # Adding extra columns that will be filled out by this program
+    df_data['Hit_ID'] = ''
+    df_data['status'] = ''
+    df_data['in_n_ons'] = ''
+    df_data['RFI_in_range'] = ''
+
+    return df_data
+
+def read_hits_h5(filename):
+    """ Read a turboseti .hits.h5 file, the binary counterpart of the .dat file
+
+    Args:
+        filename (str): Name of .hits.h5 file to open
+
+    Returns: pandas dataframe of hits, with the same columns and column types
+    as read_dat. The numeric columns have full precision, while the .dat text
+    is rounded.
+    """
+
+    with h5py.File(filename.strip(), 'r') as h5:
+        attrs = dict(h5.attrs)
+        data = {'TopHitNum': h5['TopHitNum'][:],
+                'DriftRate': h5['DriftRate'][:],
+                'SNR': h5['SNR'][:],
+                'Freq': h5['Freq'][:],
+                'ChanIndx': h5['ChanIndx'][:],
+                'FreqStart': h5['FreqStart'][:],
+                'FreqEnd': h5['FreqEnd'][:],
+                'CoarseChanNum': h5['CoarseChanNum'][:],
+                'FullNumHitsInRange': h5['FullNumHitsInRange'][:]
+                }
+    df_data = pd.DataFrame(data)
+
+    # Header values, as the strings read_dat gets from the .dat header
+    df_data['FileID'] = attrs['FileID']
+    df_data['Source'] = str(attrs['Source']).upper()
+    df_data['MJD'] = ('%18.12f' % attrs['MJD']).strip()
+    df_data['RA'] = attrs['RA']
+    df_data['DEC'] = attrs['DEC']
+    df_data['DELTAT'] = ('%10.6f' % attrs['DELTAT']).strip()
+    df_data['DELTAF'] = ('%10.6f' % attrs['DELTAF']).strip()
 
     # Adding extra columns that will be filled out by this program
     df_data['Hit_ID'] = ''
@@ -186,10 +273,12 @@ def read_dat(filename):
 
     return df_data
 
-def make_table(filename, init=False):
+def make_table(filename, init=False, cache=False):
     """ Creates a pandas dataframe with column names standard for turboSETI .dat
     output files, either directly (if) or by reading the file line-by line and
-    then reorganizing the output (else)
+    then reorganizing the output (else). Binary .hits.h5 files are read
+    directly, without any text parsing. With cache, parsed .dat files are
+    kept in .npz sidecar files (see read_dat).
     """
     
     if init:
@@ -200,8 +289,14 @@ def make_table(filename, init=False):
                    'RFI_in_range']
         df_data = pd.DataFrame(columns=columns)
 
+    elif filename.strip().endswith('.hits.h5'):
+        df_data = read_hits_h5(filename)
+
+    elif filename.strip().endswith('.h5'):
+        raise ValueError('%s is not a turboSETI hits file (.dat or .hits.h5).' % filename.strip())
+
     else:
-        df_data = read_dat(filename)
+        df_data = read_dat(filename, cache=cache)
     return df_data
 
 def calc_freq_range(hit,delta_t=0,max_dr=True,follow=False):
@@ -228,6 +323,57 @@ def calc_freq_range(hit,delta_t=0,max_dr=True,follow=False):
 
     return [low_bound,high_bound]
 
+def calc_freq_ranges(hits,delta_t=0,max_dr=True,follow=False):
+    """Vectorized calc_freq_range: the same frequency ranges, with the same
+        arithmetic, for every hit of a table at once.
+        Returns two arrays, the low and the high bounds.
+    """
+    if max_dr:
+        drift_rate = np.full(len(hits), MAX_DRIFT_RATE, dtype=np.float64)
+    else:
+        drift_rate = hits['DriftRate'].values.astype(np.float64)
+
+    zero_drift = drift_rate == 0.0
+    if zero_drift.any():
+        drift_rate = np.where(zero_drift,
+                              hits['DELTAF'].values.astype(np.float64)/hits['DELTAT'].values.astype(np.float64),
+                              drift_rate)
+    if follow:
+        freq = hits['Freq'].values + drift_rate*(delta_t)/1e6
+        delta_t = 2*OBS_LENGTH
+    else:
+        freq = hits['Freq'].values
+        delta_t = delta_t+OBS_LENGTH
+
+    low_bound  = freq - np.abs(drift_rate)*delta_t/1e6
+    high_bound = freq + np.abs(drift_rate)*delta_t/1e6
+
+    return low_bound, high_bound
+
+def count_in_ranges(sorted_freqs, low_bounds, high_bounds):
+    """Counts, for every (low, high) range, the frequencies of a sorted array
+        that are strictly inside it, with two binary searches per range.
+    """
+    n_in_range = (np.searchsorted(sorted_freqs, high_bounds, side='left') -
+                  np.searchsorted(sorted_freqs, low_bounds, side='right'))
+    return np.maximum(n_in_range, 0)
+
+def follow_events(hits,on_table):
+    """ Follows every hit of a table to another ON observation at once, as
+    follow_event does for one hit: the ON frequencies are sorted once, and
+    each hit's predicted frequency window is found with binary searches.
+    Returns, for every hit, the positions (in on_table row order) of the ON
+    hits that could be part of the same event.
+    """
+    freq_order = np.argsort(on_table['Freq'].values, kind='stable')
+    sorted_freqs = on_table['Freq'].values[freq_order]
+
+    low_bounds, high_bounds = calc_freq_ranges(hits,delta_t=on_table['delta_t'].values[0],max_dr=False,follow=True)
+    starts = np.searchsorted(sorted_freqs, low_bounds, side='right')
+    n_in_range = np.maximum(np.searchsorted(sorted_freqs, high_bounds, side='left') - starts, 0)
+
+    return [np.sort(freq_order[start:start + n]) for start, n in zip(starts, n_in_range)]
+
 def follow_event(hit,on_table,get_count=True):
     """ Follows a given hit to the next observation of the same target and 
     looks for hits which could be part of the same event.
@@ -257,7 +403,10 @@ def find_events(dat_file_list,
                 SNR_cut=10,
                 check_zero_drift=False,
                 filter_threshold=3,
-                on_off_first='ON'):
+                on_off_first='ON',
+                cache=False,
+                rfi_index=None,
+                rfi_sources=1):
     """ Reads a list of turboSETI .dat files.
         It calls other functions to find events within this group of files.
         Filter_threshold allows the return of a table of events with hits at 
@@ -266,6 +415,10 @@ def find_events(dat_file_list,
             1) Hits above an SNR cut witout AB check
             2) Hits that are only in some As and no Bs
             3) Hits that are only in all As and no Bs
+        With cache, parsed .dat files are kept in .npz sidecar files, so that
+        later runs over the same files skip the parsing (see read_dat).
+        With rfi_index, hits also seen in the observations of rfi_sources
+        other sources of an RFI index are rejected (see rfi_index.py).
     """
     #Initializing timer
     t0 = time.time()
@@ -290,7 +443,7 @@ def find_events(dat_file_list,
         if i%2 == on_off_indicator:
             #Using make_table function to read the .dat file 
             #and create the pandas hit table
-            off_table_i=make_table(dat_file)
+            off_table_i=make_table(dat_file, cache=cache)
             off_table_i['status'] = 'off_table_%i'%off_count
             print('Loaded %i hits from %s'%(len(off_table_i), dat_file))
 
@@ -301,13 +454,13 @@ def find_events(dat_file_list,
         else: 
             #Using make_table function to read the .dat file 
             #and create the pandas hit table
-            on_table_i=make_table(dat_file)
+            on_table_i=make_table(dat_file, cache=cache)
             on_table_i['status'] = 'on_table_%i'%on_count
             print('Loaded %i hits from %s'%(len(on_table_i), dat_file))
     
             #Grouping all of the on hits into one table
             on_table_list.append(on_table_i)
-            off_count+=1
+            on_count+=1
     
     #If there are no hits on any on target, end the program
     if not len(on_table_list):
@@ -371,13 +524,28 @@ def find_events(dat_file_list,
     #----------------------------------------------------------------------
 
     #Now find how much RFI is within a frequency range of the hit 
-    #by comparing the ON to the OFF observations. Update RFI_in_range
-    snr_adjusted_table['RFI_in_range'] = snr_adjusted_table.apply(lambda hit: len(off_table[((off_table['Freq'] > calc_freq_range(hit)[0]) & (off_table['Freq'] < calc_freq_range(hit)[1]))]),axis=1)
+    #by comparing the ON to the OFF observations. Update RFI_in_range.
+    #The OFF frequencies are sorted once, then every range is counted
+    #with binary searches.
+    low_bounds, high_bounds = calc_freq_ranges(snr_adjusted_table)
+    off_freqs = np.sort(off_table['Freq'].values)
+    snr_adjusted_table['RFI_in_range'] = count_in_ranges(off_freqs, low_bounds, high_bounds)
         
     #If there is no RFI in range of the hit, it graduates to the 
     #not_in_B_table
     not_in_off_table = snr_adjusted_table[snr_adjusted_table['RFI_in_range'] == 0]
 
+    #Optionally, reject the hits that are also in range of the hits of
+    #other sources, looked up in a persistent RFI index.
+    if rfi_index is not None and len(not_in_off_table):
+        try:
+            from . import rfi_index as rfi_index_module
+        except:
+            import rfi_index as rfi_index_module
+        n_sources = rfi_index_module.count_rfi_sources(rfi_index, not_in_off_table, on_table['Source'].iloc[0])
+        print('Rejected %i hits seen in other sources of the RFI index.'%np.count_nonzero(n_sources >= rfi_sources))
+        not_in_off_table = not_in_off_table[n_sources < rfi_sources]
+
     if (len(not_in_off_table) == 0):
         print('Found no hits present in only the on observations in this cadence :(')
         end_search(t0)
@@ -405,21 +573,27 @@ def find_events(dat_file_list,
             empty_counter += 1
     if empty_counter == 0:
         first_on = on_but_not_off_table_list[0]#
-        def hit_func(hit):
-            val = 0
-            for i in range(1, len(on_but_not_off_table_list)):
-                val += follow_event(hit, on_but_not_off_table_list[i])
-            return val
-        
-        first_on['in_n_ons'] = first_on.apply(hit_func, axis=1)
-        in_all_ons_table = first_on[first_on['in_n_ons'] == number_of_ons - 1]
+
+        #Follow every hit of the first ON to the other ONs, with one batched
+        #range query per ON table.
+        matches = [follow_events(first_on, table) for table in on_but_not_off_table_list[1:]]
+        in_n_ons = np.zeros(len(first_on), dtype=np.int64)
+        for table_matches in matches:
+            in_n_ons += np.array([len(positions) > 0 for positions in table_matches], dtype=np.int64)
+        first_on['in_n_ons'] = in_n_ons
+
+        in_all_ons = (in_n_ons == number_of_ons - 1).nonzero()[0]
+        in_all_ons_table = first_on.iloc[in_all_ons]
         
-        #Create list of events.
+        #Create list of events: for each hit in all ONs, the matching hits of
+        #every ON table, the first ON included.
+        matches = [follow_events(in_all_ons_table, on_but_not_off_table_list[0])] + \
+                  [[table_matches[ii] for ii in in_all_ons] for table_matches in matches]
         filter_3_event_list = []
 
-        for hit_index, hit in in_all_ons_table.iterrows():
-            for table in on_but_not_off_table_list:
-                temp_table = follow_event(hit,table,get_count=False)
+        for hit_number, (hit_index, hit) in enumerate(in_all_ons_table.iterrows()):
+            for table, table_matches in zip(on_but_not_off_table_list, matches):
+                temp_table = table.iloc[table_matches[hit_number]]
                 temp_table['Hit_ID'] = hit['Source']+'_'+str(hit_index)
                 filter_3_event_list += [temp_table]
 
@@ -22,7 +22,11 @@ Usage (beta):
                                             on_off_first='ON', 
                                             number_in_cadence=6, 
                                             saving=True,  
-                                            user_validation=False)
+                                            user_validation=False,
+                                            cache=False,
+                                            n_jobs=1,
+                                            rfi_index=None,
+                                            rfi_sources=1)
     
     dat_file_list_str   The string name of a plaintext file ending in .lst 
                         that contains the filenames of .dat files, each on a 
@@ -75,6 +79,29 @@ Usage (beta):
                         before beginning to run the program. Recommended when
                         first learning the program, not recommended for 
                         automated scripts.
+
+    cache               A True/False flag that tells the program whether to
+                        keep the parsed .dat files in .npz sidecar files, so
+                        that repeated runs over the same .lst skip the parsing.
+                        Default is False.
+
+    n_jobs              The number of processes looking for events in
+                        different cadences at the same time. Results are 
+                        still saved in cadence order, as each cadence 
+                        finishes, and the output of each cadence is printed
+                        in one block together with its timing. Default is 1.
+
+    rfi_index           Name of a persistent RFI index file (see 
+                        rfi_index.py). When given, the hits of every file in
+                        the .lst are added to the index first (files that 
+                        were indexed before and did not change are skipped),
+                        and find_events rejects the hits that are also seen 
+                        in rfi_sources other sources of the index. The same 
+                        index can be shared by all the .lst files of a 
+                        session. Default is None (no index).
+
+    rfi_sources         The number of other sources, in the RFI index, that
+                        makes a hit RFI. Default is 1.
                     
 author: 
     Version 2.0 - Sofia Sheikh (ssheikhmsa@gmail.com), 
@@ -91,12 +118,37 @@ function.
 """
 
 #required packages and programs
-import find_event
+try:
+    from . import find_event
+    from . import rfi_index as rfi_index_module
+except:
+    import find_event
+    import rfi_index as rfi_index_module
 import pandas as pd
 
 #required for updated_find_event
 import time
 import numpy as np
+import io
+import contextlib
+import multiprocessing
+
+def _cadence_name(file_sublist, on_off_first):
+    """ Returns the name of the ON source of a cadence. """
+    if on_off_first == 'ON':
+        return file_sublist[0].split('_')[5]
+    return file_sublist[1].split('_')[5]
+
+def _find_cadence_events(args):
+    """ Runs find_events on one cadence in a worker process, capturing its
+    printed output so that it can be shown in one block by the parent.
+    """
+    file_sublist, kwargs = args
+    t0 = time.time()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        cand = find_event.find_events(file_sublist, **kwargs)
+    return cand, output.getvalue(), time.time() - t0
 
 def find_event_pipeline(dat_file_list_str,
                         SNR_cut=10, 
@@ -105,7 +157,11 @@ def find_event_pipeline(dat_file_list_str,
                         on_off_first='ON', 
                         number_in_cadence=6, 
                         saving=True, 
-                        user_validation=False): 
+                        user_validation=False,
+                        cache=False,
+                        n_jobs=1,
+                        rfi_index=None,
+                        rfi_sources=1): 
     print()
     print("************   BEGINNING FIND_EVENT PIPELINE   **************")
     print()
@@ -148,43 +204,80 @@ def find_event_pipeline(dat_file_list_str,
             if reply[0] == 'n':
                 return
     
-    #Looping over number_in_cadence chunks.
+    #Splitting the list into number_in_cadence chunks.
+    cadence_list = [dat_file_list[number_in_cadence*i:((i*number_in_cadence)+(number_in_cadence))]
+                    for i in range((int(n_files/number_in_cadence)))]
+    find_events_kwargs = dict(SNR_cut=SNR_cut, 
+                              check_zero_drift=check_zero_drift, 
+                              filter_threshold=filter_threshold, 
+                              on_off_first=on_off_first,
+                              cache=cache,
+                              rfi_index=rfi_index,
+                              rfi_sources=rfi_sources)
+    
+    #Adding the new or changed files to the RFI index
+    if rfi_index is not None:
+        n_indexed = rfi_index_module.update_rfi_index(rfi_index, dat_file_list, cache=cache)
+        print("Indexed %i new or changed files in the RFI index %s" % (n_indexed, rfi_index))
+    
+    #The output file is named after the last cadence in the list.
+    filestring = None
+    if saving == True and len(cadence_list) > 0:
+        name = _cadence_name(cadence_list[-1], on_off_first)
+        if check_zero_drift == True:
+            filestring = name + '_f' + str(filter_threshold) + '_snr' + str(SNR_cut) + '_zero' + '.csv'
+        else:
+            filestring = name + '_f' + str(filter_threshold) + '_snr' + str(SNR_cut) + '.csv'
+    
+    def serial_results():
+        for file_sublist in cadence_list:
+            print()
+            print("***       " + _cadence_name(file_sublist, on_off_first) + "       ***")
+            print()
+            t0 = time.time()
+            cand = find_event.find_events(file_sublist, **find_events_kwargs)
+            yield cand, None, time.time() - t0
+    
+    #Looping over the cadences, in a process pool if asked to.  Results come
+    #back in cadence order and are appended to the .csv as they arrive.
     candidate_list = []
-    for i in range((int(n_files/number_in_cadence))):
-        file_sublist = dat_file_list[number_in_cadence*i:((i*number_in_cadence)+(number_in_cadence))]
-        if on_off_first == 'ON':
-            name=file_sublist[0].split('_')[5]  
-        if on_off_first == 'OFF':
-            name=file_sublist[1].split('_')[5] 
-        print()
-        print("***       " + name + "       ***")
-        print()
-        cand = find_event.find_events(file_sublist, 
-                                      SNR_cut=SNR_cut, 
-                                      check_zero_drift=check_zero_drift, 
-                                      filter_threshold=filter_threshold, 
-                                      on_off_first=on_off_first)
-        cand_len = 1
-        if cand is None:
-            cand_len = 0
-        if cand_len != 0:
+    pool = None
+    if n_jobs > 1 and len(cadence_list) > 1:
+        pool = multiprocessing.Pool(min(n_jobs, len(cadence_list)))
+        results = pool.imap(_find_cadence_events, [(file_sublist, find_events_kwargs) for file_sublist in cadence_list])
+    else:
+        results = serial_results()
+    
+    try:
+        for file_sublist, (cand, output, elapsed) in zip(cadence_list, results):
+            if output is not None:
+                print()
+                print("***       " + _cadence_name(file_sublist, on_off_first) + "       ***")
+                print()
+                print(output, end='')
+            print("Cadence time: %5.2f s" % elapsed)
+            if cand is None:
+                continue
+            if filestring is not None:
+                cand.to_csv(filestring, mode='a' if candidate_list else 'w', header=not candidate_list)
             candidate_list.append(cand)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    
     if len(candidate_list) > 0:
         find_event_output_dataframe = pd.concat(candidate_list)
     else:
-        "Sorry, no potential candidates with your given parameters :("
+        print("Sorry, no potential candidates with your given parameters :(")
         find_event_output_dataframe = []
 
     print("************  ENDING FIND_EVENT PIPELINE   **************")
-    
-    if saving == True:
-        if check_zero_drift == True:
-            filestring = name + '_f' + str(filter_threshold) + '_snr' + str(SNR_cut) + '_zero' + '.csv'
-        else:
-            filestring = name + '_f' + str(filter_threshold) + '_snr' + str(SNR_cut) + '.csv'
-        
-        find_event_output_dataframe.to_csv(filestring)
-
 
     return(find_event_output_dataframe)
 
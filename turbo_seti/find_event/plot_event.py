@@ -13,6 +13,7 @@ import pandas as pd
 #import pylab as plt
 import numpy as np
 import logging; logging.disable(logging.CRITICAL);
+import multiprocessing
 
 #BL + my packages import
 #import updated_find_event
@@ -25,12 +26,15 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 from .find_event import make_table
+from .preview import read_preview_level
 
 #preliminary plot arguments
 fontsize=16
 font = {'family' : 'DejaVu Sans',
 'size' : fontsize}
 MAX_IMSHOW_POINTS = (10096, 10096)
+# Most channels read from a file at once by plot_candidate_events
+MAX_SLICE_CHANNELS = 2**20
 
 
 def plot_hit(fil_filename, dat_filename, hit_id, bw=None, offset=0):
@@ -110,6 +114,63 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
                          epoch=None,bw=250.0, local_host='',plot_name='',save_pdf_plot=False,saving_fig=False,offset=0,
                          dedoppler=False,**kwargs):
     """ Makes waterfall plots per group of ON-OFF pairs (up to 6 plots.)
+    Each file is read once, then plotted with plot_waterfall_panels.
+    """
+    panels = [read_waterfall_panel(filename, f_start, f_stop) for filename in filenames_list]
+    return plot_waterfall_panels(panels, target, drates, fvals, f_start, f_stop, node_string, filter_level,
+                                 ion=ion, offset=offset, **kwargs)
+
+
+def read_waterfall_panel(filename, f_start, f_stop, min_points=MAX_IMSHOW_POINTS[1]):
+    """ Reads the data of one panel of make_waterfall_plots. Wide windows
+    are read from the preview file of the data file, when there is one
+    (see preview.py), at the coarsest level that has min_points channels.
+
+    Args:
+        filename (str): Path to filterbank or HDF5 file
+        f_start (float): start frequency, in MHz
+        f_stop (float): stop frequency, in MHz
+        min_points (int): number of frequency points needed in the panel
+    Returns:
+        panel (dict): see waterfall_panel
+    """
+    level = read_preview_level(filename, f_start, f_stop, min_points)
+    if level is not None:
+        return preview_panel(level, f_start, f_stop)
+
+    fil = bl.Waterfall(filename, f_start=f_start, f_stop=f_stop)
+    plot_f, plot_data = fil.grab_data(f_start=f_start, f_stop=f_stop)
+    return waterfall_panel(plot_f, plot_data, fil.timestamps, fil.header, fil.n_ints_in_file)
+
+
+def waterfall_panel(plot_f, plot_data, timestamps, header, n_ints_in_file):
+    """ Groups the in-memory data needed to plot one panel
+
+    Args:
+        plot_f (np.array): frequency axis in MHz
+        plot_data (np.array): data, with shape (time, frequency)
+        timestamps (np.array): MJD of every integration of the file
+        header (dict): file header
+        n_ints_in_file (int): number of integrations in the file
+    Returns:
+        panel (dict)
+    """
+    return {'plot_f': plot_f, 'plot_data': plot_data, 'timestamps': timestamps,
+            'tstart': header['tstart'], 'tsamp': header['tsamp'], 'n_ints_in_file': n_ints_in_file}
+
+
+def preview_panel(level, f_start, f_stop):
+    """ Makes a panel from a preview level (see preview.read_preview_level) """
+    freqs, data, header = level
+    plot_f, plot_data = grab_window(freqs, data, f_start, f_stop)
+    timestamps = np.arange(header['n_ints_in_file']) * header['tsamp'] / 24./60./60. + header['tstart']
+    return waterfall_panel(plot_f, plot_data, timestamps, header, header['n_ints_in_file'])
+
+
+def plot_waterfall_panels(panels, target, drates, fvals, f_start, f_stop, node_string, filter_level, ion=False,
+                          offset=0, **kwargs):
+    """ Makes waterfall plots per group of ON-OFF pairs (up to 6 plots) from
+    in-memory panels (see waterfall_panel), and saves them as a .png file.
     """
     
     #prepares for plotting
@@ -125,23 +186,13 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
     units = 'Hz'
 
     #sets up the sub-plots
-    n_plots = len(filenames_list)
+    n_plots = len(panels)
     fig = plt.subplots(n_plots, sharex=True, sharey=True,figsize=(10, 2*n_plots))
 
     #finding plotting values range for the first panel (A1)
-    fil = bl.Waterfall(filenames_list[0], f_start=f_start, f_stop=f_stop)
-    
-    filheader=fil.header
-    f={}
-    for key, value in filheader.items():
-        f[key]=value
-    filheader=f
-
-    print ('filheader', filheader)
-    t0 = filheader['tstart']
-    plot_f, plot_data = fil.grab_data(f_start=f_start, f_stop=f_stop)
+    t0 = panels[0]['tstart']
+    plot_data = panels[0]['plot_data']
     dec_fac_x, dec_fac_y = 1, 1
-    #print ('plot_data', plot_data)
 
     #rebinning data to plot correctly with fewer plots
     if plot_data.shape[0] > MAX_IMSHOW_POINTS[0]:
@@ -157,9 +208,6 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
 
     d = rebin(d, n_x, n_y)
     plot_data=d
-    #print('d', d)
-
-    #plot_data = rebin(plot_data, dec_fac_x, dec_fac_y)
 
     #investigate intensity values for A1 (first panel)
     plot_data = 10*np.log10(plot_data)
@@ -169,7 +217,7 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
     
     #defining more plot parameters
     delta_f = 0.000250
-    epoch = filheader['tstart']
+    epoch = t0
     mid_f = np.abs(f_start+f_stop)/2.
     drate_max = np.max(np.abs(drates))
     
@@ -183,19 +231,16 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
         vmin, vmax = kwargs['clim']
         
     #Filling in each subplot for the full plot
-    for i,filename in enumerate(filenames_list):
+    for i,panel in enumerate(panels):
         subplot = plt.subplot(n_plots,1,i+1)
         subplots.append(subplot)
-        fil = bl.Waterfall(filename, f_start=f_start, f_stop=f_stop)
-        filheader=fil.header
-
 
         try:
-            this_plot = plot_waterfall(fil,f_start=f_start, f_stop=f_stop, drate=drate_max,
-                                       vmin=vmin,vmax=vmax,**kwargs)
+            this_plot = plot_waterfall_data(panel['plot_f'], panel['plot_data'], panel['timestamps'],
+                                            vmin=vmin,vmax=vmax,**kwargs)
             for drate, fval in zip(drates, fvals):
-                t_elapsed = Time(filheader['tstart'], format='mjd').unix - Time(t0, format='mjd').unix
-                t_duration = (fil.n_ints_in_file -1)* filheader['tsamp']
+                t_elapsed = Time(panel['tstart'], format='mjd').unix - Time(t0, format='mjd').unix
+                t_duration = (panel['n_ints_in_file'] -1)* panel['tsamp']
                 f_event = fval + drate / 1e6 * t_elapsed
                 overlay_drift(f_event, drate, t_duration, offset)
         except:
@@ -206,8 +251,9 @@ def make_waterfall_plots(filenames_list, target, drates, fvals, f_start,f_stop,
             srcname = "%s $\dot{\\nu}$=%2.3f Hzs$^{-1}$" % (target, drate_max)
             plt.title(srcname)
     #Plot formatting
-        if i < len(filenames_list)-1:
-            plt.xticks(np.arange(f_start, f_stop, delta_f/4.), ['','','',''])
+        if i < len(panels)-1:
+            plt.xticks(np.arange(f_start, f_stop, delta_f/4.))
+            plt.tick_params(labelbottom=False)
 
     #More plot formatting.
     ax = plt.gca()
@@ -242,14 +288,40 @@ def plot_waterfall(fil, f_start=None, f_stop=None, drate=None, if_id=0, logged=T
         logged (bool): Plot in linear (False) or dB units (True),
         cb (bool): for plotting the colorbar
         kwargs: keyword args to be passed to matplotlib imshow()
+    A wide window is read from the preview file of fil, when there is one
+    (see read_waterfall_panel): fil then needs no data loaded.
+    """
+
+    #Get the data
+    level = None
+    if f_start is not None and f_stop is not None:
+        level = read_preview_level(fil.filename, f_start, f_stop, MAX_IMSHOW_POINTS[1])
+    if level is not None:
+        panel = preview_panel(level, f_start, f_stop)
+        plot_f, plot_data, timestamps = panel['plot_f'], panel['plot_data'], panel['timestamps']
+    else:
+        plot_f, plot_data = fil.grab_data(f_start=f_start, f_stop=f_stop)
+        timestamps = fil.timestamps
+
+    return plot_waterfall_data(plot_f, plot_data, timestamps, logged=logged, cb=cb, freq_label=freq_label,
+                               MJD_time=MJD_time, **kwargs)
+
+
+def plot_waterfall_data(plot_f, plot_data, timestamps, logged=True, cb=False, freq_label=False, MJD_time=False,
+                        **kwargs):
+    """ Plot waterfall of in-memory data
+    Args:
+        plot_f (np.array): frequency axis in MHz
+        plot_data (np.array): data, with shape (time, frequency)
+        timestamps (np.array): MJD of every integration
+        logged (bool): Plot in linear (False) or dB units (True),
+        cb (bool): for plotting the colorbar
+        kwargs: keyword args to be passed to matplotlib imshow()
     """
 
     #prepare font
     matplotlib.rc('font', **font)
 
-    #Get the data
-    plot_f, plot_data = fil.grab_data(f_start=f_start, f_stop=f_stop)
-
     # Make sure waterfall plot is under 4k*4k
     dec_fac_x, dec_fac_y = 1, 1
     if plot_data.shape[0] > MAX_IMSHOW_POINTS[0]:
@@ -268,9 +340,9 @@ def plot_waterfall(fil, f_start=None, f_stop=None, drate=None, if_id=0, logged=T
     #plot_data = rebin(plot_data, dec_fac_x, dec_fac_y)
 
     if MJD_time:
-        extent=(plot_f[0], plot_f[-1], fil.timestamps[-1], fil.timestamps[0])
+        extent=(plot_f[0], plot_f[-1], timestamps[-1], timestamps[0])
     else:
-        extent=(plot_f[0], plot_f[-1], (fil.timestamps[-1]-fil.timestamps[0])*24.*60.*60, 0.0)
+        extent=(plot_f[0], plot_f[-1], (timestamps[-1]-timestamps[0])*24.*60.*60, 0.0)
 
     #plots and scales intensity
     kwargs['cmap'] = kwargs.get('cmap', 'viridis')
@@ -303,88 +375,212 @@ def plot_waterfall(fil, f_start=None, f_stop=None, drate=None, if_id=0, logged=T
 
 def plot_candidate_events_individually(full_candidate_event_dataframe, correct_fils, source_name,
                                        node_string, filter_level, show=False, overwrite=False, offset=0, **kwargs):
-    trimmed_candidate_event_dataframe=pd.read_csv(full_candidate_event_dataframe)
-    print ('full_candidate_event_dataframe', full_candidate_event_dataframe)
-    #get only the events in the dataframe that are from the right target
-    #full_candidate_event_dataframe=full_candidate_event_dataframe['Source']
-    print ('trimmed_candidate_event_dataframe_Source', trimmed_candidate_event_dataframe.loc[:, ['Source']])
-    #print ('full_candidate_event_dataframe_Source', full_candidate_event_dataframe['Source'])
-    candidate_event_dataframe = trimmed_candidate_event_dataframe.loc[:, ['Source', 'Freq', 'DriftRate','FreqStart']]
-    #candidate_event_dataframe = full_candidate_event_dataframe.loc[full_candidate_event_dataframe['Source'] == source_name]
-    print ('full_candidate_event_dataframe', candidate_event_dataframe)
-
-    #load in the data for each individual hit
-    for i in range(0, len(candidate_event_dataframe)):
-        candidate = candidate_event_dataframe.iloc[i]
-        source_id = candidate['Source']
-        f_mid = candidate['Freq']
-        drate = -1*candidate['DriftRate']
-                
-        #load in the list of .fil files
-        filelist = open(correct_fils).readlines()
-        filelist = [files.replace('\n','') for files in filelist]
-        #print ('dat_file_list', dat_file_list)
-        filelist = [files.replace(',','') for files in filelist]
-        #filelist = correct_fils    
-        print ('filelist', filelist) 
-        #calculate the length of the total ABABAB from the fil files' headers
-        fil0 = bl.Waterfall(filelist[0], load_data=True)
-        print ('fil0', fil0)
-        fil0header=fil0.header
-        print ('fil0header', fil0header)
-        y={}
-        for key, value in fil0header.items():
-            y[key.decode("utf-8")]=value
-        fil0header=y
-        print ('fil0header', fil0header)
-        t0 = fil0header['tstart']
-        
-        fil6 = bl.Waterfall(filelist[-1], load_data=True)
-        fil6header=fil6.header
-        z={}
-        for key, value in fil6header.items():
-            z[key.decode("utf-8")]=value
-        fil6header=z
-        t6 = fil6header['tstart']
-        t_elapsed = Time(t6, format='mjd').unix - Time(t0, format='mjd').unix + (fil6.n_ints_in_file -1) * fil6header['tsamp']
-
-
-        #calculate the width of the plot based on making sure the full drift is visible
-        bw = 2.4*abs(drate)/1e6 * t_elapsed
-        bw = np.max((bw, 500./1e6))
-
-        #Get start and stop frequencies based on midpoint and bandwidth
-        f_start, f_stop = np.sort((f_mid-bw/2,  f_mid+bw/2))
-
-        #Print useful values
-        print('*************************************************')
-        print('***     The Parameters for This Plot Are:     ***')
-        print('*************************************************')   
-        print('Target = ', source_id)
-        print('Bandwidth (MHz) = ', bw)
-        print('Total Time Elapsed (s) = ', t_elapsed)
-        print('Start Frequency (MHz) = ', f_start)
-        print('Middle Frequency (MHz) = ', f_mid)
-        print('Stop Frequency (MHz) = ', f_stop)
-        print('Expected Drift (Hz/s) = ', drate)
-        print('*************************************************')
-        print('*************************************************')
-                
-        #Pass info to make_waterfall_plots() function
-        subplots = make_waterfall_plots(filelist, 
-                                        [source_id], 
-                                        [drate], 
-                                        [f_mid], 
-                                        f_start, 
-                                        f_stop, 
-                                        node_string,
-                                        filter_level,
-                                        ion=False, 
-                                        epoch=None,
-                                        local_host='',
-                                        plot_name='',
-                                        save_pdf_plot=True,
-                                        saving_fig=True, 
-                                        offset=offset, 
-                                        **kwargs)
+    """ Plots every candidate of a .csv file of events, with the files of a
+    single cadence listed in correct_fils (see plot_candidate_events).
+    """
+    plot_candidate_events(full_candidate_event_dataframe, correct_fils, node_string, filter_level,
+                          offset=offset, **kwargs)
     return 
+
+
+def read_waterfall_header(filename):
+    """ Reads the header of a filterbank or HDF5 file, without its data
+
+    Args:
+        filename (str): Path to filterbank or HDF5 file
+    Returns:
+        file_info (dict): header, number of integrations, timestamps and
+        frequency borders of the file
+    """
+    fil = bl.Waterfall(filename, load_data=False)
+    return {'header': dict(fil.header),
+            'n_ints_in_file': fil.n_ints_in_file,
+            'timestamps': fil.container.populate_timestamps(),
+            'f_begin': fil.container.f_begin,
+            'f_end': fil.container.f_end}
+
+
+def window_chans(file_info, f_start, f_stop):
+    """ Channel range [start, stop) that blimpy reads for a frequency
+    selection, with the same clipping and rounding as its readers.
+    """
+    f_begin, f_end, foff = file_info['f_begin'], file_info['f_end'], file_info['header']['foff']
+    if not f_begin <= f_start < f_end:
+        f_start = f_begin
+    if not f_begin < f_stop <= f_end:
+        f_stop = f_end
+    f0 = f_end if foff < 0 else f_begin
+    chan_start = int(np.round((f_start - f0) / foff))
+    chan_stop = int(np.round((f_stop - f0) / foff))
+    return min(chan_start, chan_stop), max(chan_start, chan_stop)
+
+
+def grab_window(freqs, data, f_start, f_stop, if_id=0):
+    """ Extract a portion of in-memory data by frequency range, as
+    Waterfall.grab_data does.
+
+    Returns:
+        (freqs, data) (np.arrays): frequency axis in MHz and data subset
+    """
+    i0 = np.argmin(np.abs(freqs - f_start))
+    i1 = np.argmin(np.abs(freqs - f_stop))
+
+    if i0 < i1:
+        return freqs[i0:i1 + 1], np.squeeze(data[:, if_id, i0:i1 + 1])
+    return freqs[i1:i0 + 1], np.squeeze(data[:, if_id, i1:i0 + 1])
+
+
+def read_window_panels(filename, file_info, windows, min_points=MAX_IMSHOW_POINTS[1]):
+    """ Reads the panels of several frequency windows of one file. Wide
+    windows are read from the preview file, as in read_waterfall_panel.
+    The others are read together when they are close in frequency (no more
+    than a window width apart), in one slice of at most MAX_SLICE_CHANNELS
+    channels. The panels hold copies of their windows, not views of the
+    slice.
+
+    Args:
+        filename (str): Path to filterbank or HDF5 file
+        file_info (dict): see read_waterfall_header
+        windows (list): (f_start, f_stop) of every window, in MHz
+        min_points (int): number of frequency points needed in a panel
+    Returns:
+        panels (list): one panel per window (see waterfall_panel)
+    """
+    chans = [window_chans(file_info, f_start, f_stop) for f_start, f_stop in windows]
+    f0 = file_info['f_end'] if file_info['header']['foff'] < 0 else file_info['f_begin']
+
+    panels = [None] * len(windows)
+    for ii, (f_start, f_stop) in enumerate(windows):
+        level = read_preview_level(filename, f_start, f_stop, min_points)
+        if level is not None:
+            panels[ii] = preview_panel(level, f_start, f_stop)
+    order = sorted([ii for ii in range(len(windows)) if panels[ii] is None], key=lambda ii: chans[ii])
+    while order:
+        #Grow the slice with the next window while it is close and the slice stays small enough
+        group = [order.pop(0)]
+        slice_start, slice_stop = chans[group[0]]
+        while order and chans[order[0]][0] - slice_stop <= chans[order[0]][1] - chans[order[0]][0] and \
+                max(slice_stop, chans[order[0]][1]) - slice_start <= MAX_SLICE_CHANNELS:
+            slice_stop = max(slice_stop, chans[order[0]][1])
+            group.append(order.pop(0))
+
+        f_slice = np.sort([f0 + slice_start * file_info['header']['foff'], f0 + slice_stop * file_info['header']['foff']])
+        fil = bl.Waterfall(filename, f_start=f_slice[0], f_stop=f_slice[1])
+        freqs = fil.container.populate_freqs()
+        first_chan = fil.container.chan_start_idx
+        for ii in group:
+            chan_start, chan_stop = chans[ii]
+            plot_f, plot_data = grab_window(freqs[chan_start - first_chan:chan_stop - first_chan],
+                                            fil.data[:, :, chan_start - first_chan:chan_stop - first_chan],
+                                            windows[ii][0], windows[ii][1])
+            panels[ii] = waterfall_panel(np.array(plot_f), np.array(plot_data), file_info['timestamps'],
+                                         file_info['header'], file_info['n_ints_in_file'])
+    return panels
+
+
+def _init_plot_worker():
+    """ Pool initializer: plots are only saved, with the Agg backend. """
+    plt.switch_backend('Agg')
+
+
+def _plot_candidate(job):
+    """ Plots and saves one candidate, then frees its figure. """
+    panels, args, kwargs = job
+    plot_waterfall_panels(panels, *args, **kwargs)
+    plt.close('all')
+
+
+def plot_candidate_events(candidate_event_table, fil_file_list, node_string, filter_level, number_in_cadence=None,
+                          n_jobs=1, offset=0, on_off_first='ON', **kwargs):
+    """ Plots every candidate of a table of events (see find_event_pipeline),
+    with the files of its cadence.
+
+    The header of every file is read once. The candidates are grouped by
+    cadence, and every file is read once for all the candidates of its
+    cadence (see read_window_panels), instead of once per candidate.
+
+    Args:
+        candidate_event_table (str or pandas dataframe): events, or name of
+            the .csv file where find_event_pipeline saved them
+        fil_file_list (str): Name of a .lst file with the filterbank or HDF5
+            files of one or more cadences, in the order of the .dat files
+        node_string (str): Prefix of the names of the .png files
+        filter_level (int): Filter level of the events, for the file names
+        number_in_cadence (int): Number of files in one cadence. The
+            candidates of a cadence are those of its ON source. Default is
+            None: the files of the list are one cadence, used for all the
+            candidates.
+        n_jobs (int): Number of processes rendering the plots, with the Agg
+            backend. Default is 1.
+        offset (float): Offset drift line on plot. Default 0.
+        on_off_first (str): 'ON' (default) if the cadences start with an ON
+            observation, 'OFF' if they start with an OFF observation, as in
+            find_event_pipeline.
+    """
+    if on_off_first not in ('ON', 'OFF'):
+        raise ValueError('Invalid on_off_first parameter: %s' % on_off_first)
+    if isinstance(candidate_event_table, str):
+        candidate_event_table = pd.read_csv(candidate_event_table)
+    candidate_event_dataframe = candidate_event_table.loc[:, ['Source', 'Freq', 'DriftRate','FreqStart']]
+
+    #load in the list of .fil files
+    filelist = open(fil_file_list).readlines()
+    filelist = [files.replace('\n','') for files in filelist]
+    filelist = [files.replace(',','') for files in filelist]
+    if number_in_cadence is None:
+        number_in_cadence = len(filelist)
+    cadence_list = [filelist[ii:ii + number_in_cadence] for ii in range(0, len(filelist), number_in_cadence)]
+
+    file_infos = {}
+    for filename in filelist:
+        if filename not in file_infos:
+            file_infos[filename] = read_waterfall_header(filename)
+
+    def jobs():
+        for cadence in cadence_list:
+            if len(cadence_list) > 1:
+                # The OFF targets of a cadence are often the ON targets of others: only its ON source counts.
+                on_file = cadence[0] if on_off_first == 'ON' else cadence[1]
+                on_source = str(file_infos[on_file]['header']['source_name']).upper()
+                candidates = candidate_event_dataframe[candidate_event_dataframe['Source'] == on_source]
+            else:
+                candidates = candidate_event_dataframe
+            if len(candidates) == 0:
+                continue
+
+            #calculate the length of the total ABABAB from the files' headers
+            first_info, last_info = file_infos[cadence[0]], file_infos[cadence[-1]]
+            t_elapsed = Time(last_info['header']['tstart'], format='mjd').unix - \
+                        Time(first_info['header']['tstart'], format='mjd').unix + \
+                        (last_info['n_ints_in_file'] -1) * last_info['header']['tsamp']
+
+            windows = []
+            for i in range(0, len(candidates)):
+                drate = -1*candidates['DriftRate'].iloc[i]
+                #calculate the width of the plot based on making sure the full drift is visible
+                bw = 2.4*abs(drate)/1e6 * t_elapsed
+                bw = np.max((bw, 500./1e6))
+                f_mid = candidates['Freq'].iloc[i]
+                windows.append(tuple(np.sort((f_mid-bw/2,  f_mid+bw/2))))
+
+            cadence_panels = [read_window_panels(filename, file_infos[filename], windows) for filename in cadence]
+            for i in range(0, len(candidates)):
+                candidate = candidates.iloc[i]
+                args = ([candidate['Source']], [-1*candidate['DriftRate']], [candidate['Freq']], windows[i][0],
+                        windows[i][1], node_string, filter_level)
+                yield [panels[i] for panels in cadence_panels], args, dict(kwargs, offset=offset)
+
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, initializer=_init_plot_worker)
+        try:
+            for _ in pool.imap(_plot_candidate, jobs()):
+                pass
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for job in jobs():
+            _plot_candidate(job)
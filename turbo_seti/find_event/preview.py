@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Multi-resolution previews of filterbank and HDF5 files, for fast plotting
+of wide frequency windows.
+
+make_preview_pyramid writes a sidecar file (<name>.preview.h5) next to a
+data file, with copies of its data decimated in frequency: every channel of
+the level with factor f is the mean of f adjacent channels of the file.
+Plotting a wide window then reads one of these levels instead of the full
+resolution data, which plot_event would average down to MAX_IMSHOW_POINTS
+anyway.
+
+Usage (beta):
+    import preview
+    preview.make_preview_pyramid(filename, factors=PREVIEW_FACTORS)
+    level = preview.read_preview_level(filename, f_start, f_stop, min_points)
+
+    filename            Name of the filterbank (.fil) or HDF5 (.h5) file.
+
+    factors             Decimation factors of the levels, in channels.
+                        Default is 2, 4, 16, 64, 256 and 1024.
+
+    f_start, f_stop     Frequency window to plot, in MHz.
+
+    min_points          Number of frequency points the plot needs. The
+                        coarsest level with at least this many channels in
+                        the window is read.
+"""
+
+import os
+import h5py
+import numpy as np
+import blimpy as bl
+
+PREVIEW_FACTORS = (2, 4, 16, 64, 256, 1024)
+# Channels of the data file read at once while building the levels
+PREVIEW_CHUNK_CHANNELS = 2**20
+
+def preview_filename(filename):
+    """ Name of the preview sidecar file of a data file. """
+    return os.path.splitext(filename)[0] + '.preview.h5'
+
+def make_preview_pyramid(filename, factors=PREVIEW_FACTORS):
+    """ Writes the frequency-decimated levels of a data file into its preview
+    sidecar file (see preview_filename).
+
+    Args:
+        filename (str): Name of the filterbank or HDF5 file
+        factors (tuple): Decimation factors of the levels, in channels
+
+    Returns: name of the preview file
+    """
+    fil = bl.Waterfall(filename, load_data=False)
+    header = fil.header
+    n_ints, n_chans, n_ifs = fil.n_ints_in_file, fil.n_channels_in_file, header['nifs']
+    f0 = fil.container.f_end if header['foff'] < 0 else fil.container.f_begin
+    file_stat = os.stat(filename)
+
+    # Chunks are a multiple of every factor, so no level channel spans two chunks
+    chunk = PREVIEW_CHUNK_CHANNELS // np.lcm.reduce(factors) * np.lcm.reduce(factors)
+    if chunk == 0:
+        raise ValueError('Preview factors must divide %i channels.' % PREVIEW_CHUNK_CHANNELS)
+
+    out_file = preview_filename(filename)
+    with h5py.File(out_file + '.tmp', 'w') as h5:
+        h5.attrs['source_file'] = os.path.basename(filename)
+        h5.attrs['mtime_ns'] = file_stat.st_mtime_ns
+        h5.attrs['size'] = file_stat.st_size
+        h5.attrs['tstart'] = header['tstart']
+        h5.attrs['tsamp'] = header['tsamp']
+        h5.attrs['n_ints_in_file'] = n_ints
+        h5.attrs['n_channels_in_file'] = n_chans
+        levels = []
+        for factor in sorted(factors):
+            level = h5.create_dataset('level_%i' % factor, shape=(n_ints, n_ifs, n_chans // factor), dtype='float32')
+            level.attrs['factor'] = factor
+            level.attrs['fch1'] = header['fch1'] + header['foff'] * (factor - 1) / 2.
+            level.attrs['foff'] = header['foff'] * factor
+            levels.append(level)
+
+        for chan_start in range(0, n_chans, chunk):
+            chan_stop = min(chan_start + chunk, n_chans)
+            f_chunk = np.sort([f0 + chan_start * header['foff'], f0 + chan_stop * header['foff']])
+            data = bl.Waterfall(filename, f_start=f_chunk[0], f_stop=f_chunk[1]).data
+            if data.shape[2] != chan_stop - chan_start:
+                raise ValueError('Read %i channels instead of %i from %s.' % (data.shape[2], chan_stop - chan_start,
+                                                                              filename))
+            for level in levels:
+                factor = level.attrs['factor']
+                n_level_chans = (chan_stop - chan_start) // factor
+                decimated = data[:, :, :n_level_chans * factor].reshape(n_ints, n_ifs, n_level_chans, factor)
+                level[:, :, chan_start // factor:chan_start // factor + n_level_chans] = \
+                    decimated.mean(axis=3, dtype=np.float64)
+    os.replace(out_file + '.tmp', out_file)
+    return out_file
+
+def read_preview_level(filename, f_start, f_stop, min_points):
+    """ Reads a frequency window from the coarsest preview level that still
+    has min_points channels in it.
+
+    Args:
+        filename (str): Name of the filterbank or HDF5 file
+        f_start (float): start frequency, in MHz
+        f_stop (float): stop frequency, in MHz
+        min_points (int): Number of frequency points needed
+
+    Returns: (freqs, data, header) with the frequency axis in MHz, the data
+    with shape (time, IF, frequency), and a dict with tstart, tsamp and
+    n_ints_in_file. Returns None when there is no preview file, when it is
+    out of date, or when no level is coarse enough to help.
+    """
+    out_file = preview_filename(filename)
+    if not os.path.isfile(out_file):
+        return None
+    file_stat = os.stat(filename)
+    with h5py.File(out_file, 'r') as h5:
+        if (h5.attrs['mtime_ns'], h5.attrs['size']) != (file_stat.st_mtime_ns, file_stat.st_size):
+            return None
+
+        level = None
+        for name in h5:
+            factor = h5[name].attrs['factor']
+            n_points = abs(f_stop - f_start) / abs(h5[name].attrs['foff'])
+            if n_points >= min_points and (level is None or factor > level.attrs['factor']):
+                level = h5[name]
+        if level is None:
+            return None
+
+        # Level channels covering the window, plus one on each side
+        fch1, foff = level.attrs['fch1'], level.attrs['foff']
+        chans = np.sort([(f_start - fch1) / foff, (f_stop - fch1) / foff])
+        chan_start = max(int(np.floor(chans[0])) - 1, 0)
+        chan_stop = min(int(np.ceil(chans[1])) + 2, level.shape[2])
+        freqs = fch1 + foff * np.arange(chan_start, chan_stop)
+        data = level[:, :, chan_start:chan_stop]
+        header = {'tstart': h5.attrs['tstart'], 'tsamp': h5.attrs['tsamp'],
+                  'n_ints_in_file': int(h5.attrs['n_ints_in_file'])}
+    return freqs, data, header
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Persistent index of the hits found in many turboSETI .dat files, used to
+reject RFI that shows up in the observations of other sources.
+
+Terrestrial emitters are seen in every cadence of a session, whatever the
+target. find_events compares each ON hit with the OFFs of its own cadence;
+with an index, it can also compare it with the hits of every other source
+that was observed, without reading those .dat files again.
+
+The index is a SQLite file with one row per hit (frequency, drift rate and
+source) and a B-tree index on frequency. A hit of the ON source matches RFI
+when hits of other sources lie strictly inside its frequency range, the same
+range (calc_freq_range) that find_events uses for the OFF observations.
+SQLite's R-tree module is not used: the ranges are one dimensional, which a
+B-tree answers just as well, and R-tree coordinates are 32-bit floats, too
+coarse for frequencies in MHz (~0.5 kHz steps at 8 GHz).
+
+Usage (beta):
+    import rfi_index
+    rfi_index.update_rfi_index(index_file, dat_file_list, cache=False)
+    n_sources = rfi_index.count_rfi_sources(index_file, hits, source)
+
+    index_file          Name of the SQLite index file. It is created when
+                        missing.
+
+    dat_file_list       A Python list of .dat (or .hits.h5) files to add to
+                        the index. Files that are already in the index, with
+                        unchanged size and modification time, are skipped;
+                        changed files are indexed again.
+
+    hits                A pandas dataframe of hits, as returned by make_table.
+
+    source              The name of the ON source: its own hits are ignored.
+"""
+
+import os
+import sqlite3
+import numpy as np
+
+try:
+    from . import find_event
+except:
+    import find_event
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, '
+    'mtime_ns INTEGER, size INTEGER, source TEXT)',
+    'CREATE TABLE IF NOT EXISTS hits (file INTEGER, source TEXT, freq REAL, drift_rate REAL)',
+    # Covering index: counting the sources in a frequency range never reads the table rows
+    'CREATE INDEX IF NOT EXISTS hits_freq ON hits (freq, source)',
+    'CREATE INDEX IF NOT EXISTS hits_file ON hits (file)',
+]
+
+def open_rfi_index(index_file):
+    """ Opens (and creates, if needed) an RFI index
+
+    Args:
+        index_file (str): Name of the SQLite index file
+
+    Returns: sqlite3 connection
+    """
+
+    connection = sqlite3.connect(index_file)
+    with connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+    return connection
+
+def update_rfi_index(index_file, dat_file_list, cache=False):
+    """ Adds the hits of .dat files to an RFI index, skipping the files that
+    were indexed before and have not changed since.
+
+    Args:
+        index_file (str): Name of the SQLite index file
+        dat_file_list (list): Names of the .dat or .hits.h5 files to index
+        cache (bool): Passed to make_table, to use the .npz sidecar files
+
+    Returns: number of files that were (re)indexed
+    """
+
+    connection = open_rfi_index(index_file)
+    n_indexed = 0
+    try:
+        for dat_file in dat_file_list:
+            path = os.path.abspath(dat_file.strip())
+            file_stat = os.stat(path)
+            row = connection.execute('SELECT id, mtime_ns, size FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[1:] == (file_stat.st_mtime_ns, file_stat.st_size):
+                continue
+
+            hits = find_event.make_table(path, cache=cache)
+            source = str(hits['Source'].iloc[0]) if len(hits) else ''
+            with connection:
+                if row is not None:
+                    connection.execute('DELETE FROM hits WHERE file = ?', (row[0],))
+                    connection.execute('DELETE FROM files WHERE id = ?', (row[0],))
+                file_id = connection.execute('INSERT INTO files (path, mtime_ns, size, source) VALUES (?, ?, ?, ?)',
+                                             (path, file_stat.st_mtime_ns, file_stat.st_size, source)).lastrowid
+                if len(hits):
+                    connection.executemany('INSERT INTO hits VALUES (?, ?, ?, ?)',
+                                           zip([file_id] * len(hits), [source] * len(hits),
+                                               hits['Freq'].values.tolist(), hits['DriftRate'].values.tolist()))
+            n_indexed += 1
+    finally:
+        connection.close()
+    return n_indexed
+
+def count_rfi_sources(index_file, hits, source):
+    """ Counts, for every hit, the other sources with indexed hits strictly
+    inside the hit's frequency range (see calc_freq_range).
+
+    Args:
+        index_file (str): Name of the SQLite index file
+        hits (pandas dataframe): Hits, as returned by make_table
+        source (str): Name of the ON source, whose hits are not counted
+
+    Returns: numpy array with the number of other sources for every hit
+    """
+
+    low_bounds, high_bounds = find_event.calc_freq_ranges(hits)
+    connection = open_rfi_index(index_file)
+    try:
+        query = 'SELECT COUNT(DISTINCT source) FROM hits WHERE freq > ? AND freq < ? AND source != ?'
+        n_sources = [connection.execute(query, (low, high, source)).fetchone()[0]
+                     for low, high in zip(low_bounds.tolist(), high_bounds.tolist())]
+    finally:
+        connection.close()
+    return np.array(n_sources, dtype=np.int64)